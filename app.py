@@ -3,15 +3,42 @@ import json
 import time
 import csv
 import threading
+import atexit
+import io
+import re
+import zlib
+import functools
+import hmac
+import hashlib
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, session, send_file, g, has_request_context
+from flask import before_render_template, template_rendered
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from authlib.integrations.flask_client import OAuth
-import paho.mqtt.client as mqtt
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_mail import Mail, Message
 import requests
 import base64
+import click
+import numpy as np
+from storage import HomeConflict, create_storage, migrate_json_to_sqlite
+from events import ChangeFeed, format_sse
+from commands import CommandQueue
+from mqtt_publisher import MQTTPublisher
+from device_status import StatusIngestor
+from timer_scheduler import TimerJournal, TimerScheduler, run_as_leader
+from mail_queue import MailQueue, MailQueueFull
+from snapshots import SnapshotStore, SnapshotTooLarge
+from presence import PresenceTracker
+from home_locks import HomeLocks
+from auth_pool import AuthBusy, PasswordHasher, TokenBucketLimiter
+from user_cache import UserCache
+from synthetic import generate_home_series, generate_homes
+from metrics import RequestMetrics, TimedProxy
+from profiler import RequestProfiler
+from usage_stats import summarize_usage
+from timeseries import (EPOCH, SegmentStore, epoch_hour_label, load_series, parse_export_bound, parse_reading,
+                        to_epoch_hours, to_epoch_seconds)
 
 
 # --- Application Setup ---
@@ -30,11 +57,120 @@ app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', app.config['MAIL_USERNAME'])
 mail = Mail(app)
+MAIL_OUTBOX_DB = os.environ.get('MAIL_OUTBOX_DB', 'mail_outbox.db')
+MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS', 2))  # Worker threads, each holding one SMTP connection
+SNAPSHOTS_DIR = os.environ.get('SNAPSHOTS_DIR', 'snapshots')
+
+# --- Authentication ---
+AUTH_HASH_WORKERS = int(os.environ.get('AUTH_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2)))  # Hashing processes; 0 hashes inline
+AUTH_MAX_CONCURRENT_HASHES = int(os.environ.get('AUTH_MAX_CONCURRENT_HASHES', max(1, (os.cpu_count() or 2) // 2)))  # Across all workers of this deployment
+AUTH_SLOT_WAIT = float(os.environ.get('AUTH_SLOT_WAIT', 5))  # Seconds a sign-in waits for a hashing slot before getting a 503
+AUTH_MAX_WAITING = int(os.environ.get('AUTH_MAX_WAITING', 16))  # Sign-ins per worker that may wait for a slot at once
+AUTH_SLOT_DIR = os.environ.get('AUTH_SLOT_DIR')  # Slot lock files shared by this deployment's workers; defaults to a temp dir keyed by the working directory
+AUTH_HASH_METHOD = os.environ.get('AUTH_HASH_METHOD', 'scrypt')
+LOGIN_IP_BURST = int(os.environ.get('LOGIN_IP_BURST', 10))
+LOGIN_IP_PER_MINUTE = float(os.environ.get('LOGIN_IP_PER_MINUTE', 10))
+LOGIN_ACCOUNT_BURST = int(os.environ.get('LOGIN_ACCOUNT_BURST', 5))
+LOGIN_ACCOUNT_PER_MINUTE = float(os.environ.get('LOGIN_ACCOUNT_PER_MINUTE', 5))
+
+# --- User Cache ---
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))  # Seconds a principal may be served without rereading storage
+
+# --- Request Timing ---
+request_metrics = RequestMetrics()
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # When set, /metrics requires "Authorization: Bearer <token>"
+
+# --- Slow Request Profiler ---
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 1000))  # Requests slower than this are saved with their sampled stacks
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 200))  # Oldest captures are deleted beyond this
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))  # Seconds between stack samples
+PROFILE_SAMPLING = os.environ.get('PROFILE_SAMPLING', 'false').lower() in ['true', 'on', '1']  # Stack-sample every request to catch slow ones
+# Usernames that may read saved profiles and request a full cProfile run with "X-Profile: 1"
+ADMIN_USERS = {name.strip() for name in os.environ.get('ADMIN_USERS', '').split(',') if name.strip()}
+profiler = RequestProfiler(PROFILE_DIR, PROFILE_SLOW_MS / 1000, PROFILE_MAX_FILES, PROFILE_SAMPLE_INTERVAL, PROFILE_SAMPLING)
+
+def is_admin():
+    return current_user.is_authenticated and current_user.username in ADMIN_USERS
+
+def record_phase(phase, seconds):
+    """Adds time spent in a phase to its histogram and to the current request's Server-Timing header."""
+    request_metrics.observe_phase(phase, seconds)
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[phase] = timings.get(phase, 0) + seconds
+
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - started)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.profile = profiler.begin(full=request.headers.get('X-Profile') == '1' and is_admin())
+
+@app.after_request
+def record_request_timing(response):
+    """Streamed responses are timed up to their first byte."""
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    request_metrics.observe_request(endpoint, request.method, response.status_code, elapsed)
+    profile_name = profiler.finish(g.pop('profile', None), endpoint, request.method, request.path, response.status_code, elapsed)
+    if profile_name and is_admin():
+        response.headers['X-Profile-Id'] = profile_name
+    timings = g.get('timings', {})
+    response.headers['Server-Timing'] = ', '.join(
+        [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in timings.items()] + [f"app;dur={elapsed * 1000:.2f}"])
+    return response
+
+@app.teardown_request
+def stop_request_profile(exc):
+    # Requests that failed before after_request still have to release their profile
+    profiler.cancel(g.pop('profile', None))
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_render_timing(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        record_phase('render', time.perf_counter() - started)
 
 # --- Data File Paths ---
 USERS_FILE = 'users.json'
 DATA_FILE = 'data.json'
+DATABASE_FILE = os.environ.get('DATABASE_FILE', 'luminous.db')
 ANALYTICS_FILE = 'analytics_data.csv'
+# Columnar binary copy of ANALYTICS_FILE that the analytics endpoints memory-map
+ANALYTICS_STORE = os.environ.get('ANALYTICS_STORE', 'analytics_data.bin')
+# Per-home meter readings posted to /api/readings, one directory of monthly segments per home
+READINGS_DIR = os.environ.get('READINGS_DIR', 'readings')
+# Readings parsed and committed per group when a request streams NDJSON
+READINGS_CHUNK_SIZE = 5000
+# Validation errors echoed back to the device per request
+MAX_READING_ERRORS = 20
+READINGS_CACHE_HOMES = int(os.environ.get('READINGS_CACHE_HOMES', 256))  # Homes' reading series kept in memory per worker
+# Signs the per-home tokens devices send as X-Device-Token; when unset only signed-in users can post readings
+# and device check-in is disabled
+DEVICE_TOKEN_SECRET = os.environ.get('DEVICE_TOKEN_SECRET', '')
+EXPORT_CHUNK_ROWS = 8760  # Rows rendered per streamed export chunk (a year of hourly readings)
+
+# 'json' keeps everything in data.json/users.json, 'sqlite' stores one row per home
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json').lower()
+# Seconds the JSON backend waits to coalesce writes before flushing them to disk
+STORAGE_WRITE_DELAY = float(os.environ.get('STORAGE_WRITE_DELAY', 0.5))
+storage = TimedProxy(create_storage(STORAGE_BACKEND, DATA_FILE, USERS_FILE, DATABASE_FILE, STORAGE_WRITE_DELAY),
+                     'storage', timed)
 
 ELECTRICITY_RATE = 6.50
 
@@ -45,10 +181,60 @@ API_KEY = ""  # Your API Key will be automatically provided by the Canvas enviro
 # --- MQTT Setup ---
 MQTT_BROKER = "mqtt.eclipse.org"
 MQTT_PORT = 1883
-MQTT_TOPIC_COMMAND = "lumino_us/commands"
+MQTT_TOPIC_COMMAND = "lumino_us/commands"  # Each home's device subscribes to <MQTT_TOPIC_COMMAND>/<user_id>
 MQTT_TOPIC_STATUS = "lumino_us/status"
+MQTT_QOS = int(os.environ.get('MQTT_QOS', 1))
+MQTT_MAX_QUEUE = int(os.environ.get('MQTT_MAX_QUEUE', 10000))  # Messages held in memory before spilling to disk
+MQTT_BATCH_MAX = int(os.environ.get('MQTT_BATCH_MAX', 1))  # >1 joins same-topic payloads with newlines
+MQTT_SPILL_FILE = os.environ.get('MQTT_SPILL_FILE', 'mqtt_spill.jsonl')
+MQTT_MAX_SPILL = int(os.environ.get('MQTT_MAX_SPILL', 100000))  # Messages kept in the spill file; newer ones are dropped
+MQTT_STATUS_WORKERS = int(os.environ.get('MQTT_STATUS_WORKERS', 4))
+MQTT_STATUS_FLUSH_INTERVAL = 0.5  # Seconds between coalesced status writes
 
 mqtt_client = None
+status_ingestor = None
+
+# --- ESP Command Queue Setup ---
+COMMANDS_DB = os.environ.get('COMMANDS_DB', 'commands.db')
+CHECK_IN_MAX_WAIT = 30  # Longest a check-in long-poll may hold the request, in seconds
+COMMAND_TTL = int(os.environ.get('COMMAND_TTL', 600))  # Seconds a queued command stays deliverable
+TIMERS_DB = os.environ.get('TIMERS_DB', 'timers.db')  # Timers set by any worker, for the process that fires them
+TIMERS_LEADER_LOCK = os.environ.get('TIMERS_LEADER_LOCK', 'timers.leader.lock')  # Held by the one process firing timers
+command_queue = CommandQueue(COMMANDS_DB, COMMAND_TTL)
+
+def command_topic(user_id):
+    """MQTT topic carrying the commands for one home's device."""
+    return f"{MQTT_TOPIC_COMMAND}/{user_id}"
+
+def send_state_commands(user_id, changes):
+    """
+    Queues and publishes one relay command per changed appliance, in the
+    same shape set_appliance_state sends, so devices only ever see
+    commands that name a room, appliance and relay.
+    """
+    timestamp = int(time.time())
+    command_queue.enqueue_many(user_id, [{
+        "room_id": change['room_id'],
+        "appliance_id": change['appliance']['id'],
+        "state": change['appliance']['state'],
+        "relay_number": change['appliance']['relay_number'],
+        "timestamp": timestamp
+    } for change in changes])
+    if mqtt_client:
+        for change in changes:
+            appliance = change['appliance']
+            mqtt_client.publish(command_topic(user_id),
+                                f"{user_id}:{change['room_id']}:{appliance['id']}:{appliance['relay_number']}:{int(appliance['state'])}")
+
+# --- AI Presence Detection ---
+AI_PRESENCE_ON_FRAMES = int(os.environ.get('AI_PRESENCE_ON_FRAMES', 3))  # Consecutive positive frames to switch on
+AI_PRESENCE_OFF_SECONDS = float(os.environ.get('AI_PRESENCE_OFF_SECONDS', 30))  # Seconds without a person to switch off
+
+# --- Event Stream Setup ---
+change_feed = ChangeFeed()
+SSE_KEEPALIVE = 15  # Seconds between keepalives (and cross-worker revision checks)
+SSE_MAX_DURATION = 300  # Streams end after this long; EventSource reconnects with Last-Event-ID
+SSE_RETRY_MS = 3000
 
 app.secret_key = os.urandom(24)
 
@@ -83,53 +269,93 @@ github = oauth.register(
 )
 
 def connect_mqtt():
-    """Connects to the MQTT broker."""
-    global mqtt_client
+    """Starts the background MQTT publisher; it keeps reconnecting on its own."""
+    global mqtt_client, status_ingestor
     try:
-        mqtt_client = mqtt.Client()
-        def on_connect(client, userdata, flags, rc):
-            if rc == 0:
-                print("Connected to MQTT Broker successfully!")
-            else:
-                print(f"Failed to connect to MQTT Broker, return code {rc}")
-        mqtt_client.on_connect = on_connect
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        mqtt_client.loop_start()
+        mqtt_client = TimedProxy(MQTTPublisher(MQTT_BROKER, MQTT_PORT, qos=MQTT_QOS, max_queue=MQTT_MAX_QUEUE,
+                                               batch_max=MQTT_BATCH_MAX, spill_file=MQTT_SPILL_FILE,
+                                               max_spill=MQTT_MAX_SPILL),
+                                 'mqtt', timed, methods=('publish',))
+        # Devices report what their relays actually did on the status topic
+        status_ingestor = StatusIngestor(apply_device_status, workers=MQTT_STATUS_WORKERS,
+                                         flush_interval=MQTT_STATUS_FLUSH_INTERVAL)
+        status_ingestor.start()
+        mqtt_client.subscribe(MQTT_TOPIC_STATUS, status_ingestor.submit, qos=MQTT_QOS)
+        mqtt_client.start()
+        atexit.register(status_ingestor.stop)
+        atexit.register(mqtt_client.stop)
     except Exception as e:
         print(f"Error connecting to MQTT: {e}")
 
 def run_mqtt_thread():
-    # Use a separate thread for the MQTT loop to prevent blocking
-    mqtt_thread = threading.Thread(target=connect_mqtt)
-    mqtt_thread.daemon = True
-    mqtt_thread.start()
+    # The publisher runs its own threads, so this never blocks
+    connect_mqtt()
 
 
 # --- User Management ---
-class User(UserMixin):
+password_hasher = PasswordHasher(AUTH_HASH_WORKERS, AUTH_MAX_CONCURRENT_HASHES, AUTH_HASH_METHOD,
+                                 AUTH_SLOT_DIR, AUTH_SLOT_WAIT, AUTH_MAX_WAITING)
+login_ip_limiter = TokenBucketLimiter(LOGIN_IP_PER_MINUTE / 60, LOGIN_IP_BURST)
+login_account_limiter = TokenBucketLimiter(LOGIN_ACCOUNT_PER_MINUTE / 60, LOGIN_ACCOUNT_BURST)
+
+def upgrade_password_hash(user_id, old_hash, password):
+    """Re-hashes a password with the current method in the background after a successful login."""
+    def upgrade():
+        try:
+            new_hash = password_hasher.hash(password)
+        except AuthBusy:
+            return  # Try again on the next login
+        user_record = storage.get_user(user_id)
+        if user_record and user_record.get('password_hash') == old_hash:
+            user_record['password_hash'] = new_hash
+            save_user(user_record)
+            print(f"Upgraded password hash for user {user_id} to {AUTH_HASH_METHOD}.")
+    threading.Thread(target=upgrade, daemon=True).start()
+
+
+class User:
+    """
+    The session principal. Implements Flask-Login's user interface directly
+    instead of through UserMixin, so __slots__ keeps cached instances small.
+    """
+    __slots__ = ('id', 'username', 'password_hash')
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
     def __init__(self, id, username, password):
         self.id = id
         self.username = username
         self.password_hash = password
 
+    def get_id(self):
+        return str(self.id)
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
 @login_manager.user_loader
 def load_user(user_id):
-    users = load_users()
-    for user in users:
-        if user['id'] == user_id:
-            return User(user['id'], user['username'], user['password_hash'])
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    user = storage.get_user(user_id)
+    if user:
+        user_obj = User(user['id'], user['username'], user['password_hash'])
+        user_cache.put(user_id, user_obj)
+        return user_obj
     return None
 
+def save_user(user_record):
+    """Saves a user record and drops its cached principal."""
+    storage.save_user(user_record)
+    user_cache.invalidate(str(user_record['id']))
+
 def load_users():
-    if not os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'w') as f:
-            json.dump([], f)
-    with open(USERS_FILE, 'r') as f:
-        return json.load(f)
+    return storage.load_users()
 
 def save_users(users):
-    with open(USERS_FILE, 'w') as f:
-        json.dump(users, f, indent=4)
+    storage.save_users(users)
 
 # In app.py, add this new function
 
@@ -157,42 +383,27 @@ def create_default_user_data(name, email, picture=None):
 
 # --- Data Persistence Functions ---
 def load_data():
-    if not os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'w') as f:
-            json.dump({}, f)
-    with open(DATA_FILE, 'r') as f:
-        return json.load(f)
+    return storage.load_all()
 
 # In app.py
 
 # In app.py
 def find_or_create_oauth_user(profile):
     """
-    Finds a user by email to link accounts, or creates a new user.
+    Finds a user by provider ID or email to link accounts, or creates a new user.
     """
-    all_data = load_data()
-    users = load_users()
-    
-    # 1. Find existing user by email to link accounts
-    existing_user_id = None
-    for user_id, user_data in all_data.items():
-        if user_data.get("user_settings", {}).get("email") == profile['email']:
-            existing_user_id = user_id
-            break
-
-    if existing_user_id:
+    provider_field = f"{profile['provider']}_id"
+
+    # 1. Find a user already linked to this provider, or an existing user by email
+    user_record = storage.find_user(provider_field, profile['provider_id'])
+    if user_record is None and profile['email']:
+        user_record = storage.find_user('email', profile['email'])
+
+    if user_record:
         # User found! Link the new provider to this existing account.
-        user_record = next((u for u in users if u['id'] == existing_user_id), None)
-        if not user_record:
-            return "Error: Data inconsistency found.", 500
-        
-        # Add the provider's ID to the user's record
-        if profile['provider'] == 'google':
-            user_record['google_id'] = profile['provider_id']
-        elif profile['provider'] == 'github':
-            user_record['github_id'] = profile['provider_id']
-        
-        save_users(users) # Save the updated user record
+        if user_record.get(provider_field) != profile['provider_id']:
+            user_record[provider_field] = profile['provider_id']
+            save_user(user_record) # Save the updated user record
         
         # Log the user in
         user_obj = User(user_record['id'], user_record['username'], user_record['password_hash'])
@@ -200,7 +411,7 @@ def find_or_create_oauth_user(profile):
         return redirect(url_for('home'))
 
     # 2. If no user with that email exists, create a new account
-    new_user_id = str(int(users[-1]['id']) + 1) if users else "1"
+    new_user_id = storage.next_user_id()
     
     # Create new entry in users.json
     new_user = {
@@ -210,16 +421,14 @@ def find_or_create_oauth_user(profile):
         'google_id': profile['provider_id'] if profile['provider'] == 'google' else None,
         'github_id': profile['provider_id'] if profile['provider'] == 'github' else None,
     }
-    users.append(new_user)
-    save_users(users)
+    save_user(new_user)
     
     # Create new entry in data.json using your helper function
-    all_data[new_user_id] = create_default_user_data(
+    storage.save_home(new_user_id, create_default_user_data(
         name=profile['name'],
         email=profile['email'],
         picture=profile['picture']
-    )
-    save_data(all_data)
+    ))
     
     # Log the new user in
     user_obj = User(new_user['id'], new_user['username'], new_user['password_hash'])
@@ -227,97 +436,287 @@ def find_or_create_oauth_user(profile):
     return redirect(url_for('home'))
 
 def save_data(data):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+    storage.save_all(data)
 
 def get_user_data():
-    data = load_data()
-    return data.get(current_user.id, {
+    user_data = storage.get_home(current_user.id)
+    if user_data is not None:
+        return user_data
+    return {
         "user_settings": {
             "name": current_user.username,
             "email": "", "mobile": "", "channel": "email", "theme": "light", "ai_control_interval": 5
         },
         "rooms": []
-    })
+    }
 
-def save_user_data(user_data):
-    data = load_data()
-    data[current_user.id] = user_data
-    save_data(data)
+home_locks = HomeLocks()
+HOME_SAVE_ATTEMPTS = 3  # Times a home write is redone after another worker saved the home first
+
+def locks_home(view):
+    """
+    Runs a view that loads, changes and saves the current user's home under
+    that home's lock. When another worker saved the home in between (see
+    save_user_data), the view runs again on the fresh home.
+    """
+    @functools.wraps(view)
+    def locked_view(*args, **kwargs):
+        with home_locks.holding([str(current_user.id)]):
+            for attempt in range(HOME_SAVE_ATTEMPTS):
+                response = view(*args, **kwargs)
+                if not g.pop('home_conflict', False):
+                    return response
+        return jsonify({"status": "error", "message": "Your home was changed elsewhere at the same time. Please try again."}), 409
+    return locked_view
+
+def save_user_data(user_data, changes=None):
+    """
+    Saves the current user's home under a new revision and publishes the
+    changes to their event stream. changes defaults to the whole room list.
+    Raises HomeConflict (and flags it for locks_home) when the home was saved
+    elsewhere since it was loaded.
+    """
+    if changes is None:
+        changes = [{"type": "rooms", "rooms": user_data['rooms']}]
+    loaded_revision = user_data.get('revision', 0)
+    revision = stamp_revision(user_data, changes)
+    try:
+        storage.save_home(current_user.id, user_data, expected=loaded_revision)
+    except HomeConflict:
+        # Views turn exceptions into error responses, so locks_home learns of the conflict here
+        g.home_conflict = True
+        raise
+    change_feed.publish(current_user.id, revision, changes)
+
+def stamp_revision(user_data, changes):
+    """Moves a home to its next revision and stamps it on whatever changed."""
+    revision = user_data.get('revision', 0) + 1
+    user_data['revision'] = revision
+    # Stamp what changed so /api/get-rooms-and-appliances?since= can find it later
+    for change in changes:
+        if change['type'] == 'appliance':
+            change['appliance']['revision'] = revision
+        elif change['type'] == 'room':
+            change['room']['revision'] = revision
+        elif change['type'] == 'rooms':
+            user_data['rooms_revision'] = revision
+    return revision
+
+def apply_device_status(batch):
+    """
+    Applies relay states reported by devices, {user_id: {(room_id, appliance_id): state}},
+    with one write for all affected homes. Returns the number of appliances corrected.
+    """
+    corrected = 0
+    with home_locks.holding(batch):
+        for attempt in range(HOME_SAVE_ATTEMPTS):
+            updated_homes = {}
+            home_changes = {}
+            loaded_revisions = {}
+            for user_id, states in batch.items():
+                user_data = storage.get_home(user_id)
+                if not user_data:
+                    continue
+                changes = []
+                for room in user_data.get('rooms', []):
+                    for appliance in room['appliances']:
+                        state = states.get((str(room['id']), str(appliance['id'])))
+                        if state is not None and appliance['state'] != state:
+                            appliance['state'] = state
+                            changes.append({"type": "appliance", "room_id": room['id'], "appliance": appliance})
+                if changes:
+                    loaded_revisions[user_id] = user_data.get('revision', 0)
+                    stamp_revision(user_data, changes)
+                    updated_homes[user_id] = user_data
+                    home_changes[user_id] = changes
+            if not updated_homes:
+                break
+            conflicts = save_homes_checked(updated_homes, loaded_revisions)
+            for user_id, user_data in updated_homes.items():
+                if user_id not in conflicts:
+                    change_feed.publish(user_id, user_data['revision'], home_changes[user_id])
+                    corrected += len(home_changes[user_id])
+            # Homes another worker saved meanwhile are reloaded and corrected again
+            batch = {user_id: batch[user_id] for user_id in conflicts}
+            if not batch:
+                break
+        else:
+            print(f"Device status for {len(batch)} homes dropped after repeated write conflicts.")
+    return corrected
+
+def save_homes_checked(homes, loaded_revisions):
+    """Saves homes that still have their loaded revision; returns the ids of those that didn't."""
+    try:
+        storage.save_homes(homes, loaded_revisions)
+    except HomeConflict as e:
+        return set(e.user_ids)
+    return set()
+
+def fire_timers(due):
+    """
+    Switches off appliances whose timers have expired, with one write for all
+    affected homes, and sends the off commands over MQTT and the ESP queue.
+    """
+    now = time.time()
+    due_by_user = {}
+    for (user_id, room_id, appliance_id), deadline in due:
+        due_by_user.setdefault(user_id, set()).add((room_id, appliance_id))
+
+    saved_homes = {}
+    home_changes = {}
+    commands = []
+    with home_locks.holding(due_by_user):
+        for attempt in range(HOME_SAVE_ATTEMPTS):
+            updated_homes = {}
+            loaded_revisions = {}
+            home_commands = {}
+            for user_id, keys in due_by_user.items():
+                user_data = storage.get_home(user_id)
+                if not user_data:
+                    continue
+                changes = []
+                for room in user_data.get('rooms', []):
+                    for appliance in room['appliances']:
+                        if (room['id'], appliance['id']) not in keys:
+                            continue
+                        # The stored timer is authoritative; it may have been moved or cleared since
+                        if not appliance.get('timer') or float(appliance['timer']) > now:
+                            continue
+                        appliance['timer'] = None
+                        if appliance['state']:
+                            appliance['state'] = False
+                            home_commands.setdefault(user_id, []).append((user_id, room['id'], appliance))
+                        changes.append({"type": "appliance", "room_id": room['id'], "appliance": appliance})
+                if changes:
+                    loaded_revisions[user_id] = user_data.get('revision', 0)
+                    stamp_revision(user_data, changes)
+                    updated_homes[user_id] = user_data
+                    home_changes[user_id] = changes
+            conflicts = save_homes_checked(updated_homes, loaded_revisions) if updated_homes else set()
+            for user_id in updated_homes.keys() - conflicts:
+                saved_homes[user_id] = updated_homes[user_id]
+                commands.extend(home_commands.get(user_id, []))
+            # Homes another worker saved meanwhile are reloaded and checked again
+            due_by_user = {user_id: due_by_user[user_id] for user_id in conflicts}
+            if not due_by_user:
+                break
+    for user_id, user_data in saved_homes.items():
+        change_feed.publish(user_id, user_data['revision'], home_changes[user_id])
+    for user_id, room_id, appliance in commands:
+        command_queue.enqueue(user_id, {
+            "room_id": room_id,
+            "appliance_id": appliance['id'],
+            "state": False,
+            "relay_number": appliance['relay_number'],
+            "timestamp": int(now)
+        })
+        if mqtt_client:
+            mqtt_client.publish(command_topic(user_id), f"{user_id}:{room_id}:{appliance['id']}:{appliance['relay_number']}:off")
+    if saved_homes:
+        print(f"Timers expired: switched off {len(commands)} appliances in {len(saved_homes)} homes.")
+    if due_by_user:
+        # The scheduler fires these timers again after a delay
+        raise HomeConflict(list(due_by_user))
+
+timer_scheduler = TimerScheduler(fire_timers)
+timer_journal = TimerJournal(TIMERS_DB)
+
+def start_timer_scheduler():
+    """
+    Offers this process to run the timer scheduler. Called once per process
+    from the entry points (__main__ and gunicorn.conf.py); whichever process
+    holds the leader lock loads every stored timer, fires them, and picks up
+    the timers other workers set through the journal.
+    """
+    def lead():
+        after = timer_journal.last_id()
+        for user_id, user_data in storage.iter_homes():
+            for room in user_data.get('rooms', []):
+                for appliance in room['appliances']:
+                    if appliance.get('timer'):
+                        timer_scheduler.schedule((str(user_id), room['id'], appliance['id']), float(appliance['timer']))
+        print(f"Loaded {len(timer_scheduler)} pending appliance timers.")
+        timer_scheduler.start()
+        timer_journal.follow(timer_scheduler, after)
+    run_as_leader(TIMERS_LEADER_LOCK, lead)
+
+def changes_since(user_data, since):
+    """Returns the changes to the user's rooms after revision since, in the event stream's format."""
+    revision = user_data.get('revision', 0)
+    if since >= revision:
+        return []
+    if user_data.get('rooms_revision', 0) > since or since > revision:
+        return [{"type": "rooms", "rooms": user_data['rooms']}]
+    changes = []
+    for room in user_data['rooms']:
+        if room.get('revision', 0) > since:
+            changes.append({"type": "room", "room": room})
+            continue
+        for appliance in room['appliances']:
+            if appliance.get('revision', 0) > since:
+                changes.append({"type": "appliance", "room_id": room['id'], "appliance": appliance})
+    return changes
+
+@app.cli.command('migrate-storage')
+def migrate_storage_command():
+    """Imports data.json and users.json into the SQLite database."""
+    user_count, home_count = migrate_json_to_sqlite(DATA_FILE, USERS_FILE, DATABASE_FILE)
+    print(f"Imported {user_count} users and {home_count} homes into {DATABASE_FILE}.")
 
 # --- Analytics Data ---
 def generate_analytics_data():
-    if os.path.exists(ANALYTICS_FILE):
-        return
-    start_date = datetime.now() - timedelta(days=365)
-    with open(ANALYTICS_FILE, 'w', newline='') as csvfile:
-        fieldnames = ['date', 'hour', 'consumption']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for i in range(365 * 24):
-            current_datetime = start_date + timedelta(hours=i)
-            consumption = 50 + (i % 24) * 2 + (i % 7) * 5 + os.urandom(1)[0] % 10
-            writer.writerow({
-                'date': current_datetime.strftime('%Y-%m-%d'),
-                'hour': current_datetime.hour,
-                'consumption': round(consumption, 2)
-            })
-def generate_analytics_data():
-    """Your existing function with minor improvements"""
-    if os.path.exists(ANALYTICS_FILE):
+    """Creates the shared one-year sample series when neither its CSV nor its binary store exists"""
+    if os.path.exists(ANALYTICS_FILE) or os.path.exists(ANALYTICS_STORE):
         return
-    start_date = datetime.now() - timedelta(days=365)
-    with open(ANALYTICS_FILE, 'w', newline='') as csvfile:
-        fieldnames = ['date', 'hour', 'consumption']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for i in range(365 * 24):
-            current_datetime = start_date + timedelta(hours=i)
-            # More realistic consumption pattern
-            base_consumption = 50
-            hour_factor = (i % 24) * 2  # Higher usage during day
-            day_factor = (i % 7) * 5    # Higher usage on weekends
-            seasonal_factor = 10 * (1 + 0.3 * (i // (24*30)) % 12 / 12)  # Seasonal variation
-            random_factor = os.urandom(1)[0] % 20 - 10  # Random variation
-            
-            consumption = base_consumption + hour_factor + day_factor + seasonal_factor + random_factor
-            consumption = max(20, consumption)  # Minimum consumption
-            
-            writer.writerow({
-                'date': current_datetime.strftime('%Y-%m-%d'),
-                'hour': current_datetime.hour,
-                'consumption': round(consumption, 2)
-            })
+    generate_home_series(seed=None, index=0, years=1).save(ANALYTICS_STORE)
+
+reading_store = SegmentStore(READINGS_DIR, READINGS_CACHE_HOMES)
 
+def device_token(user_id):
+    """The token a home's devices present to write on its behalf."""
+    return hmac.new(DEVICE_TOKEN_SECRET.encode(), f"device:{user_id}".encode(), hashlib.sha256).hexdigest()
+
+def device_home_id():
+    """The home named by ?user_id= when the request carries its device token, else None."""
+    user_id = request.args.get('user_id')
+    token = request.headers.get('X-Device-Token', '')
+    if not DEVICE_TOKEN_SECRET or not user_id or not token:
+        return None
+    return user_id if hmac.compare_digest(token, device_token(user_id)) else None
+
+@app.cli.command('generate-readings')
+@click.option('--homes', default=100, help='Number of homes to generate.')
+@click.option('--years', default=1.0, help='Years of hourly readings per home.')
+@click.option('--seed', default=0, help='Seed; the same seed reproduces the same dataset.')
+@click.option('--first-id', default=1, help='Home id of the first generated home.')
+@click.option('--workers', default=0, help='Worker processes (defaults to one per CPU).')
+def generate_readings_command(homes, years, seed, first_id, workers):
+    """Writes synthetic hourly readings for many homes into the readings store."""
+    started = time.time()
+    def progress(done, total):
+        print(f"Generated {done}/{total} homes", end='\r', flush=True)
+    readings = generate_homes(READINGS_DIR, homes, years, seed, first_id, workers or None, progress)
+    print(f"\nWrote {readings} readings for {homes} homes to {READINGS_DIR} in {time.time() - started:.1f}s.")
+
+@timed('analytics')
 def load_analytics_data():
-    """Your existing function"""
-    data = []
-    with open(ANALYTICS_FILE, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if 'hour' in row and 'consumption' in row and row['hour'] is not None and row['consumption'] is not None:
-                try:
-                    data.append({
-                        'date': row['date'],
-                        'hour': int(row['hour']),
-                        'consumption': float(row['consumption'])
-                    })
-                except (ValueError, TypeError):
-                    continue
-    return data
+    """Returns the caller's own readings, or the shared sample series if their meter hasn't reported yet"""
+    if current_user.is_authenticated:
+        series = reading_store.load(current_user.id)
+        if len(series):
+            return series
+    return load_series(ANALYTICS_FILE, ANALYTICS_STORE)
 
 def process_hourly_data(data):
     """Process data for last 24 hours view"""
     now = datetime.now()
     last_24h = now - timedelta(hours=24)
     
-    hourly_data = defaultdict(float)
-    
-    for record in data:
-        record_datetime = datetime.strptime(f"{record['date']} {record['hour']:02d}:00:00", "%Y-%m-%d %H:%M:%S")
-        if record_datetime >= last_24h:
-            hour_label = record_datetime.strftime("%H:00")
-            hourly_data[hour_label] = record['consumption']
+    # Readings are on whole hours, so the window starts at the next full hour
+    first = np.searchsorted(data.hours, int(np.ceil(to_epoch_seconds(last_24h) / 3600)))
+    hourly_data = {}
+    for hour, consumption in zip(data.hour_of_day[first:].tolist(), data.consumption[first:].tolist()):
+        hourly_data[f"{hour:02d}:00"] = consumption
     
     # Fill missing hours with 0
     labels = []
@@ -334,165 +733,81 @@ def process_weekly_data(data):
     now = datetime.now()
     last_7_days = now - timedelta(days=7)
     
-    daily_data = defaultdict(float)
-    daily_counts = defaultdict(int)
-    
-    for record in data:
-        record_date = datetime.strptime(record['date'], "%Y-%m-%d")
-        if record_date >= last_7_days:
-            day_label = record_date.strftime("%Y-%m-%d")
-            daily_data[day_label] += record['consumption']
-            daily_counts[day_label] += 1
-    
-    # Average consumption per day
-    for day in daily_data:
-        if daily_counts[day] > 0:
-            daily_data[day] = daily_data[day] / daily_counts[day]
+    # Average consumption per day since the first midnight inside the window
+    first_day = int(np.ceil(to_epoch_seconds(last_7_days) / 86400))
+    first = np.searchsorted(data.days, first_day)
+    offsets = data.days[first:] - first_day
+    daily_sums = np.bincount(offsets, weights=data.consumption64[first:])
+    daily_counts = np.bincount(offsets)
     
     labels = []
     values = []
     for i in range(7):
-        date = (now - timedelta(days=6-i)).strftime("%Y-%m-%d")
-        day_name = (now - timedelta(days=6-i)).strftime("%a")
-        labels.append(day_name)
-        values.append(daily_data.get(date, 0))
+        date = now - timedelta(days=6-i)
+        offset = (date - EPOCH).days - first_day
+        labels.append(date.strftime("%a"))
+        if 0 <= offset < len(daily_counts) and daily_counts[offset] > 0:
+            values.append(float(daily_sums[offset] / daily_counts[offset]))
+        else:
+            values.append(0)
     
     return {'labels': labels, 'values': values}
 
 def process_yearly_data(data):
     """Process data for last 12 months view"""
     now = datetime.now()
-    monthly_data = defaultdict(float)
-    monthly_counts = defaultdict(int)
-    
-    for record in data:
-        record_date = datetime.strptime(record['date'], "%Y-%m-%d")
-        if (now - record_date).days <= 365:
-            month_label = record_date.strftime("%Y-%m")
-            monthly_data[month_label] += record['consumption']
-            monthly_counts[month_label] += 1
-    
-    # Average consumption per month
-    for month in monthly_data:
-        if monthly_counts[month] > 0:
-            monthly_data[month] = monthly_data[month] / monthly_counts[month]
+    monthly = data.rollups.monthly
     
+    # Every labelled month lies inside the last 365 days, so whole-month buckets match
     labels = []
     values = []
     for i in range(12):
         date = now.replace(day=1) - timedelta(days=30*i)
-        month_label = date.strftime("%Y-%m")
         month_name = date.strftime("%b %Y")
         labels.insert(0, month_name)
-        values.insert(0, monthly_data.get(month_label, 0))
+        values.insert(0, float(monthly.mean((date.year - 1970) * 12 + date.month - 1)))
     
     return {'labels': labels, 'values': values}
 
 def calculate_statistics(data):
-    """Calculate comprehensive statistics"""
-    now = datetime.now()
-    this_month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    last_month_start = (this_month_start - timedelta(days=1)).replace(day=1)
-    
-    this_month_data = []
-    last_month_data = []
-    all_consumption = []
-    peak_usage = 0
-    peak_time = ""
-    
-    for record in data:
-        record_date = datetime.strptime(record['date'], "%Y-%m-%d")
-        consumption = record['consumption']
-        all_consumption.append(consumption)
-        
-        # Track peak usage
-        if consumption > peak_usage:
-            peak_usage = consumption
-            peak_time = f"{record['date']} {record['hour']:02d}:00"
-        
-        # Monthly comparison
-        if record_date >= this_month_start:
-            this_month_data.append(consumption)
-        elif record_date >= last_month_start and record_date < this_month_start:
-            last_month_data.append(consumption)
-    
-    # Calculate statistics
-    total_consumption = sum(this_month_data) if this_month_data else 0
-    average_daily = total_consumption / max(1, len(set(record['date'] for record in data 
-                    if datetime.strptime(record['date'], "%Y-%m-%d") >= this_month_start)))
-    
-    # Calculate monthly change
-    this_month_avg = statistics.mean(this_month_data) if this_month_data else 0
-    last_month_avg = statistics.mean(last_month_data) if last_month_data else 0
-    daily_change = ((this_month_avg - last_month_avg) / max(last_month_avg, 1)) * 100 if last_month_avg > 0 else 0
-    
-    estimated_cost = total_consumption * ELECTRICITY_RATE
-    
+    """Calculate comprehensive statistics from a TimeSeries, any iterable of readings or a UsageStats"""
+    usage = summarize_usage(data)
+    total_consumption = usage.this_month_total
     return {
         'total_consumption': total_consumption,
-        'average_daily': average_daily,
-        'peak_usage': peak_usage,
-        'peak_time': peak_time,
-        'daily_change': daily_change,
-        'estimated_cost': estimated_cost
+        'average_daily': usage.this_month_daily_average,
+        'peak_usage': usage.peak_usage,
+        'peak_time': usage.peak_time,
+        'daily_change': usage.month_change_percent,
+        'estimated_cost': total_consumption * ELECTRICITY_RATE
     }
 
 def analyze_peak_usage(data):
     """Analyze peak usage by hour of day"""
-    hourly_peaks = defaultdict(list)
-    
-    for record in data:
-        hour = record['hour']
-        consumption = record['consumption']
-        hourly_peaks[hour].append(consumption)
-    
     labels = [f"{i:02d}:00" for i in range(24)]
-    values = []
-    
-    for i in range(24):
-        if i in hourly_peaks and hourly_peaks[i]:
-            values.append(max(hourly_peaks[i]))
-        else:
-            values.append(0)
+    values = data.rollups.hourly.max.tolist()
     
     return {'labels': labels, 'values': values}
 
 def calculate_usage_distribution(data):
     """Calculate usage distribution for pie chart"""
-    all_consumption = [record['consumption'] for record in data]
-    if not all_consumption:
+    usage = summarize_usage(data)
+    if not usage.count:
         return [25, 25, 25, 25]  # Default equal distribution
     
-    # Define usage categories based on percentiles
-    sorted_consumption = sorted(all_consumption)
-    total_records = len(sorted_consumption)
-    
-    q1 = sorted_consumption[total_records // 4]
-    q2 = sorted_consumption[total_records // 2]
-    q3 = sorted_consumption[3 * total_records // 4]
-    
-    low_count = sum(1 for c in all_consumption if c <= q1)
-    medium_count = sum(1 for c in all_consumption if q1 < c <= q2)
-    high_count = sum(1 for c in all_consumption if q2 < c <= q3)
-    peak_count = sum(1 for c in all_consumption if c > q3)
-    
-    return [low_count, medium_count, high_count, peak_count]
+    # Readings up to each quartile of the whole history
+    return usage.quartile_counts()
 
 def calculate_weekly_pattern(data):
     """Calculate average usage by day of week"""
-    daily_totals = defaultdict(list)
-    
-    for record in data:
-        record_date = datetime.strptime(record['date'], "%Y-%m-%d")
-        day_of_week = record_date.weekday()  # 0 = Monday
-        daily_totals[day_of_week].append(record['consumption'])
+    daily_totals = data.rollups.weekday_matrix('sum').sum(axis=1)
+    daily_counts = data.rollups.weekday_matrix('count').sum(axis=1)
     
     # Calculate averages for each day
     weekly_averages = []
     for i in range(7):  # Monday to Sunday
-        if i in daily_totals and daily_totals[i]:
-            avg = statistics.mean(daily_totals[i])
-            weekly_averages.append(round(avg, 2))
+        if daily_counts[i]:
+            weekly_averages.append(round(float(daily_totals[i] / daily_counts[i]), 2))
         else:
             weekly_averages.append(0)
     
@@ -518,8 +833,7 @@ def generate_efficiency_insights(data, stats):
     insights = []
     
     # Calculate efficiency score
-    all_consumption = [record['consumption'] for record in data]
-    avg_consumption = statistics.mean(all_consumption) if all_consumption else 0
+    avg_consumption = summarize_usage(data).mean
     optimal_consumption = 60  # Assumed optimal consumption
     efficiency_score = max(0, min(100, 100 - (avg_consumption - optimal_consumption) / optimal_consumption * 100))
     
@@ -568,12 +882,19 @@ def signin():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        users = load_users()
-        for user in users:
-            if user['username'] == username and check_password_hash(user['password_hash'], password):
-                user_obj = User(user['id'], user['username'], user['password_hash'])
-                login_user(user_obj)
-                return redirect(url_for('home'))
+        # Admission control: throttle by client address and by the account being tried
+        if not login_ip_limiter.allow(request.remote_addr or 'unknown') or not login_account_limiter.allow(username.lower()):
+            return render_template('signin.html', error='Too many sign-in attempts. Please wait a minute and try again.'), 429
+        try:
+            for user in storage.find_users('username', username):
+                if user['password_hash'] and password_hasher.verify(user['password_hash'], password):
+                    if password_hasher.needs_rehash(user['password_hash']):
+                        upgrade_password_hash(user['id'], user['password_hash'], password)
+                    user_obj = User(user['id'], user['username'], user['password_hash'])
+                    login_user(user_obj)
+                    return redirect(url_for('home'))
+        except AuthBusy:
+            return render_template('signin.html', error='The server is busy. Please try again in a moment.'), 503
         return render_template('signin.html', error='Invalid username or password.')
     return render_template('signin.html')
 
@@ -582,17 +903,15 @@ def signup():
     if current_user.is_authenticated:
         return redirect(url_for('home'))
     
-    users = load_users()
-    if not users:
+    if storage.user_count() == 0:
         # Create a new default user if the users file is empty
         new_user_id = "1"
         default_user = {
             'id': new_user_id,
             'username': 'hi',
-            'password_hash': generate_password_hash('hello')
+            'password_hash': password_hasher.hash('hello')
         }
-        users.append(default_user)
-        save_users(users)
+        save_user(default_user)
         
         # Create a new entry for the user in data.json
         # data = load_data()
@@ -615,10 +934,8 @@ def signup():
         # }
         # save_data(data)
 
-        data = load_data()
         # Standard signup form doesn't have email, so we pass an empty string
-        data[new_user_id] = create_default_user_data(name=username, email="")
-        save_data(data)
+        storage.save_home(new_user_id, create_default_user_data(name=default_user['username'], email=""))
         
         user_obj = User(default_user['id'], default_user['username'], default_user['password_hash'])
         login_user(user_obj)
@@ -627,21 +944,24 @@ def signup():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        if any(u['username'] == username for u in users):
+        if storage.find_user('username', username):
             return render_template('signup.html', error='Username already exists.')
         
-        new_user_id = str(len(users) + 1)
+        try:
+            password_hash = password_hasher.hash(password)
+        except AuthBusy:
+            return render_template('signup.html', error='The server is busy. Please try again in a moment.'), 503
+        
+        new_user_id = storage.next_user_id()
         new_user = {
             'id': new_user_id,
             'username': username,
-            'password_hash': generate_password_hash(password)
+            'password_hash': password_hash
         }
-        users.append(new_user)
-        save_users(users)
+        save_user(new_user)
 
         # Create a new entry for the user in data.json
-        data = load_data()
-        data[new_user_id] = {
+        storage.save_home(new_user_id, {
             "user_settings": {
                 "name": username,
                 "email": "", "mobile": "", "channel": "email", "theme": "light", "ai_control_interval": 5
@@ -657,8 +977,7 @@ def signup():
                     {"id": "4", "name": "A/C", "state": False, "locked": False, "timer": None, "relay_number": 4}
                 ]
             }]
-        }
-        save_data(data)
+        })
 
         # Log the new user in and redirect to home
         user_obj = User(new_user['id'], new_user['username'], new_user['password_hash'])
@@ -703,20 +1022,107 @@ def contact():
 # --- Backend API Endpoints ---
 @app.route('/api/esp/check-in', methods=['GET'])
 def check_in():
-    data = load_data()
-    user_id = request.args.get('user_id')
-    user_data = data.get(user_id, {})
-    last_command = user_data.get('last_command', {})
-    
-    if last_command and last_command.get('timestamp', 0) > user_data.get('last_command_sent_time', 0):
-        user_data['last_command_sent_time'] = last_command['timestamp']
-        data[user_id] = user_data
-        save_data(data)
-        return jsonify(last_command), 200
-    
-    return jsonify({}), 200
+    """
+    Delivers queued commands to the home's ESP. Devices that pass ack=<seq>
+    (0 on first boot) acknowledge everything up to seq and long-poll for up
+    to wait=<seconds>, then receive every pending command in one batch.
+    Older firmware without ack gets the oldest pending command, as before.
+    The device authenticates with its home's X-Device-Token.
+    """
+    user_id = device_home_id()
+    if not user_id:
+        return jsonify({"status": "error", "message": "A valid device token is required."}), 401
+
+    ack = request.args.get('ack', type=int)
+    if ack is None:
+        commands = command_queue.pending(user_id)
+        if not commands:
+            return jsonify({}), 200
+        command = commands[0]
+        command_queue.ack(user_id, command.pop('seq'))
+        return jsonify(command), 200
+
+    command_queue.ack(user_id, ack)
+    wait = min(max(request.args.get('wait', 0, type=float), 0), CHECK_IN_MAX_WAIT)
+    commands = command_queue.wait(user_id, after=ack, timeout=wait)
+    return jsonify({"commands": commands}), 200
+
+@app.route('/api/mqtt-metrics', methods=['GET'])
+@login_required
+def mqtt_metrics():
+    """Queue depth, spill backlog and publish latency of the MQTT publisher, plus status ingestion counters."""
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Admins only."}), 403
+    if not mqtt_client:
+        return jsonify({"status": "disabled"}), 200
+    return jsonify(dict(mqtt_client.metrics(), status=status_ingestor.metrics())), 200
+
+def ingest_readings(home_id, items, result):
+    """Validates a chunk of readings and appends the valid ones to the home's segments."""
+    hours = []
+    consumption = []
+    for item in items:
+        try:
+            hour, value = parse_reading(item)
+        except (ValueError, TypeError, OverflowError) as e:
+            if len(result['errors']) < MAX_READING_ERRORS:
+                result['errors'].append({"index": result['received'], "message": str(e)})
+            result['rejected'] += 1
+        else:
+            hours.append(hour)
+            consumption.append(value)
+        result['received'] += 1
+    if hours:
+        result['accepted'] += reading_store.append(home_id, np.array(hours, dtype=np.int32),
+                                                   np.array(consumption, dtype=np.float32))
+
+@app.route('/api/readings', methods=['POST'])
+def post_readings():
+    """
+    Accepts a batch of meter readings for a home, either as a JSON array or
+    streamed as NDJSON (one reading per line). Signed-in users post to their
+    own home; devices pass ?user_id= with that home's X-Device-Token.
+    """
+    home_id = current_user.id if current_user.is_authenticated else device_home_id()
+    if not home_id:
+        return jsonify({"status": "error", "message": "Unauthorized."}), 401
+    if storage.get_user(home_id) is None:
+        return jsonify({"status": "error", "message": "Unknown user."}), 404
+
+    result = {"received": 0, "accepted": 0, "rejected": 0, "errors": []}
+    try:
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            chunk = []
+            for line in request.stream:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    chunk.append(json.loads(line))
+                except ValueError:
+                    chunk.append(None)
+                if len(chunk) >= READINGS_CHUNK_SIZE:
+                    ingest_readings(home_id, chunk, result)
+                    chunk = []
+            ingest_readings(home_id, chunk, result)
+        else:
+            payload = request.get_json(silent=True)
+            if isinstance(payload, dict):
+                payload = payload.get('readings')
+            if not isinstance(payload, list):
+                return jsonify({"status": "error", "message": "Expected a JSON array of readings."}), 400
+            for start in range(0, len(payload), READINGS_CHUNK_SIZE):
+                ingest_readings(home_id, payload[start:start + READINGS_CHUNK_SIZE], result)
+    except Exception as e:
+        print(f"Error ingesting readings for {home_id}: {e}")
+        return jsonify({"status": "error", "message": "Failed to store readings.", **result}), 500
+
+    status = 200 if result['accepted'] or not result['received'] else 400
+    return jsonify({"status": "success" if status == 200 else "error", **result}), status
+
 @app.route('/api/add-appliance', methods=['POST'])
 @login_required
+@locks_home
 def add_appliance():
     try:
         data_from_request = request.json
@@ -747,14 +1153,83 @@ def add_appliance():
 @app.route('/api/get-rooms-and-appliances', methods=['GET'])
 @login_required
 def get_rooms_and_appliances():
+    """
+    Returns the user's rooms, or with ?since=<revision> only the changes
+    after that revision. Responses carry the home revision as their ETag.
+    """
     try:
-        user_data = get_user_data()
-        return jsonify(user_data['rooms']), 200
+        # Most polls see no change: answer them before loading the rooms
+        etag = f"rev-{storage.get_home_revision(current_user.id)}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            user_data = get_user_data()
+            etag = f"rev-{user_data.get('revision', 0)}"
+            since = request.args.get('since', type=int)
+            if since is None:
+                response = jsonify(user_data['rooms'])
+            else:
+                response = jsonify({"revision": user_data.get('revision', 0),
+                                    "changes": changes_since(user_data, since)})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/api/events', methods=['GET'])
+@login_required
+def stream_events():
+    """
+    Server-Sent Events stream of changes to the user's rooms and appliances.
+    Event ids are home revisions, so reconnecting clients resume from
+    Last-Event-ID; the first message is a full snapshot when they can't.
+    """
+    user_id = current_user.id
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    except (TypeError, ValueError):
+        last_event_id = None
+
+    def snapshot():
+        user_data = storage.get_home(user_id) or {}
+        revision = user_data.get('revision', 0)
+        message = format_sse({"changes": [{"type": "rooms", "rooms": user_data.get('rooms', [])}]}, revision, SSE_RETRY_MS)
+        return revision, message
+
+    def generate():
+        backlog = change_feed.since(user_id, last_event_id) if last_event_id is not None else None
+        stored_revision = (storage.get_home(user_id) or {}).get('revision', 0)
+        if backlog is None or stored_revision > max([last_event_id] + [rev for rev, _ in backlog]):
+            revision, message = snapshot()
+            yield message
+        else:
+            revision = last_event_id
+            for revision, changes in backlog:
+                yield format_sse({"changes": changes}, revision, SSE_RETRY_MS)
+
+        deadline = time.time() + SSE_MAX_DURATION
+        while time.time() < deadline:
+            changes = change_feed.wait(user_id, revision, SSE_KEEPALIVE)
+            if changes is None:
+                revision, message = snapshot()
+                yield message
+            elif changes:
+                for revision, batch in changes:
+                    yield format_sse({"changes": batch}, revision)
+            elif (storage.get_home(user_id) or {}).get('revision', 0) > revision:
+                # Changed by another worker, whose events we never see
+                revision, message = snapshot()
+                yield message
+            else:
+                yield ": keepalive\n\n"
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/update-room-settings', methods=['POST'])
 @login_required
+@locks_home
 def update_room_settings():
     try:
         data_from_request = request.json
@@ -773,7 +1248,7 @@ def update_room_settings():
             room['ai_control'] = ai_control
             # Additional logic to handle AI control toggle could go here
 
-        save_user_data(user_data)
+        save_user_data(user_data, [{"type": "room", "room": room}])
         
         return jsonify({"status": "success", "message": "Room settings updated."}), 200
     except Exception as e:
@@ -781,6 +1256,7 @@ def update_room_settings():
         
 @app.route('/api/delete-room', methods=['POST'])
 @login_required
+@locks_home
 def delete_room():
     try:
         data_from_request = request.json
@@ -794,6 +1270,7 @@ def delete_room():
 
 @app.route('/api/add-room', methods=['POST'])
 @login_required
+@locks_home
 def add_room():
     try:
         data_from_request = request.json
@@ -808,6 +1285,7 @@ def add_room():
 
 @app.route('/api/delete-appliance', methods=['POST'])
 @login_required
+@locks_home
 def delete_appliance():
     try:
         data_from_request = request.json
@@ -826,6 +1304,7 @@ def delete_appliance():
         return jsonify({"status": "error", "message": str(e)}), 500
 @app.route('/api/set-appliance-state', methods=['POST'])
 @login_required
+@locks_home
 def set_appliance_state():
     try:
         data_from_request = request.json
@@ -847,7 +1326,7 @@ def set_appliance_state():
 
         appliance['state'] = state
         
-        user_data['last_command'] = {
+        command = {
             "room_id": room_id,
             "appliance_id": appliance_id,
             "state": state,
@@ -855,10 +1334,11 @@ def set_appliance_state():
             "timestamp": int(time.time())
         }
         
-        save_user_data(user_data)
+        save_user_data(user_data, [{"type": "appliance", "room_id": room_id, "appliance": appliance}])
+        command_queue.enqueue(current_user.id, command)
         
         if mqtt_client:
-            mqtt_client.publish(MQTT_TOPIC_COMMAND, f"{current_user.id}:{room_id}:{appliance_id}:{appliance['relay_number']}:{int(state)}")
+            mqtt_client.publish(command_topic(current_user.id), f"{current_user.id}:{room_id}:{appliance_id}:{appliance['relay_number']}:{int(state)}")
         
         action = "turned ON" if state else "turned OFF"
         message = f"Appliance '{appliance['name']}' in room '{room['name']}' has been {action}."
@@ -869,6 +1349,7 @@ def set_appliance_state():
 
 @app.route('/api/set-appliance-name', methods=['POST'])
 @login_required
+@locks_home
 def set_appliance_name():
     try:
         data_from_request = request.json
@@ -886,7 +1367,7 @@ def set_appliance_name():
             return jsonify({"status": "error", "message": "Appliance not found."}), 404
         
         appliance['name'] = name
-        save_user_data(user_data)
+        save_user_data(user_data, [{"type": "appliance", "room_id": room_id, "appliance": appliance}])
         
         return jsonify({"status": "success", "message": "Name updated."}), 200
     except Exception as e:
@@ -894,6 +1375,7 @@ def set_appliance_name():
 
 @app.route('/api/set-lock', methods=['POST'])
 @login_required
+@locks_home
 def set_lock():
     try:
         data_from_request = request.json
@@ -911,10 +1393,10 @@ def set_lock():
             return jsonify({"status": "error", "message": "Appliance not found."}), 404
         
         appliance['locked'] = locked
-        save_user_data(user_data)
+        save_user_data(user_data, [{"type": "appliance", "room_id": room_id, "appliance": appliance}])
 
         if mqtt_client:
-            mqtt_client.publish(MQTT_TOPIC_COMMAND, f"{current_user.id}:{room_id}:{appliance_id}:{appliance['relay_number']}:lock:{int(locked)}")
+            mqtt_client.publish(command_topic(current_user.id), f"{current_user.id}:{room_id}:{appliance_id}:{appliance['relay_number']}:lock:{int(locked)}")
 
         return jsonify({"status": "success", "message": "Lock state updated."}), 200
     except Exception as e:
@@ -922,6 +1404,7 @@ def set_lock():
 
 @app.route('/api/update-appliance-settings', methods=['POST'])
 @login_required
+@locks_home
 def update_appliance_settings():
     try:
         data_from_request = request.json
@@ -959,6 +1442,7 @@ def update_appliance_settings():
 
 @app.route('/api/set-timer', methods=['POST'])
 @login_required
+@locks_home
 def set_timer():
     try:
         data_from_request = request.json
@@ -978,7 +1462,7 @@ def set_timer():
         if timer_timestamp:
             appliance['state'] = True
             appliance['timer'] = timer_timestamp
-            user_data['last_command'] = {
+            command = {
                 "room_id": room_id,
                 "appliance_id": appliance_id,
                 "state": True,
@@ -986,11 +1470,12 @@ def set_timer():
                 "timestamp": int(time.time())
             }
             if mqtt_client:
-                mqtt_client.publish(MQTT_TOPIC_COMMAND, f"{current_user.id}:{room_id}:{appliance_id}:{appliance['relay_number']}:on")
+                mqtt_client.publish(command_topic(current_user.id), f"{current_user.id}:{room_id}:{appliance_id}:{appliance['relay_number']}:on")
+            timer_journal.record((str(current_user.id), room_id, appliance_id), float(timer_timestamp))
         else: # Timer is being cancelled or turned off
             appliance['state'] = False
             appliance['timer'] = None
-            user_data['last_command'] = {
+            command = {
                 "room_id": room_id,
                 "appliance_id": appliance_id,
                 "state": False,
@@ -998,10 +1483,12 @@ def set_timer():
                 "timestamp": int(time.time())
             }
             if mqtt_client:
-                 mqtt_client.publish(MQTT_TOPIC_COMMAND, f"{current_user.id}:{room_id}:{appliance_id}:{appliance['relay_number']}:off")
+                 mqtt_client.publish(command_topic(current_user.id), f"{current_user.id}:{room_id}:{appliance_id}:{appliance['relay_number']}:off")
+            timer_journal.record((str(current_user.id), room_id, appliance_id))
 
 
-        save_user_data(user_data)
+        save_user_data(user_data, [{"type": "appliance", "room_id": room_id, "appliance": appliance}])
+        command_queue.enqueue(current_user.id, command)
         
         return jsonify({"status": "success", "message": "Timer set."}), 200
     except Exception as e:
@@ -1009,6 +1496,7 @@ def set_timer():
         
 @app.route('/api/save-room-order', methods=['POST'])
 @login_required
+@locks_home
 def save_room_order():
     try:
         data_from_request = request.json
@@ -1023,6 +1511,7 @@ def save_room_order():
         
 @app.route('/api/save-appliance-order', methods=['POST'])
 @login_required
+@locks_home
 def save_appliance_order():
     try:
         data_from_request = request.json
@@ -1042,44 +1531,84 @@ def save_appliance_order():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+class UnlockedApplianceIndex:
+    """
+    Per-home list of unlocked appliances, plus whether they already all sit
+    in one state. Entries are tagged with the home's revision, so any save,
+    from this process or another, invalidates them.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, revision):
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry and entry['revision'] == revision:
+            return entry
+        return None
+
+    def build(self, user_id, user_data):
+        unlocked = []
+        for room_pos, room in enumerate(user_data.get('rooms', [])):
+            for appliance_pos, appliance in enumerate(room['appliances']):
+                if not appliance.get('locked', False):
+                    unlocked.append((room_pos, appliance_pos))
+        states = {user_data['rooms'][r]['appliances'][a]['state'] for r, a in unlocked}
+        entry = {
+            'revision': user_data.get('revision', 0),
+            'unlocked': unlocked,
+            'uniform_state': states.pop() if len(states) == 1 else None,
+        }
+        with self._lock:
+            self._entries[user_id] = entry
+        return entry
+
+unlocked_index = UnlockedApplianceIndex()
+
 @app.route('/api/global-ai-signal', methods=['POST'])
+@login_required
+@locks_home
 def global_ai_signal():
     """
-    Receives a signal for global AI control and updates all non-locked appliances.
+    Receives a whole-home detection signal and switches every unlocked
+    appliance in the caller's home. Repeated signals for a state the home is
+    already in return without loading or writing anything.
     """
     data = request.get_json()
     if data is None or 'state' not in data:
         return jsonify({"status": "error", "message": "Invalid request"}), 400
 
-    human_detected = data.get('state', False)
+    human_detected = bool(data.get('state', False))
     action_str = "ON" if human_detected else "OFF"
-    updated_count = 0
+    user_id = str(current_user.id)
 
     try:
-        # Get all user data and iterate through all users and their rooms
-        all_data = load_data()
-        
-        for user_id, user_data in all_data.items():
-            if 'rooms' not in user_data:
-                continue
-                
-            # Iterate through all rooms for this user
-            for room in user_data['rooms']:
-                for appliance in room['appliances']:
-                    # Check if the appliance is NOT locked
-                    if not appliance.get('locked', False):
-                        # Update the state in our backend data
-                        appliance['state'] = human_detected
-                        updated_count += 1
-        
-        # Save the updated data back to file
-        save_data(all_data)
-        
-        # Send MQTT command for global control (if MQTT client exists)
-        if mqtt_client:
-            mqtt_client.publish(MQTT_TOPIC_COMMAND, f"global:all:ai:{int(human_detected)}")
-        
-        message = f"Global signal processed. Turned {action_str} {updated_count} unlocked appliances."
+        entry = unlocked_index.get(user_id, storage.get_home_revision(user_id))
+        if entry and entry['uniform_state'] == human_detected:
+            return jsonify({"status": "success", "message": f"Global signal processed. Turned {action_str} 0 unlocked appliances."}), 200
+
+        user_data = storage.get_home(user_id)
+        if not user_data:
+            return jsonify({"status": "error", "message": "Home not found."}), 404
+        if entry is None or entry['revision'] != user_data.get('revision', 0):
+            entry = unlocked_index.build(user_id, user_data)
+
+        changes = []
+        for room_pos, appliance_pos in entry['unlocked']:
+            room = user_data['rooms'][room_pos]
+            appliance = room['appliances'][appliance_pos]
+            if appliance['state'] != human_detected:
+                appliance['state'] = human_detected
+                changes.append({"type": "appliance", "room_id": room['id'], "appliance": appliance})
+
+        if changes:
+            save_user_data(user_data, changes)
+            send_state_commands(user_id, changes)
+        unlocked_index.build(user_id, user_data)
+
+        message = f"Global signal processed. Turned {action_str} {len(changes)} unlocked appliances."
         return jsonify({"status": "success", "message": message}), 200
 
     except Exception as e:
@@ -1092,27 +1621,16 @@ def global_ai_signal():
 def get_analytics():
     try:
         analytics_data = load_analytics_data()
+        rollups = analytics_data.rollups
         
-        # Aggregate data by hour, day, and month
-        hourly_data = {str(i): 0 for i in range(24)}
-        daily_data = {}
-        monthly_data = {}
-        for record in analytics_data:
-            # Hourly aggregation
-            hour = record['hour']
-            hourly_data[str(hour)] += record['consumption']
-            
-            # Daily aggregation
-            date = record['date']
-            daily_data[date] = daily_data.get(date, 0) + record['consumption']
-            # Monthly aggregation
-            month = date[:7] # YYYY-MM
-            monthly_data[month] = monthly_data.get(month, 0) + record['consumption']
+        # Aggregates by hour, day, and month are maintained as readings arrive
+        day_numbers = rollups.daily.keys()
+        month_numbers = rollups.monthly.keys()
         
         # Calculate stats
-        total_consumption = sum(d['consumption'] for d in analytics_data)
-        highest_usage = max(d['consumption'] for d in analytics_data) if analytics_data else 0
-        average_usage = total_consumption / len(analytics_data) if analytics_data else 0
+        total_consumption = rollups.total
+        highest_usage = rollups.peak_usage
+        average_usage = total_consumption / rollups.count if rollups.count else 0
         # Placeholder for savings calculation
         estimated_savings = total_consumption * 0.15 # 15% arbitrary saving
         
@@ -1122,37 +1640,34 @@ def get_analytics():
             "savings": estimated_savings,
             # Additional stats for advanced dashboard
             "total_consumption": total_consumption,
-            "average_daily": total_consumption / max(1, len(set(record['date'] for record in analytics_data))),
+            "average_daily": total_consumption / max(1, len(day_numbers)),
             "peak_usage": highest_usage,
-            "peak_time": "12:00 PM",  # Placeholder
-            "daily_change": 5.2,  # Placeholder percentage change
+            "peak_time": epoch_hour_label(rollups.peak_hour) if rollups.peak_hour is not None else "",
+            "daily_change": rollups.month_change_percent(),
             "estimated_cost": total_consumption * ELECTRICITY_RATE
         }
         
         # Convert your existing data format to match frontend expectations
         # Transform hourly data for last 24 hours
         hourly_labels = [f"{i:02d}:00" for i in range(24)]
-        hourly_values = [hourly_data.get(str(i), 0) for i in range(24)]
+        hourly_values = rollups.hourly.sum.tolist()
         
         # Transform daily data for last 7 days (get most recent 7 days)
-        sorted_daily = sorted(daily_data.items(), key=lambda x: x[0], reverse=True)[:7]
-        weekly_labels = [datetime.strptime(date, "%Y-%m-%d").strftime("%a") for date, _ in reversed(sorted_daily)]
-        weekly_values = [value for _, value in reversed(sorted_daily)]
+        recent_days = day_numbers[-7:]
+        weekly_labels = [day.strftime("%a") for day in recent_days.astype('datetime64[D]').tolist()]
+        weekly_values = [float(rollups.daily.get(day)) for day in recent_days]
         
         # Transform monthly data for last 12 months
-        sorted_monthly = sorted(monthly_data.items(), key=lambda x: x[0], reverse=True)[:12]
-        yearly_labels = [datetime.strptime(f"{month}-01", "%Y-%m-%d").strftime("%b %Y") for month, _ in reversed(sorted_monthly)]
-        yearly_values = [value for _, value in reversed(sorted_monthly)]
+        recent_months = month_numbers[-12:]
+        yearly_labels = [month.strftime("%b %Y") for month in recent_months.astype('datetime64[M]').astype('datetime64[D]').tolist()]
+        yearly_values = [float(rollups.monthly.get(month)) for month in recent_months]
         
         # Generate additional analytics for advanced features
-        peak_analysis = {
-            'labels': hourly_labels,
-            'values': [max(80, hourly_data.get(str(i), 0) + (i * 2)) for i in range(24)]  # Mock peak data
-        }
+        peak_analysis = analyze_peak_usage(analytics_data)
         
-        distribution = [25, 35, 25, 15]  # Mock distribution data
+        distribution = calculate_usage_distribution(analytics_data)
         
-        weekly_pattern = [65, 70, 68, 72, 75, 85, 80]  # Mock weekly pattern
+        weekly_pattern = calculate_weekly_pattern(analytics_data)
         
         cost_breakdown = calculate_cost_breakdown(total_consumption)
         
@@ -1177,64 +1692,85 @@ def get_analytics():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def export_rows(series, start, stop):
+    """Yields (date, hour, consumption) rows in chunks so only one chunk is ever in memory."""
+    for chunk_start in range(start, stop, EXPORT_CHUNK_ROWS):
+        yield list(series.records(chunk_start, min(chunk_start + EXPORT_CHUNK_ROWS, stop)))
+
+def export_csv(series, start, stop):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['date', 'hour', 'consumption', 'cost'])
+    for records in export_rows(series, start, stop):
+        writer.writerows([record['date'], f"{record['hour']:02d}:00", record['consumption'],
+                          round(record['consumption'] * ELECTRICITY_RATE, 2)] for record in records)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def export_ndjson(series, start, stop):
+    for records in export_rows(series, start, stop):
+        yield "".join(json.dumps(dict(record, cost=round(record['consumption'] * ELECTRICITY_RATE, 2))) + "\n"
+                      for record in records)
+
+def export_json(series, start, stop):
+    yield f'{{"export_date": {json.dumps(datetime.now().isoformat())}, "total_records": {stop - start}, "data": ['
+    first = True
+    for records in export_rows(series, start, stop):
+        text = ", ".join(json.dumps(record) for record in records)
+        yield text if first else ", " + text
+        first = False
+    yield f'], "summary": {json.dumps(calculate_statistics(series.slice(start, stop)))}}}'
+
+def gzip_stream(chunks):
+    """Compresses a stream of text chunks into a gzip stream on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv', 'energy_consumption_{}.csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson', 'energy_consumption_{}.ndjson'),
+    'json': (export_json, 'application/json', 'energy_analytics_{}.json'),
+}
+
 @app.route('/api/export-data')
 @login_required
 def export_data():
-    """Export analytics data in various formats"""
+    """
+    Streams analytics data as csv, ndjson or json, optionally limited to
+    from/to and gzip-compressed with gzip=1. Memory use stays constant
+    however long the history is.
+    """
     format_type = request.args.get('format', 'csv').lower()
+    if format_type not in EXPORT_FORMATS:
+        return jsonify({'error': 'Unsupported format'}), 400
+    
+    try:
+        start_hour = parse_export_bound(request.args.get('from'))
+        end_hour = parse_export_bound(request.args.get('to'), is_end=True)
+    except ValueError:
+        return jsonify({'error': 'from/to must be epoch seconds or ISO dates'}), 400
     
     try:
         raw_data = load_analytics_data()
-        if not raw_data:
+        start, stop = raw_data.index_range(start_hour, end_hour)
+        if start >= stop:
             return jsonify({'error': 'No data to export'}), 404
         
-        if format_type == 'csv':
-            # Create temporary CSV file
-            temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False)
-            
-            fieldnames = ['date', 'hour', 'consumption', 'cost']
-            writer = csv.DictWriter(temp_file, fieldnames=fieldnames)
-            writer.writeheader()
-            
-            for record in raw_data:
-                writer.writerow({
-                    'date': record['date'],
-                    'hour': f"{record['hour']:02d}:00",
-                    'consumption': record['consumption'],
-                    'cost': round(record['consumption'] * ELECTRICITY_RATE, 2)
-                })
-            
-            temp_file.close()
-            
-            return send_file(
-                temp_file.name,
-                as_attachment=True,
-                download_name=f'energy_consumption_{datetime.now().strftime("%Y%m%d")}.csv',
-                mimetype='text/csv'
-            )
-        
-        elif format_type == 'json':
-            # Export as JSON
-            export_data = {
-                'export_date': datetime.now().isoformat(),
-                'total_records': len(raw_data),
-                'data': raw_data,
-                'summary': calculate_statistics(raw_data)
-            }
-            
-            temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False)
-            json.dump(export_data, temp_file, indent=2)
-            temp_file.close()
-            
-            return send_file(
-                temp_file.name,
-                as_attachment=True,
-                download_name=f'energy_analytics_{datetime.now().strftime("%Y%m%d")}.json',
-                mimetype='application/json'
-            )
+        generate, mimetype, filename = EXPORT_FORMATS[format_type]
+        filename = filename.format(datetime.now().strftime("%Y%m%d"))
+        body = generate(raw_data, start, stop)
+        if request.args.get('gzip') in ('1', 'true'):
+            body = gzip_stream(body)
+            mimetype = 'application/gzip'
+            filename += '.gz'
         
-        else:
-            return jsonify({'error': 'Unsupported format'}), 400
+        return Response(body, mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
             
     except Exception as e:
         return jsonify({'error': f'Export failed: {str(e)}'}), 500
@@ -1244,11 +1780,12 @@ def export_data():
 def get_efficiency_tips():
     """Get personalized efficiency tips based on usage patterns"""
     try:
-        raw_data = load_analytics_data()
-        if not raw_data:
+        # One pass over the history feeds the statistics and the per-hour averages
+        usage = summarize_usage(load_analytics_data())
+        if not usage.count:
             return jsonify({'error': 'No data available'}), 404
         
-        stats = calculate_statistics(raw_data)
+        stats = calculate_statistics(usage)
         tips = []
         
         # Generate tips based on usage patterns
@@ -1267,14 +1804,8 @@ def get_efficiency_tips():
             })
         
         # Time-based tips
-        hourly_usage = defaultdict(list)
-        for record in raw_data:
-            hourly_usage[record['hour']].append(record['consumption'])
-        
-        peak_hours = []
-        for hour, consumptions in hourly_usage.items():
-            if consumptions and statistics.mean(consumptions) > 70:
-                peak_hours.append(hour)
+        hourly_means = usage.hourly_means()
+        peak_hours = [hour for hour in range(24) if hourly_means[hour] > 70]
         
         if any(9 <= hour <= 17 for hour in peak_hours):
             tips.append({
@@ -1320,13 +1851,14 @@ def predict_next_month_usage(data):
     if len(data) < 30:  # Need at least 30 data points
         return None
     
-    recent_data = data[-720:]  # Last 30 days (assuming hourly data)
-    recent_avg = statistics.mean([record['consumption'] for record in recent_data])
+    consumption = data.consumption64
+    recent_data = consumption[-720:]  # Last 30 days (assuming hourly data)
+    recent_avg = float(recent_data.mean())
     
     # Simple trend calculation
-    older_data = data[-1440:-720] if len(data) >= 1440 else data[:-720]
-    if older_data:
-        older_avg = statistics.mean([record['consumption'] for record in older_data])
+    older_data = consumption[-1440:-720] if len(consumption) >= 1440 else consumption[:-720]
+    if len(older_data):
+        older_avg = float(older_data.mean())
         trend = (recent_avg - older_avg) / older_avg if older_avg > 0 else 0
         predicted_usage = recent_avg * (1 + trend) * 30 * 24  # Monthly prediction
         return max(0, predicted_usage)
@@ -1339,12 +1871,11 @@ def get_predictions():
     """Get usage predictions and projections"""
     try:
         raw_data = load_analytics_data()
-        if not raw_data:
+        if not len(raw_data):
             return jsonify({'error': 'Insufficient data for predictions'}), 404
         
         next_month_prediction = predict_next_month_usage(raw_data)
-        current_month_consumption = sum(record['consumption'] for record in raw_data 
-                                      if datetime.strptime(record['date'], "%Y-%m-%d").month == datetime.now().month)
+        current_month_consumption = float(raw_data.consumption64[raw_data.month_of_year == datetime.now().month].sum())
         
         predictions = {
             'next_month_kwh': round(next_month_prediction, 2) if next_month_prediction else None,
@@ -1367,13 +1898,14 @@ def get_user_settings():
         settings = user_data.get('user_settings', {})
 
         # Also load the main user record to get linked account info
-        users = load_users()
-        user_record = next((u for u in users if u['id'] == current_user.id), None)
+        user_record = storage.get_user(current_user.id)
 
         if user_record:
             settings['google_id'] = user_record.get('google_id')
             settings['github_id'] = user_record.get('github_id')
             settings['has_password'] = user_record.get('password_hash') is not None
+        if DEVICE_TOKEN_SECRET:
+            settings['device_token'] = device_token(current_user.id)
         
         return jsonify(settings), 200
     except Exception as e:
@@ -1381,12 +1913,13 @@ def get_user_settings():
 
 @app.route('/api/set-user-settings', methods=['POST'])
 @login_required
+@locks_home
 def set_user_settings():
     try:
         new_settings = request.json
         user_data = get_user_data()
         user_data['user_settings'].update(new_settings)
-        save_user_data(user_data)
+        save_user_data(user_data, [])
         return jsonify({"status": "success", "message": "Settings updated."}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -1399,8 +1932,7 @@ def change_password():
         old_password = data_from_request['old_password']
         new_password = data_from_request['new_password']
         
-        users = load_users()
-        user_found = next((user for user in users if user['id'] == current_user.id), None)
+        user_found = storage.get_user(current_user.id)
         
         if not user_found:
             return jsonify({"status": "error", "message": "User not found."}), 404
@@ -1408,25 +1940,28 @@ def change_password():
         # Check if user has no existing password (OAuth user setting password for first time)
         if not user_found.get('password_hash'):
             # No existing password, so set the new password directly
-            user_found['password_hash'] = generate_password_hash(new_password)
-            save_users(users)
+            user_found['password_hash'] = password_hasher.hash(new_password)
+            save_user(user_found)
             return jsonify({"status": "success", "message": "Password set successfully."}), 200
         
         # User has existing password, verify old password before updating
-        if check_password_hash(user_found['password_hash'], old_password):
-            user_found['password_hash'] = generate_password_hash(new_password)
-            save_users(users)
+        if password_hasher.verify(user_found['password_hash'], old_password):
+            user_found['password_hash'] = password_hasher.hash(new_password)
+            save_user(user_found)
             return jsonify({"status": "success", "message": "Password updated successfully."}), 200
         else:
             return jsonify({"status": "error", "message": "Invalid old password."}), 400
             
     except KeyError as e:
         return jsonify({"status": "error", "message": f"Missing required field: {str(e)}"}), 400
+    except AuthBusy:
+        return jsonify({"status": "error", "message": "The server is busy. Please try again in a moment."}), 503
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/api/set-global-ai-control', methods=['POST'])
 @login_required
+@locks_home
 def set_global_ai_control():
     try:
         data_from_request = request.json
@@ -1445,13 +1980,47 @@ def set_global_ai_control():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+presence_tracker = PresenceTracker(AI_PRESENCE_ON_FRAMES, AI_PRESENCE_OFF_SECONDS)
+
+def parse_detection_samples(data):
+    """
+    Reads either a single {"state": bool} frame or a batch
+    {"samples": [{"state": bool, "timestamp": epoch_seconds}, ...]} into
+    time-ordered (timestamp, detected) pairs.
+    """
+    now = time.time()
+    if 'samples' not in data:
+        return [(now, bool(data['state']))]
+    samples = []
+    for sample in data['samples']:
+        if isinstance(sample, dict):
+            timestamp = float(sample.get('timestamp', now))
+            samples.append((min(timestamp, now), bool(sample['state'])))
+        else:
+            samples.append((now, bool(sample)))
+    samples.sort(key=lambda sample: sample[0])
+    return samples
+
 @app.route('/api/ai-detection-signal', methods=['POST'])
 @login_required
+@locks_home
 def ai_detection_signal():
+    """
+    Receives detection frames for a room (or the whole home when room_id is
+    omitted). Appliances are switched, saved and published only when the
+    debounced presence state actually changes.
+    """
     try:
         data_from_request = request.json
         room_id = data_from_request.get('room_id') # Can be None for global
-        state = data_from_request['state']
+        samples = parse_detection_samples(data_from_request)
+        if not samples:
+            return jsonify({"status": "error", "message": "No detection samples."}), 400
+        
+        present, changed = presence_tracker.observe((str(current_user.id), room_id), samples)
+        if not changed:
+            return jsonify({"status": "success", "present": present, "message": "No change in presence."}), 200
+        state = present
         
         user_data = get_user_data()
 
@@ -1459,104 +2028,83 @@ def ai_detection_signal():
             # Per-room control
             room = next((r for r in user_data['rooms'] if r['id'] == room_id), None)
             if not room:
+                presence_tracker.forget((str(current_user.id), room_id))
                 return jsonify({"status": "error", "message": "Room not found."}), 404
-            
-            for appliance in room['appliances']:
-                if not appliance['locked']:
-                    appliance['state'] = state
+            rooms = [room]
         else:
             # Global control
-            for room in user_data['rooms']:
-                for appliance in room['appliances']:
-                    if not appliance['locked']:
-                        appliance['state'] = state
+            rooms = user_data['rooms']
 
-        user_data['last_command'] = {
-            "room_id": room_id,
-            "state": state,
-            "timestamp": int(time.time())
-        }
-        
-        save_user_data(user_data)
+        changes = []
+        for room in rooms:
+            for appliance in room['appliances']:
+                if not appliance['locked'] and appliance['state'] != state:
+                    appliance['state'] = state
+                    changes.append({"type": "appliance", "room_id": room['id'], "appliance": appliance})
 
-        if mqtt_client:
-            topic_payload = f"{current_user.id}:{room_id or 'all'}:ai:{int(state)}"
-            mqtt_client.publish(MQTT_TOPIC_COMMAND, topic_payload)
+        if changes:
+            save_user_data(user_data, changes)
+            send_state_commands(str(current_user.id), changes)
 
         action = "activated" if state else "deactivated"
         message = f"AI control has been {action}."
         
-        return jsonify({"status": "success", "message": message}), 200
+        return jsonify({"status": "success", "present": present, "message": message}), 200
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"Invalid detection signal: {e}"}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
         
 
-def send_detection_email_thread(recipient, subject, body, image_data):
-    """Send email in a separate thread to prevent blocking."""
-    def send_email():
-        with app.app_context():
-            print(f"Preparing to send email to {recipient}...")
-            try:
-                if not recipient or not subject or not body:
-                    print("Email sending failed: Missing required fields")
-                    return
-                
-                msg = Message(
-                    subject=subject,
-                    recipients=[recipient]
-                )
-                msg.html = body
-                
-                if image_data:
-                    try:
-                        if ',' in image_data:
-                            image_binary = base64.b64decode(image_data.split(',')[1])
-                        else:
-                            image_binary = base64.b64decode(image_data)
-                        
-                        msg.attach(
-                            "detection_alert.png",
-                            "image/png",
-                            image_binary
-                        )
-                    except Exception as img_error:
-                        print(f"Error processing image attachment: {img_error}")
-                        
-                mail.send(msg)
-                print(f"Email sent successfully to {recipient}!")
-                
-            except Exception as e:
-                print(f"Error sending email: {e}")
-    
-    email_thread = threading.Thread(target=send_email)
-    email_thread.daemon = True
-    email_thread.start()
-
-
-@app.route('/api/send-detection-email', methods=['POST'])
-@login_required
-def send_detection_email():
+def build_detection_message(item):
+    """Turns a queued alert into a Message, noting any alerts that were folded into it."""
+    subject = item['subject']
+    body = item['body']
+    if item['alerts'] > 1:
+        subject = f"{subject} ({item['alerts']} alerts)"
+        body = body.replace("</body>", f"<p style=\"text-align: center; color: #777;\">{item['alerts']} detections were reported since the last alert; this is the first of them.</p></body>")
+    msg = Message(subject=subject, recipients=[item['recipient']])
+    msg.html = body
+    if item['attachment']:
+        msg.attach("detection_alert.jpg", "image/jpeg", item['attachment'])
+    return msg
+
+mail_queue = MailQueue(MAIL_OUTBOX_DB, mail.connect, build_detection_message,
+                       workers=MAIL_WORKERS, context=app.app_context)
+mail_queue.start()
+
+snapshot_store = SnapshotStore(SNAPSHOTS_DIR)
+
+def decode_image_data(image_data):
+    """Decodes a base64 image, with or without a data URL prefix."""
+    if not image_data:
+        return None
     try:
-        data_from_request = request.json
-        room_name = data_from_request.get('room_name')
-        is_global = data_from_request.get('is_global', False)
-        image_data = data_from_request['image_data']
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        user_data = get_user_data()
-        recipient_email = user_data['user_settings']['email']
-        
-        if not recipient_email:
-            print("No recipient email found in user settings. Email not sent.")
-            return jsonify({"status": "error", "message": "User email not set for notifications."}), 400
-        
-        if is_global:
-            subject = "Luminous Home System Alert: Human Detected at Home"
-            message_text = "A human has been detected at your home. All unlocked appliances have been activated."
-        else:
-            subject = "Luminous Home System Alert: Motion Detected!"
-            message_text = f"Motion has been detected in your room: {room_name}"
+        if ',' in image_data:
+            return base64.b64decode(image_data.split(',')[1])
+        return base64.b64decode(image_data)
+    except Exception as img_error:
+        print(f"Error processing image attachment: {img_error}")
+        return None
 
-        body_html = f"""
+def queue_detection_alert(room_name, is_global, snapshot_digest):
+    """Emails the user about a detection, attaching the compacted snapshot."""
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    user_data = get_user_data()
+    recipient_email = user_data['user_settings']['email']
+    
+    if not recipient_email:
+        print("No recipient email found in user settings. Email not sent.")
+        return jsonify({"status": "error", "message": "User email not set for notifications."}), 400
+    
+    if is_global:
+        subject = "Luminous Home System Alert: Human Detected at Home"
+        message_text = "A human has been detected at your home. All unlocked appliances have been activated."
+    else:
+        subject = "Luminous Home System Alert: Motion Detected!"
+        message_text = f"Motion has been detected in your room: {room_name}"
+
+    body_html = f"""
         <html>
             <body style="font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 20px;">
                 <div style="max-width: 600px; margin: 0 auto; background-color: #fff; padding: 20px; border-radius: 10px; box-shadow: 0 4px 8px rgba(0,0,0,0.1);">
@@ -1572,12 +2120,133 @@ def send_detection_email():
             </body>
         </html>
         """
-        
-        send_detection_email_thread(recipient_email, subject, body_html, image_data)
-        
-        print("API call to send email initiated.")
-        return jsonify({"status": "success", "message": "Email alert sent."}), 200
-        
+    
+    try:
+        attachment = snapshot_store.read(snapshot_digest) if snapshot_digest else None
+        coalesced = mail_queue.enqueue(str(current_user.id), recipient_email, subject, body_html, attachment)
+    except MailQueueFull as e:
+        print(f"Error queueing detection email: {e}")
+        return jsonify({"status": "error", "message": "Too many alerts pending, try again later."}), 503
+    
+    print("Detection email queued." if not coalesced else "Detection email merged into a pending alert.")
+    return jsonify({"status": "success", "message": "Email alert sent.", "snapshot": snapshot_digest}), 200
+
+@app.route('/api/detection-alert', methods=['POST'])
+@login_required
+def detection_alert():
+    """
+    Binary variant of /api/send-detection-email. Takes the frame as a
+    multipart 'image' file or as a raw image/* body, with room_name and
+    is_global as form fields or query parameters.
+    """
+    try:
+        fields = request.form if request.files else request.args
+        room_name = fields.get('room_name')
+        is_global = fields.get('is_global', 'false').lower() in ('true', '1')
+        upload = request.files.get('image')
+        stream = upload.stream if upload else request.stream
+        digest, reused = snapshot_store.put_stream(str(current_user.id), stream)
+        return queue_detection_alert(room_name, is_global, digest)
+    except SnapshotTooLarge as e:
+        return jsonify({"status": "error", "message": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        print(f"Error in detection_alert endpoint: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/snapshots/<digest>', methods=['GET'])
+@login_required
+def get_snapshot(digest):
+    """Serves a stored detection snapshot by its content hash, to the users who uploaded it."""
+    if (not re.fullmatch(r'[0-9a-f]{64}', digest) or not os.path.exists(snapshot_store.path(digest))
+            or not snapshot_store.owns(current_user.id, digest)):
+        return jsonify({"status": "error", "message": "Snapshot not found."}), 404
+    return send_file(snapshot_store.path(digest), mimetype='image/jpeg', max_age=86400)
+
+@app.route('/api/user-cache-metrics', methods=['GET'])
+@login_required
+def user_cache_metrics():
+    """Hit and miss counters of the session principal cache, for sizing it."""
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Admins only."}), 403
+    return jsonify(user_cache.metrics()), 200
+
+@app.route('/api/mail-metrics', methods=['GET'])
+@login_required
+def mail_metrics():
+    """Outbox depth, delivery latency and send counters of the alert mail workers."""
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Admins only."}), 403
+    return jsonify(mail_queue.metrics()), 200
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@login_required
+def list_profiles():
+    """Saved slow-request profiles, newest first, and the slowest endpoints with their hottest functions."""
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Admins only."}), 403
+    top = request.args.get('top', 10, type=int)
+    captures = [{key: value for key, value in capture.items() if key != 'functions'} for capture in profiler.captures()]
+    return jsonify({"threshold_ms": PROFILE_SLOW_MS, "profiles": captures,
+                    "slowest_endpoints": profiler.slowest_endpoints(top)}), 200
+
+@app.route('/api/admin/profiles/<name>', methods=['GET'])
+@login_required
+def get_profile(name):
+    """Downloads one capture: the JSON summary, or the .prof file of a full cProfile run."""
+    if not is_admin():
+        return jsonify({"status": "error", "message": "Admins only."}), 403
+    path = profiler.path(name)
+    if not path:
+        return jsonify({"status": "error", "message": "Profile not found."}), 404
+    return send_file(path, as_attachment=name.endswith('.prof'))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Request latencies, storage traffic and queue depths of this worker, in the Prometheus text format."""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"status": "error", "message": "Unauthorized."}), 401
+    storage_io = storage.metrics()
+    mqtt = mqtt_client.metrics() if mqtt_client else {}
+    mail = mail_queue.metrics()
+    cache = user_cache.metrics()
+    counters = [
+        ('storage_read_bytes_total', 'Bytes of stored homes and accounts read.', storage_io['bytes_read']),
+        ('storage_written_bytes_total', 'Bytes of stored homes and accounts written.', storage_io['bytes_written']),
+        ('mqtt_published_total', 'Messages delivered to the MQTT broker.', mqtt.get('published')),
+        ('mqtt_failed_total', 'MQTT publishes that failed and were retried.', mqtt.get('failed')),
+        ('mqtt_dropped_total', 'MQTT messages dropped because the queue or spill file was full.', mqtt.get('dropped')),
+        ('mail_sent_total', 'Alert mails sent.', mail['sent']),
+        ('mail_failed_total', 'Alert mail send attempts that failed.', mail['failed']),
+        ('user_cache_hits_total', 'Session principals served from the user cache.', cache['hits']),
+        ('user_cache_misses_total', 'Session principals loaded from storage.', cache['misses']),
+    ]
+    gauges = [
+        ('mqtt_connected', 'Whether the MQTT publisher is connected.', int(mqtt['connected']) if mqtt else None),
+        ('mqtt_queue_depth', 'Messages waiting in the MQTT publisher queue.', mqtt.get('queue_depth')),
+        ('mqtt_spill_depth', 'Messages spilled to disk while the broker was unreachable.', mqtt.get('spill_depth')),
+        ('mail_queue_depth', 'Alert mails waiting in the outbox.', mail['queue_depth']),
+        ('user_cache_entries', 'Session principals held in the user cache.', cache['size']),
+    ]
+    return Response(request_metrics.render(counters, gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/send-detection-email', methods=['POST'])
+@login_required
+def send_detection_email():
+    try:
+        data_from_request = request.json
+        room_name = data_from_request.get('room_name')
+        is_global = data_from_request.get('is_global', False)
+        image_binary = decode_image_data(data_from_request['image_data'])
+        digest = None
+        if image_binary:
+            digest, reused = snapshot_store.put_bytes(str(current_user.id), image_binary)
+        return queue_detection_alert(room_name, is_global, digest)
+        
+    except (ValueError, SnapshotTooLarge) as e:
+        print(f"Error processing image attachment: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         print(f"Error in send_detection_email endpoint: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -1631,5 +2300,6 @@ def authorize_github():
 if __name__ == '__main__':
     generate_analytics_data()
     run_mqtt_thread()
+    start_timer_scheduler()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,205 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms fall back to a per-process budget
+    fcntl = None
+
+# How long a login waits for a free hashing slot before it is turned away; several hash durations
+SLOT_WAIT = 5.0
+# Calls per process that may wait for a slot at once; any more are turned away immediately
+MAX_WAITING = 16
+# Seconds between attempts to take a slot while waiting
+SLOT_POLL = 0.02
+# Token bucket entries kept per limiter; the least recently used are forgotten first
+MAX_BUCKETS = 100000
+# Hashing processes run at lower CPU priority so request workers win any contention
+HASHER_NICENESS = 10
+
+
+class AuthBusy(Exception):
+    """Raised when every password hashing slot is taken."""
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+
+def _lower_priority():
+    try:
+        os.nice(HASHER_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+def hash_method(pwhash):
+    """The method prefix of a werkzeug hash, e.g. 'scrypt:32768:8:1'."""
+    return pwhash.split('$', 1)[0]
+
+
+def default_slot_directory():
+    """A temp directory for the slot files, keyed by the working directory so each deployment gets its own."""
+    key = hashlib.sha1(os.path.abspath(os.getcwd()).encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'lumino-auth-slots-{key}')
+
+
+class ConcurrencyBudget:
+    """
+    Caps how many password hashes run at once across every worker process
+    of a deployment. Each slot is a lock file in directory held with flock
+    for the duration of one hash. A call that finds every slot taken waits
+    up to wait seconds for one, unless max_waiting calls in this process
+    are already waiting.
+    """
+
+    def __init__(self, slots, directory=None, wait=SLOT_WAIT, max_waiting=MAX_WAITING):
+        self.slots = slots
+        self.directory = directory or default_slot_directory()
+        self.wait = wait
+        self.max_waiting = max_waiting
+        self._semaphore = threading.BoundedSemaphore(slots)
+        self._waiting = 0
+        self._waiting_lock = threading.Lock()
+        if fcntl:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def acquire(self):
+        handle = self._try_acquire()
+        if handle is not None:
+            return handle
+        with self._waiting_lock:
+            if self._waiting >= self.max_waiting:
+                raise AuthBusy("Too many sign-in attempts in progress")
+            self._waiting += 1
+        try:
+            deadline = time.monotonic() + self.wait
+            while time.monotonic() < deadline:
+                time.sleep(SLOT_POLL)
+                handle = self._try_acquire()
+                if handle is not None:
+                    return handle
+            raise AuthBusy("Too many sign-in attempts in progress")
+        finally:
+            with self._waiting_lock:
+                self._waiting -= 1
+
+    def _try_acquire(self):
+        if not fcntl:
+            return self if self._semaphore.acquire(blocking=False) else None
+        for slot in range(self.slots):
+            f = open(os.path.join(self.directory, f"slot-{slot}.lock"), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except OSError:
+                f.close()
+        return None
+
+    def release(self, handle):
+        if handle is self:
+            self._semaphore.release()
+        else:
+            handle.close()
+
+
+class PasswordHasher:
+    """
+    Runs password hashing and verification in a pool of worker processes,
+    so a burst of logins costs CPU in the pool rather than in request
+    workers. Each call holds one ConcurrencyBudget slot, waiting briefly
+    for one when all are taken; past the budget's queue depth or wait it
+    raises AuthBusy. With workers=0, hashes run inline but still within the
+    budget. The pool is forked on first use in each process, so a pool
+    created before a server forks its workers is never shared with them.
+    """
+
+    def __init__(self, workers=2, max_concurrent=2, method='scrypt', slot_directory=None,
+                 slot_wait=SLOT_WAIT, max_waiting=MAX_WAITING):
+        self.workers = workers
+        self.budget = ConcurrencyBudget(max_concurrent, slot_directory, slot_wait, max_waiting)
+        self.method = method
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._target_method = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget_pool)
+
+    def _forget_pool(self):
+        # The parent's pool threads don't exist in a forked child; it starts its own
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                                 initializer=_lower_priority)
+                # Fork the processes now, while this thread holds no slot; a child would keep its flock alive
+                self._pool.submit(int).result()
+            return self._pool
+
+    def _run(self, function, *args):
+        executor = self._executor() if self.workers else None
+        handle = self.budget.acquire()
+        try:
+            if executor is None:
+                return function(*args)
+            return executor.submit(function, *args).result()
+        finally:
+            self.budget.release(handle)
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(_verify, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when pwhash was made with a different method or cost than new hashes use."""
+        if self._target_method is None:
+            self._target_method = hash_method(generate_password_hash('', method=self.method))
+        return hash_method(pwhash) != self._target_method
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket per key: up to burst attempts at once, refilled at rate
+    tokens per second. Buckets live in this process only.
+    """
+
+    def __init__(self, rate, burst, max_keys=MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
@@ -0,0 +1,190 @@
+"""
+Micro-benchmarks for the analytics functions in app.py.
+
+Each function runs over synthetic hourly series (see synthetic.py) of 1, 5
+and 10 years, once per home for 1 to 1,000 homes. Every call gets a fresh
+TimeSeries over the same columns, so it pays for the derived columns and
+rollups it needs ("cold", as on the first request after a load); a second
+call on the same series measures the cached ("warm") path. Peak memory of
+one cold call is taken separately under tracemalloc, which NumPy reports
+its buffers to.
+
+Homes cycle through a pool of --distinct generated series, so generation
+time stays out of the way at 1,000 homes.
+
+Usage: python benchmarks/analytics_bench.py [--years 1,5,10] [--homes 1,10,100,1000]
+       [--output analytics_bench.json] [--plot analytics_bench.png] [--compare before.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FUNCTIONS = ['process_hourly_data', 'process_weekly_data', 'process_yearly_data', 'calculate_statistics',
+             'analyze_peak_usage', 'calculate_usage_distribution', 'calculate_weekly_pattern',
+             'predict_next_month_usage']
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_memory(function, series, series_class):
+    # The first call anywhere can allocate for lazy imports and caches; keep that out
+    function(series_class(series.hours, series.consumption))
+    fresh = series_class(series.hours, series.consumption)
+    tracemalloc.start()
+    try:
+        function(fresh)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_function(function, pool, homes, repeat, series_class):
+    cold = []
+    warm = []
+    for call in range(max(homes, repeat)):
+        source = pool[call % len(pool)]
+        series = series_class(source.hours, source.consumption)
+        started = time.perf_counter()
+        function(series)
+        cold.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        function(series)
+        warm.append(time.perf_counter() - started)
+    # With fewer homes than repeats, total is still the cost of one call per home
+    per_home = sum(cold) / len(cold)
+    return {
+        'cold_ms': round(statistics.median(cold) * 1000, 4),
+        'warm_ms': round(statistics.median(warm) * 1000, 4),
+        'cold_p95_ms': round(sorted(cold)[int(len(cold) * 0.95)] * 1000, 4),
+        'total_s': round(per_home * homes, 6),
+    }
+
+
+def run(args):
+    # Importing the app creates its databases in the working directory
+    os.chdir(tempfile.mkdtemp(prefix='analytics-bench-'))
+    import app
+    from synthetic import generate_home_series, current_hour
+    from timeseries import TimeSeries
+
+    functions = [name for name in FUNCTIONS if not args.functions or name in args.functions.split(',')]
+    end_hour = current_hour()
+    results = []
+    for years in args.years:
+        pool = [generate_home_series(args.seed, index, years, end_hour) for index in range(min(args.distinct, max(args.homes)))]
+        rows = len(pool[0])
+        for name in functions:
+            function = getattr(app, name)
+            memory = peak_memory(function, pool[0], TimeSeries)
+            for homes in args.homes:
+                timing = bench_function(function, pool[:homes], homes, args.repeat, TimeSeries)
+                result = dict(function=name, years=years, homes=homes, rows=rows, peak_kib=round(memory / 1024, 1), **timing)
+                results.append(result)
+                print(f"{name:<30} {years:>3}y {homes:>5} homes  cold {timing['cold_ms']:>9.3f} ms  "
+                      f"warm {timing['warm_ms']:>9.3f} ms  total {timing['total_s']:>8.3f} s  peak {result['peak_kib']:>9.1f} KiB")
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpus': os.cpu_count(),
+            'machine': platform.machine(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline):
+    before = {(r['function'], r['years'], r['homes']): r for r in baseline['results']}
+    print(f"\nAgainst {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')}):")
+    for result in results['results']:
+        old = before.get((result['function'], result['years'], result['homes']))
+        if not old:
+            continue
+        ratio = lambda key: f"{result[key] / old[key]:.2f}x" if old[key] else 'n/a'
+        print(f"{result['function']:<30} {result['years']:>3}y {result['homes']:>5} homes  "
+              f"cold {ratio('cold_ms'):>7}  warm {ratio('warm_ms'):>7}  peak {ratio('peak_kib'):>7}")
+
+
+def plot(results, path):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed; skipping the plot")
+        return
+    rows = results['results']
+    functions = sorted({r['function'] for r in rows})
+    years = sorted({r['years'] for r in rows})
+    homes = sorted({r['homes'] for r in rows})
+    fig, (by_years, by_homes, memory) = plt.subplots(1, 3, figsize=(18, 5.5))
+    for name in functions:
+        single = sorted((r['years'], r['cold_ms']) for r in rows if r['function'] == name and r['homes'] == homes[0])
+        by_years.plot(*zip(*single), marker='o', label=name)
+        fleet = sorted((r['homes'], r['total_s']) for r in rows if r['function'] == name and r['years'] == years[-1])
+        by_homes.plot(*zip(*fleet), marker='o', label=name)
+        peaks = sorted((r['years'], r['peak_kib']) for r in rows if r['function'] == name and r['homes'] == homes[0])
+        memory.plot(*zip(*peaks), marker='o', label=name)
+    by_years.set(title='Cold call vs history length', xlabel='years of hourly data', ylabel='ms per call', yscale='log')
+    by_homes.set(title=f'Fleet total at {years[-1]} years', xlabel='homes', ylabel='seconds', xscale='log', yscale='log')
+    memory.set(title='Peak memory of one cold call', xlabel='years of hourly data', ylabel='KiB', yscale='log')
+    by_years.legend(fontsize='small')
+    fig.suptitle(f"Analytics functions @ {results['meta']['commit']}")
+    fig.tight_layout()
+    fig.savefig(path, dpi=110)
+    print(f"Plot written to {path}")
+
+
+def int_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int_list, default=[1, 5, 10])
+    parser.add_argument('--homes', type=int_list, default=[1, 10, 100, 1000])
+    parser.add_argument('--functions', default='', help='comma-separated subset of the functions')
+    parser.add_argument('--distinct', type=int, default=20, help='distinct generated series homes cycle through')
+    parser.add_argument('--repeat', type=int, default=20, help='minimum calls per measurement')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='analytics_bench.json')
+    parser.add_argument('--plot', help='write scaling curves to this image (needs matplotlib)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+    for name in ('output', 'plot', 'compare'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.plot:
+        plot(results, args.plot)
+
+
+if __name__ == '__main__':
+    main()
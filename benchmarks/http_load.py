@@ -0,0 +1,377 @@
+"""
+Offline load test for the HTTP API with synthetic homes.
+
+Generates --users homes of --rooms rooms with --appliances appliances each,
+shaped after create_default_user_data(), and drives the app through
+Flask's test client (--mode testclient, the default) or a local gunicorn
+(--mode gunicorn). Client threads replay a weighted mix of the traffic a
+home produces:
+
+  poll     dashboard GET /api/get-rooms-and-appliances every 3 s
+  checkin  ESP GET /api/esp/check-in every 3 s
+  detect   camera POST /api/ai-detection-signal every 5 s
+  toggle   POST /api/set-appliance-state about once a minute
+  timer    POST /api/set-timer about once every five minutes
+
+Latency percentiles and throughput per endpoint are written as JSON,
+together with the commit and parameters, so runs can be compared with
+--compare. Runs are reproducible for a given --seed.
+
+Usage: python benchmarks/http_load.py --users 200 --duration 30
+       python benchmarks/http_load.py --mode gunicorn --workers 4 --compare before.json
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Requests per home per minute for each kind of traffic
+DEFAULT_MIX = {'poll': 20, 'checkin': 20, 'detect': 12, 'toggle': 1, 'timer': 0.2}
+BENCH_PASSWORD = 'bench-password'
+# A cheap hash keeps dataset generation and sign-in fast; auth is not what is measured here
+BENCH_HASH_METHOD = 'pbkdf2:sha256:1000'
+SERVER_ENV = {
+    'AUTH_HASH_METHOD': BENCH_HASH_METHOD,
+    'DEVICE_TOKEN_SECRET': 'bench-device-secret',
+    'LOGIN_IP_BURST': '1000000', 'LOGIN_IP_PER_MINUTE': '1000000',
+    'LOGIN_ACCOUNT_BURST': '1000000', 'LOGIN_ACCOUNT_PER_MINUTE': '1000000',
+}
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    for part in filter(None, (text or '').split(',')):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f"Unknown operation in --mix: {name}")
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def build_home(template, rooms, appliances):
+    home = copy.deepcopy(template)
+    room_template = template['rooms'][0]
+    home['rooms'] = []
+    for r in range(rooms):
+        room = copy.deepcopy(room_template)
+        room['id'] = str(r + 1)
+        room['name'] = f"{room_template['name']} {r + 1}" if r else room_template['name']
+        room['appliances'] = []
+        for a in range(appliances):
+            appliance = copy.deepcopy(room_template['appliances'][a % len(room_template['appliances'])])
+            appliance['id'] = str(a + 1)
+            appliance['relay_number'] = a + 1
+            room['appliances'].append(appliance)
+        home['rooms'].append(room)
+    return home
+
+
+def generate_dataset(args):
+    """Writes the synthetic users and homes through the app's own storage layer."""
+    from werkzeug.security import generate_password_hash
+    from app import create_default_user_data
+    from storage import create_storage
+
+    password_hash = generate_password_hash(BENCH_PASSWORD, method=BENCH_HASH_METHOD)
+    users = []
+    homes = {}
+    for i in range(args.users):
+        user_id = str(i + 1)
+        username = f"bench{user_id}"
+        users.append({'id': user_id, 'username': username, 'password_hash': password_hash})
+        template = create_default_user_data(name=username, email=f"{username}@example.com")
+        homes[user_id] = build_home(template, args.rooms, args.appliances)
+
+    store = create_storage(args.storage, 'data.json', 'users.json', 'luminous.db')
+    store.save_homes(homes)
+    store.save_users(users)
+    if hasattr(store, 'flush'):
+        store.flush()
+    return users
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.app = app
+
+    def session(self):
+        return self.app.test_client()
+
+    def sign_in(self, session, username):
+        session.post('/signin', data={'username': username, 'password': BENCH_PASSWORD})
+
+    def request(self, session, method, path, body=None, headers=None):
+        response = session.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_data()
+
+    def close(self, session):
+        pass
+
+
+class HTTPTransport:
+    def __init__(self, base):
+        import requests
+        self.requests = requests
+        self.base = base
+
+    def session(self):
+        return self.requests.Session()
+
+    def sign_in(self, session, username):
+        session.post(self.base + '/signin', allow_redirects=False, timeout=120,
+                     data={'username': username, 'password': BENCH_PASSWORD})
+
+    def request(self, session, method, path, body=None, headers=None):
+        response = session.request(method, self.base + path, json=body, headers=headers,
+                                   allow_redirects=False, timeout=120)
+        return response.status_code, response.content
+
+    def close(self, session):
+        session.close()
+
+
+def device_token(user_id):
+    """The X-Device-Token the app expects from the home's ESP (SERVER_ENV sets its secret)."""
+    import app
+    return app.device_token(user_id)
+
+
+class VirtualClient(threading.Thread):
+    """Replays the weighted mix against its own share of the homes."""
+
+    def __init__(self, index, transport, homes, args, mix, record, stop):
+        super().__init__(daemon=True)
+        self.transport = transport
+        self.homes = homes
+        self.args = args
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.record = record
+        self.stop = stop
+        self.sessions = {}
+        self.acks = {}
+        self.pause = args.clients / args.rate if args.rate else 0
+
+    def _session(self, user):
+        session = self.sessions.get(user['id'])
+        if session is None:
+            session = self.transport.session()
+            self.transport.sign_in(session, user['username'])
+            self.sessions[user['id']] = session
+        return session
+
+    def _request(self, operation, user):
+        rng = self.rng
+        room_id = str(rng.randint(1, self.args.rooms))
+        appliance_id = str(rng.randint(1, self.args.appliances))
+        if operation == 'poll':
+            return 'GET', '/api/get-rooms-and-appliances', None
+        if operation == 'checkin':
+            return 'GET', f"/api/esp/check-in?user_id={user['id']}&ack={self.acks.get(user['id'], 0)}&wait=0", None
+        if operation == 'detect':
+            return 'POST', '/api/ai-detection-signal', {'room_id': room_id, 'state': rng.random() < 0.3}
+        if operation == 'toggle':
+            return 'POST', '/api/set-appliance-state', {'room_id': room_id, 'appliance_id': appliance_id,
+                                                         'state': rng.random() < 0.5}
+        timer = time.time() + rng.randint(60, 3600) if rng.random() < 0.8 else None
+        return 'POST', '/api/set-timer', {'room_id': room_id, 'appliance_id': appliance_id, 'timer': timer}
+
+    def run(self):
+        while not self.stop.is_set():
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            user = self.rng.choice(self.homes)
+            session = self._session(user)
+            method, path, body = self._request(operation, user)
+            headers = {'X-Device-Token': device_token(user['id'])} if operation == 'checkin' else None
+            started = time.perf_counter()
+            try:
+                status, content = self.transport.request(session, method, path, body, headers)
+            except Exception:
+                status, content = 599, b''
+            self.record(operation, time.perf_counter() - started, status)
+            if operation == 'checkin' and status == 200:
+                # Like a device, ack the newest command seen on the next check-in
+                commands = json.loads(content).get('commands') or []
+                if commands:
+                    self.acks[user['id']] = commands[-1]['seq']
+            if self.pause:
+                time.sleep(self.pause)
+        # Open keep-alive connections would hold up a graceful gunicorn shutdown
+        for session in self.sessions.values():
+            self.transport.close(session)
+
+
+def summarize(samples, errors, seconds):
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0, 'errors': errors}
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 3)
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'throughput_rps': round(len(ordered) / seconds, 1),
+        'p50_ms': pick(0.5),
+        'p95_ms': pick(0.95),
+        'p99_ms': pick(0.99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(args):
+    mix = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix='http-load-')
+    os.chdir(workdir)
+    os.environ.update(SERVER_ENV, STORAGE_BACKEND=args.storage)
+    server = None
+    app = None
+    try:
+        print(f"Generating {args.users} homes x {args.rooms} rooms x {args.appliances} appliances in {workdir}")
+        users = generate_dataset(args)
+
+        if args.mode == 'gunicorn':
+            port = free_port()
+            server = subprocess.Popen(
+                ['gunicorn', '-w', str(args.workers), '-k', args.worker_class, '--threads', str(args.threads),
+                 '-b', f'127.0.0.1:{port}', '--timeout', '120', 'app:app'],
+                cwd=workdir, env=dict(os.environ, PYTHONPATH=ROOT),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            transport = HTTPTransport(f'http://127.0.0.1:{port}')
+            for _ in range(300):
+                try:
+                    transport.requests.get(transport.base + '/signin', timeout=1)
+                    break
+                except transport.requests.RequestException:
+                    time.sleep(0.1)
+        else:
+            import app
+            transport = TestClientTransport(app.app)
+
+        lock = threading.Lock()
+        samples = {name: [] for name in mix}
+        errors = {name: 0 for name in mix}
+        measuring = threading.Event()
+
+        def record(operation, elapsed, status):
+            if not measuring.is_set():
+                return
+            with lock:
+                samples[operation].append(elapsed)
+                if status >= 300:
+                    errors[operation] += 1
+
+        stop = threading.Event()
+        shares = [users[i::args.clients] for i in range(args.clients)]
+        clients = [VirtualClient(i, transport, share, args, mix, record, stop)
+                   for i, share in enumerate(shares) if share]
+        for client in clients:
+            client.start()
+        time.sleep(args.warmup)
+        measuring.set()
+        started = time.time()
+        time.sleep(args.duration)
+        measuring.clear()
+        elapsed = time.time() - started
+        stop.set()
+        for client in clients:
+            client.join(timeout=120)
+
+        all_samples = [s for name in mix for s in samples[name]]
+        return {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'args': vars(args),
+                'mix_per_home_per_minute': mix,
+            },
+            'endpoints': {name: summarize(samples[name], errors[name], elapsed) for name in mix},
+            'total': summarize(all_samples, sum(errors.values()), elapsed),
+        }
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+        if app and hasattr(app.storage, 'flush'):
+            # Write pending changes now; the store resolves its files against this directory
+            app.storage.flush()
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(results, baseline=None):
+    print(f"{'endpoint':<10}{'count':>9}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = dict(results['endpoints'], total=results['total'])
+    for name, row in rows.items():
+        if not row['count']:
+            continue
+        line = (f"{name:<10}{row['count']:>9}{row['errors']:>6}{row['throughput_rps']:>9}"
+                f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+        if baseline:
+            before = baseline['total'] if name == 'total' else baseline['endpoints'].get(name)
+            if before and before.get('count'):
+                change = lambda key: f"{(row[key] - before[key]) / before[key] * 100:+.0f}%" if before[key] else 'n/a'
+                line += f"   p50 {change('p50_ms')}, p95 {change('p95_ms')}, rps {change('throughput_rps')}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rooms', type=int, default=3)
+    parser.add_argument('--appliances', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--rate', type=float, default=0, help='target total requests/s; 0 runs flat out')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--mix', default='', help='override weights, e.g. poll=20,toggle=5,timer=0')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--mode', choices=['testclient', 'gunicorn'], default='testclient')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--worker-class', default='gthread')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--output', default='http_load.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = run(args)
+    print_report(results, baseline)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
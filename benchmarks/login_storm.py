@@ -0,0 +1,166 @@
+"""
+Measures control-API latency while a login storm hits /signin.
+
+Starts the app under gunicorn sync workers in a scratch directory, signs a
+control client in, then polls /api/get-rooms-and-appliances, first on its
+own and then while storm threads post wrong passwords. Each scenario runs
+with different authentication settings:
+
+  inline    hashes in the request worker with no admission control
+            (the behaviour before the hashing pool)
+  pooled    hashing pool with a fixed concurrency budget, rate limits off
+  admitted  pool plus the default per-IP and per-account token buckets
+
+Usage: python benchmarks/login_storm.py [--workers 4] [--storm-threads 16]
+       [--seconds 10] [--output login_storm.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+from werkzeug.security import generate_password_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+UNLIMITED = {'LOGIN_IP_BURST': '1000000', 'LOGIN_IP_PER_MINUTE': '1000000',
+             'LOGIN_ACCOUNT_BURST': '1000000', 'LOGIN_ACCOUNT_PER_MINUTE': '1000000'}
+SCENARIOS = {
+    'inline': dict(UNLIMITED, AUTH_HASH_WORKERS='0', AUTH_MAX_CONCURRENT_HASHES='1000'),
+    'pooled': dict(UNLIMITED),
+    'admitted': {},
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 2)
+    return {'count': len(ordered), 'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99),
+            'max_ms': round(ordered[-1] * 1000, 2)}
+
+
+def prepare_workdir(password_hash):
+    from app import create_default_user_data
+
+    workdir = tempfile.mkdtemp(prefix='login-storm-')
+    users = [{'id': '1', 'username': 'bench', 'password_hash': password_hash}]
+    users += [{'id': str(i), 'username': f'victim{i}', 'password_hash': password_hash} for i in range(2, 52)]
+    with open(os.path.join(workdir, 'users.json'), 'w') as f:
+        json.dump(users, f)
+    with open(os.path.join(workdir, 'data.json'), 'w') as f:
+        json.dump({user['id']: create_default_user_data(user['username'], '') for user in users}, f)
+    return workdir
+
+
+def run_scenario(name, env_overrides, args, password_hash):
+    workdir = prepare_workdir(password_hash)
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=ROOT, **env_overrides)
+    server = subprocess.Popen(
+        ['gunicorn', '-w', str(args.workers), '-b', f'127.0.0.1:{port}', '--timeout', '120', 'app:app'],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(200):
+            try:
+                requests.get(base + '/signin', timeout=1)
+                break
+            except requests.RequestException:
+                time.sleep(0.1)
+
+        control = requests.Session()
+        control.post(base + '/signin', data={'username': 'bench', 'password': 'bench-password'})
+
+        def poll(seconds):
+            latencies = []
+            deadline = time.time() + seconds
+            while time.time() < deadline:
+                started = time.perf_counter()
+                response = control.get(base + '/api/get-rooms-and-appliances', timeout=120)
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.status_code
+            return latencies
+
+        baseline = poll(args.seconds / 2)
+
+        outcomes = {}
+        outcomes_lock = threading.Lock()
+        stop = threading.Event()
+
+        def storm(index):
+            session = requests.Session()
+            attempt = 0
+            while not stop.is_set():
+                attempt += 1
+                response = session.post(base + '/signin', allow_redirects=False, timeout=120,
+                                        data={'username': f'victim{2 + (index + attempt) % 50}', 'password': 'wrong'})
+                with outcomes_lock:
+                    outcomes[response.status_code] = outcomes.get(response.status_code, 0) + 1
+
+        threads = [threading.Thread(target=storm, args=(i,), daemon=True) for i in range(args.storm_threads)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        under_storm = poll(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=120)
+
+        return {
+            'env': env_overrides,
+            'control_baseline': percentiles(baseline),
+            'control_under_storm': percentiles(under_storm),
+            'login_responses': {str(code): count for code, count in sorted(outcomes.items())},
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--storm-threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--output', default='login_storm.json')
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    # Importing the app creates its queue databases in the working directory
+    os.chdir(tempfile.mkdtemp(prefix='login-storm-client-'))
+
+    # Victims share the legacy pbkdf2 cost so every wrong guess is as expensive as a real login
+    password_hash = generate_password_hash('bench-password', method='pbkdf2:sha256:600000')
+    results = {'workers': args.workers, 'storm_threads': args.storm_threads, 'cpus': os.cpu_count(), 'scenarios': {}}
+    for name in args.scenarios.split(','):
+        print(f"Running {name}...")
+        results['scenarios'][name] = result = run_scenario(name, SCENARIOS[name], args, password_hash)
+        print(f"  control p50/p95 baseline {result['control_baseline']['p50_ms']}/{result['control_baseline']['p95_ms']} ms, "
+              f"under storm {result['control_under_storm']['p50_ms']}/{result['control_under_storm']['p95_ms']} ms, "
+              f"logins {result['login_responses']}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
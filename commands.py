@@ -0,0 +1,93 @@
+import json
+import time
+import sqlite3
+import threading
+
+# How often a long-poll re-checks the database for commands queued by other workers
+CROSS_WORKER_POLL_INTERVAL = 0.5
+# Commands older than this are dropped undelivered; a switch made long ago shouldn't replay on reconnect
+COMMAND_TTL = 600
+
+
+class CommandQueue:
+    """
+    Durable per-device command queue in SQLite. Every command gets the next
+    sequence number for its device and stays queued until the device acks
+    that sequence number, so commands issued between polls are never lost.
+    Commands not delivered within ttl seconds expire.
+    """
+
+    def __init__(self, db_file, ttl=COMMAND_TTL):
+        self.db_file = db_file
+        self.ttl = ttl
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._version = 0
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS device_commands (
+            device_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            command TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (device_id, seq)
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS device_sequences (
+            device_id TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL
+        )''')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, device_id, command):
+        """Queues a command and returns its sequence number."""
+        return self.enqueue_many(device_id, [command])
+
+    def enqueue_many(self, device_id, commands):
+        """Queues commands in order in one transaction; returns the last sequence number."""
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT last_seq FROM device_sequences WHERE device_id = ?', (device_id,)).fetchone()
+            first = (row[0] if row else 0) + 1
+            seq = first + len(commands) - 1
+            conn.execute('INSERT OR REPLACE INTO device_sequences (device_id, last_seq) VALUES (?, ?)', (device_id, seq))
+            now = time.time()
+            conn.executemany('INSERT INTO device_commands (device_id, seq, command, created_at) VALUES (?, ?, ?, ?)',
+                             [(device_id, first + i, json.dumps(command), now) for i, command in enumerate(commands)])
+        with self._condition:
+            self._version += 1
+            self._condition.notify_all()
+        return seq
+
+    def ack(self, device_id, seq):
+        """Drops every command up to and including seq, and any that have expired."""
+        self._conn().execute('DELETE FROM device_commands WHERE device_id = ? AND (seq <= ? OR created_at < ?)',
+                             (device_id, seq, time.time() - self.ttl))
+
+    def pending(self, device_id, after=0):
+        rows = self._conn().execute(
+            'SELECT seq, command FROM device_commands WHERE device_id = ? AND seq > ? AND created_at >= ? ORDER BY seq',
+            (device_id, after, time.time() - self.ttl))
+        return [dict(json.loads(command), seq=seq) for seq, command in rows]
+
+    def wait(self, device_id, after=0, timeout=0):
+        """
+        Returns the pending commands after seq, holding the call for up to
+        timeout seconds until at least one is queued.
+        """
+        deadline = time.time() + timeout
+        while True:
+            version = self._version
+            commands = self.pending(device_id, after)
+            remaining = deadline - time.time()
+            if commands or remaining <= 0:
+                return commands
+            with self._condition:
+                self._condition.wait_for(lambda: self._version != version,
+                                         min(remaining, CROSS_WORKER_POLL_INTERVAL))
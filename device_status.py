@@ -0,0 +1,152 @@
+import json
+import queue
+import itertools
+import threading
+
+# Raw status messages buffered before the MQTT network thread is held back
+MAX_PENDING_MESSAGES = 100000
+STATES = {'1': True, 'on': True, 'true': True, '0': False, 'off': False, 'false': False}
+
+
+def parse_status(payload):
+    """
+    Decodes a status payload into (user_id, room_id, appliance_id, state)
+    tuples. Devices report either the command format
+    "user_id:room_id:appliance_id[:relay_number]:state" or JSON objects with
+    those keys, one per line; a JSON list of objects is accepted too.
+    Raises ValueError for anything else.
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    payload = payload.strip()
+    if payload.startswith('['):
+        return [_parse_object(item) for item in json.loads(payload)]
+    statuses = []
+    for line in payload.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            statuses.append(_parse_object(json.loads(line)))
+            continue
+        parts = line.split(':')
+        if len(parts) not in (4, 5):
+            raise ValueError(f"Malformed status line: {line!r}")
+        statuses.append((parts[0], parts[1], parts[2], _parse_state(parts[-1])))
+    return statuses
+
+
+def _parse_object(item):
+    try:
+        return (str(item['user_id']), str(item['room_id']), str(item['appliance_id']),
+                _parse_state(item['state']))
+    except (KeyError, TypeError):
+        raise ValueError(f"Malformed status object: {item!r}")
+
+
+def _parse_state(value):
+    if isinstance(value, bool):
+        return value
+    state = STATES.get(str(value).strip().lower())
+    if state is None:
+        raise ValueError(f"Unknown relay state: {value!r}")
+    return state
+
+
+class StatusIngestor:
+    """
+    Decodes device status messages on a pool of worker threads and hands
+    them to apply_batch in coalesced batches of
+    {user_id: {(room_id, appliance_id): state}}, at most once per
+    flush_interval. Only the latest state per appliance survives, so a burst
+    of reports costs one write per home rather than one per message. Messages
+    are numbered as they arrive, so a report decoded late never overrides a
+    newer one that another worker decoded first.
+    """
+
+    def __init__(self, apply_batch, workers=4, flush_interval=0.5, max_pending=MAX_PENDING_MESSAGES):
+        self.apply_batch = apply_batch
+        self.workers = workers
+        self.flush_interval = flush_interval
+        self._messages = queue.Queue(maxsize=max_pending)
+        self._sequence = itertools.count()
+        # {user_id: {(room_id, appliance_id): (sequence, state)}}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._counters = {'received': 0, 'invalid': 0, 'applied': 0, 'batches': 0}
+
+    def submit(self, payload):
+        """
+        Queues a raw payload for decoding. Blocks when the backlog is full,
+        which holds back the MQTT network loop and leaves the broker to buffer.
+        """
+        self._messages.put((next(self._sequence), payload))
+
+    def start(self):
+        for i in range(self.workers):
+            self._threads.append(threading.Thread(target=self._decode_loop, daemon=True))
+        self._threads.append(threading.Thread(target=self._flush_loop, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self.flush()
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._counters, backlog=self._messages.qsize(),
+                        pending=sum(len(states) for states in self._pending.values()))
+
+    def _decode_loop(self):
+        while not self._stopped.is_set():
+            try:
+                sequence, payload = self._messages.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                statuses = parse_status(payload)
+            except (ValueError, UnicodeDecodeError) as e:
+                print(f"Ignoring device status: {e}")
+                with self._lock:
+                    self._counters['invalid'] += 1
+                continue
+            with self._lock:
+                self._counters['received'] += len(statuses)
+                for user_id, room_id, appliance_id, state in statuses:
+                    self._merge(user_id, (room_id, appliance_id), sequence, state)
+
+    def _merge(self, user_id, key, sequence, state):
+        """Records a reported state unless a later message already reported one (call with self._lock held)."""
+        states = self._pending.setdefault(user_id, {})
+        current = states.get(key)
+        if current is None or current[0] <= sequence:
+            states[key] = (sequence, state)
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        try:
+            applied = self.apply_batch({user_id: {key: state for key, (_, state) in states.items()}
+                                        for user_id, states in batch.items()})
+        except Exception as e:
+            print(f"Error applying device status batch: {e}")
+            # Retry next flush; anything reported since is newer and wins
+            with self._lock:
+                for user_id, states in batch.items():
+                    for key, (sequence, state) in states.items():
+                        self._merge(user_id, key, sequence, state)
+            return
+        with self._lock:
+            self._counters['applied'] += applied or 0
+            self._counters['batches'] += 1
@@ -0,0 +1,74 @@
+import json
+import threading
+from collections import deque
+
+# Changes kept per user so reconnecting clients can catch up without a full reload
+FEED_HISTORY = 500
+
+
+class ChangeFeed:
+    """
+    In-process log of recent changes per user. Each change carries the
+    home's revision number, which doubles as its Server-Sent Events id, so
+    subscribers can resume from a Last-Event-ID. Every user has their own
+    condition (all sharing one lock), so a change wakes only the streams
+    of the home it belongs to.
+    """
+
+    def __init__(self, history=FEED_HISTORY):
+        self.history = history
+        self._changes = {}
+        self._lock = threading.Lock()
+        self._conditions = {}
+
+    def _user_condition(self, user_id):
+        condition = self._conditions.get(user_id)
+        if condition is None:
+            condition = self._conditions[user_id] = threading.Condition(self._lock)
+        return condition
+
+    def publish(self, user_id, revision, change):
+        with self._lock:
+            log = self._changes.setdefault(user_id, deque(maxlen=self.history))
+            log.append((revision, change))
+            condition = self._conditions.get(user_id)
+            if condition is not None:
+                condition.notify_all()
+
+    def since(self, user_id, revision):
+        """
+        Returns the changes after revision, or None when some of them have
+        already dropped out of the history and the client must reload.
+        """
+        with self._lock:
+            log = self._changes.get(user_id)
+            if not log:
+                return []
+            if revision < log[0][0] - 1:
+                return None
+            return [(rev, change) for rev, change in log if rev > revision]
+
+    def latest(self, user_id):
+        with self._lock:
+            return self._latest(user_id)
+
+    def _latest(self, user_id):
+        log = self._changes.get(user_id)
+        return log[-1][0] if log else 0
+
+    def wait(self, user_id, revision, timeout):
+        """Blocks until there is a change after revision or timeout passes."""
+        with self._lock:
+            self._user_condition(user_id).wait_for(lambda: self._latest(user_id) > revision, timeout)
+        return self.since(user_id, revision)
+
+
+def format_sse(data, event_id=None, retry=None):
+    """Formats one Server-Sent Events message."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if retry is not None:
+        lines.append(f"retry: {retry}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
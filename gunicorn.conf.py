@@ -0,0 +1,23 @@
+# Gunicorn settings; `gunicorn app:app` reads this file from the working directory.
+#
+# Some requests hold a worker for a long time: every open dashboard keeps an
+# /api/events Server-Sent Events stream open (up to SSE_MAX_DURATION), and
+# ESP check-ins long-poll /api/esp/check-in for up to CHECK_IN_MAX_WAIT (30 s).
+# A sync worker serves one request at a time, so a few dashboards would pin
+# every worker. Run threaded (gthread, the default here) with enough threads
+# for the open streams plus regular traffic, or an async class such as gevent.
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')  # gthread or gevent; never sync
+# Changes reach streams in other workers only at the next keepalive check, so fewer, wider workers are better
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 64))  # Concurrent requests per gthread worker, streams included
+timeout = 120
+graceful_timeout = 35  # Lets a check-in long-poll finish on restart
+
+
+def post_worker_init(worker):
+    # Every worker offers to fire appliance timers; the one holding the leader lock does
+    from app import start_timer_scheduler
+    start_timer_scheduler()
@@ -0,0 +1,33 @@
+import zlib
+import threading
+from contextlib import contextmanager
+
+# Locks the homes are spread over; homes that share one just wait on each other
+HOME_LOCK_STRIPES = 256
+
+
+class HomeLocks:
+    """
+    Serializes read-modify-write cycles on a home within this worker, so a
+    request handler and a background writer (device status, timers) can't
+    overwrite each other's change. Homes map onto a fixed set of striped
+    locks, so memory doesn't grow with the number of homes. Several homes
+    are locked in stripe order, which keeps batch writers from deadlocking.
+    """
+
+    def __init__(self, stripes=HOME_LOCK_STRIPES):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def _stripe(self, user_id):
+        return zlib.crc32(str(user_id).encode()) % len(self._locks)
+
+    @contextmanager
+    def holding(self, user_ids):
+        stripes = sorted({self._stripe(user_id) for user_id in user_ids})
+        for stripe in stripes:
+            self._locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._locks[stripe].release()
@@ -0,0 +1,232 @@
+import time
+import sqlite3
+import threading
+from collections import deque
+from contextlib import ExitStack, nullcontext
+
+# Alerts for the same key within this many seconds are folded into one email
+COALESCE_WINDOW = 60
+# A worker reopens its SMTP connection after this many messages or seconds
+RECONNECT_AFTER_MESSAGES = 100
+RECONNECT_AFTER_SECONDS = 300
+# Idle connections are closed instead of being left to time out server-side
+IDLE_DISCONNECT = 30
+MAX_ATTEMPTS = 5
+# Claims older than this are assumed to belong to a crashed worker
+CLAIM_LEASE = 300
+LATENCY_SAMPLES = 1000
+
+
+class MailQueueFull(Exception):
+    pass
+
+
+class MailQueue:
+    """
+    Bounded outbox in SQLite, drained by a fixed pool of worker threads that
+    each keep one SMTP connection open. Alerts survive restarts. A new alert
+    for a key that already has one waiting is merged into it, raising its
+    count. The next email for a key is held until COALESCE_WINDOW after the
+    previous one, so a burst of detections produces one email per window.
+    """
+
+    def __init__(self, db_file, connect, build_message, workers=2, max_pending=10000,
+                 coalesce_window=COALESCE_WINDOW, context=None):
+        self.db_file = db_file
+        self.connect = connect
+        self.build_message = build_message
+        self.workers = workers
+        self.max_pending = max_pending
+        self.coalesce_window = coalesce_window
+        self.context = context or nullcontext
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._send_times = deque(maxlen=LATENCY_SAMPLES)
+        self._counters = {'queued': 0, 'coalesced': 0, 'sent': 0, 'failed': 0, 'dropped': 0, 'connections': 0}
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS mail_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            attachment BLOB,
+            alerts INTEGER NOT NULL DEFAULT 1,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            available_at REAL NOT NULL,
+            claimed_at REAL
+        )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS mail_outbox_available ON mail_outbox (available_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS mail_outbox_key ON mail_outbox (key)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS mail_last_sent (
+            key TEXT PRIMARY KEY,
+            sent_at REAL NOT NULL
+        )''')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, key, recipient, subject, body, attachment=None):
+        """
+        Queues an alert, or folds it into the one already waiting for key.
+        Returns True when it was coalesced. Raises MailQueueFull when the
+        outbox is at capacity.
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            waiting = conn.execute('SELECT id FROM mail_outbox WHERE key = ? AND claimed_at IS NULL',
+                                   (key,)).fetchone()
+            if waiting:
+                conn.execute('UPDATE mail_outbox SET alerts = alerts + 1 WHERE id = ?', (waiting[0],))
+                coalesced = True
+            else:
+                if conn.execute('SELECT COUNT(*) FROM mail_outbox').fetchone()[0] >= self.max_pending:
+                    raise MailQueueFull(f"Mail outbox is full ({self.max_pending} messages)")
+                row = conn.execute('SELECT sent_at FROM mail_last_sent WHERE key = ?', (key,)).fetchone()
+                available_at = max(now, row[0] + self.coalesce_window) if row else now
+                if conn.execute('SELECT 1 FROM mail_outbox WHERE key = ?', (key,)).fetchone():
+                    # One is being sent right now; this one waits out the window after it
+                    available_at = now + self.coalesce_window
+                conn.execute('''INSERT INTO mail_outbox (key, recipient, subject, body, attachment, created_at, available_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                             (key, recipient, subject, body, attachment, now, available_at))
+                coalesced = False
+        with self._lock:
+            self._counters['coalesced' if coalesced else 'queued'] += 1
+        with self._wakeup:
+            self._wakeup.notify()
+        return coalesced
+
+    def metrics(self):
+        depth = self._conn().execute('SELECT COUNT(*) FROM mail_outbox').fetchone()[0]
+        with self._lock:
+            metrics = dict(self._counters, queue_depth=depth)
+            for name, samples in (('delivery_latency_ms', self._latencies), ('send_ms', self._send_times)):
+                ordered = sorted(samples)
+                if ordered:
+                    metrics[name] = {
+                        'p50': round(ordered[len(ordered) // 2] * 1000, 2),
+                        'p95': round(ordered[int(len(ordered) * 0.95)] * 1000, 2),
+                        'max': round(ordered[-1] * 1000, 2),
+                    }
+        return metrics
+
+    def start(self):
+        # Claims left by a crashed process are picked up again once their lease expires
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=10)
+
+    def _claim(self):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('''SELECT id, key, recipient, subject, body, attachment, alerts, attempts, created_at
+                                  FROM mail_outbox
+                                  WHERE available_at <= ? AND (claimed_at IS NULL OR claimed_at < ?)
+                                  ORDER BY available_at LIMIT 1''', (now, now - CLAIM_LEASE)).fetchone()
+            if row:
+                conn.execute('UPDATE mail_outbox SET claimed_at = ? WHERE id = ?', (now, row[0]))
+        if row is None:
+            return None
+        keys = ('id', 'key', 'recipient', 'subject', 'body', 'attachment', 'alerts', 'attempts', 'created_at')
+        return dict(zip(keys, row))
+
+    def _next_available(self):
+        row = self._conn().execute('SELECT MIN(available_at) FROM mail_outbox WHERE claimed_at IS NULL').fetchone()
+        return row[0]
+
+    def _run(self):
+        with self.context():
+            stack = ExitStack()
+            connection = None
+            opened_at = last_used = 0
+            sent_on_connection = 0
+            while not self._stopped:
+                item = self._claim()
+                if item is None:
+                    if connection and time.time() - last_used > IDLE_DISCONNECT:
+                        stack.close()
+                        connection = None
+                    next_at = self._next_available()
+                    delay = min(max(next_at - time.time(), 0.05), IDLE_DISCONNECT) if next_at else IDLE_DISCONNECT
+                    with self._wakeup:
+                        if not self._stopped:
+                            self._wakeup.wait(delay)
+                    continue
+
+                started = time.time()
+                try:
+                    if connection and (sent_on_connection >= RECONNECT_AFTER_MESSAGES
+                                       or started - opened_at > RECONNECT_AFTER_SECONDS):
+                        stack.close()
+                        connection = None
+                    if connection is None:
+                        stack = ExitStack()
+                        connection = stack.enter_context(self.connect())
+                        opened_at = time.time()
+                        sent_on_connection = 0
+                        with self._lock:
+                            self._counters['connections'] += 1
+                    connection.send(self.build_message(item))
+                except Exception as e:
+                    print(f"Error sending email to {item['recipient']}: {e}")
+                    # Drop the connection; it may be the cause
+                    try:
+                        stack.close()
+                    except Exception:
+                        pass
+                    connection = None
+                    self._retry(item)
+                    continue
+
+                done = time.time()
+                sent_on_connection += 1
+                last_used = done
+                conn = self._conn()
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.execute('DELETE FROM mail_outbox WHERE id = ?', (item['id'],))
+                    conn.execute('INSERT OR REPLACE INTO mail_last_sent (key, sent_at) VALUES (?, ?)',
+                                 (item['key'], done))
+                with self._lock:
+                    self._counters['sent'] += 1
+                    self._latencies.append(done - item['created_at'])
+                    self._send_times.append(done - started)
+                print(f"Email sent successfully to {item['recipient']}!")
+            stack.close()
+
+    def _retry(self, item):
+        attempts = item['attempts'] + 1
+        conn = self._conn()
+        if attempts >= MAX_ATTEMPTS:
+            conn.execute('DELETE FROM mail_outbox WHERE id = ?', (item['id'],))
+            print(f"Giving up on email to {item['recipient']} after {attempts} attempts")
+            with self._lock:
+                self._counters['dropped'] += 1
+            return
+        conn.execute('UPDATE mail_outbox SET attempts = ?, claimed_at = NULL, available_at = ? WHERE id = ?',
+                     (attempts, time.time() + min(5 * 2 ** attempts, 600), item['id']))
+        with self._lock:
+            self._counters['failed'] += 1
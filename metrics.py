@@ -0,0 +1,121 @@
+import bisect
+import threading
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the shape Prometheus expects."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Yields the _bucket, _sum and _count exposition lines."""
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{name}_bucket{format_labels(dict(labels, le=le))} {cumulative}'
+        yield f'{name}_sum{format_labels(labels)} {self.sum:.6f}'
+        yield f'{name}_count{format_labels(labels)} {self.count}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+class RequestMetrics:
+    """
+    Request counts and latency histograms per endpoint, plus histograms of
+    the time spent in named phases (storage, analytics, mqtt, render...).
+    Recording is a dict lookup and a bisect under one lock, cheap enough to
+    leave on. Everything is per process; each gunicorn worker reports its own.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._requests = {}
+        self._latency = {}
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def observe_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._latency.get(endpoint)
+            if histogram is None:
+                histogram = self._latency[endpoint] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def observe_phase(self, phase, seconds):
+        with self._lock:
+            histogram = self._phases.get(phase)
+            if histogram is None:
+                histogram = self._phases[phase] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def render(self, counters=(), gauges=()):
+        """
+        Returns the Prometheus text exposition of the request metrics
+        followed by the given (name, help, value) counters and gauges.
+        """
+        lines = ['# HELP http_requests_total Requests handled, by endpoint, method and status.',
+                 '# TYPE http_requests_total counter']
+        with self._lock:
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append(f'http_requests_total{format_labels({"endpoint": endpoint, "method": method, "status": status})} {count}')
+            lines += ['# HELP http_request_duration_seconds Time to produce a response, by endpoint.',
+                      '# TYPE http_request_duration_seconds histogram']
+            for endpoint, histogram in sorted(self._latency.items()):
+                lines.extend(histogram.samples('http_request_duration_seconds', {'endpoint': endpoint}))
+            lines += ['# HELP request_phase_duration_seconds Time spent inside requests per phase.',
+                      '# TYPE request_phase_duration_seconds histogram']
+            for phase, histogram in sorted(self._phases.items()):
+                lines.extend(histogram.samples('request_phase_duration_seconds', {'phase': phase}))
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            for name, help_text, value in metrics:
+                if value is None:
+                    continue
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+class TimedProxy:
+    """
+    Forwards to target, running each call to the named methods (every
+    method when methods is None) inside timer(phase).
+    """
+
+    def __init__(self, target, phase, timer, methods=None):
+        self._target = target
+        self._phase = phase
+        self._timer = timer
+        self._methods = methods
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr) or (self._methods is not None and name not in self._methods):
+            return attr
+
+        def timed_call(*args, **kwargs):
+            with self._timer(self._phase):
+                return attr(*args, **kwargs)
+        return timed_call
+
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+# Publish latencies kept for the metrics percentiles
+LATENCY_SAMPLES = 1000
+# Messages taken off the queue (or spill file) per publish round
+DRAIN_BATCH = 500
+# Seconds between spill rounds while the broker is down, so bursts share one fsync
+SPILL_INTERVAL = 0.5
+
+
+class MQTTPublisher:
+    """
+    Publishes MQTT messages from a background thread so request handlers
+    never wait on the broker. publish() only appends to an in-memory queue;
+    all disk I/O happens on the background thread. When the queue grows past
+    max_queue or the broker is unreachable, that thread spills messages to a
+    JSON-lines file and replays them in order after reconnecting. The spill
+    file holds at most max_spill messages and the queue twice max_queue;
+    messages beyond either are dropped and counted. paho's network loop
+    reconnects with exponential backoff. The same connection carries any
+    topic subscriptions.
+    """
+
+    def __init__(self, broker, port, qos=1, max_queue=10000, batch_max=1,
+                 spill_file='mqtt_spill.jsonl', max_spill=100000, ack_timeout=10,
+                 min_backoff=1, max_backoff=60):
+        self.broker = broker
+        self.port = port
+        self.qos = qos
+        self.max_queue = max_queue
+        self.batch_max = batch_max
+        self.spill_file = spill_file
+        self.max_spill = max_spill
+        self.ack_timeout = ack_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._connected = threading.Event()
+        self._stopped = False
+        self._spilling = os.path.exists(spill_file)
+        self._spill_depth = self._count_spilled()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._counters = {'published': 0, 'failed': 0, 'spilled': 0, 'dropped': 0, 'reconnects': 0}
+        self._subscriptions = {}
+        self._client = None
+        self._thread = None
+
+    # --- Producer side ---
+
+    def publish(self, topic, payload):
+        """Queues a message; never blocks on the network or the disk."""
+        message = (topic, payload, time.time())
+        with self._lock:
+            if len(self._queue) >= 2 * self.max_queue:
+                self._counters['dropped'] += 1
+            else:
+                self._queue.append(message)
+        self._wakeup.set()
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            metrics = dict(self._counters,
+                           connected=self._connected.is_set(),
+                           queue_depth=len(self._queue),
+                           spill_depth=self._spill_depth)
+        if latencies:
+            metrics['publish_latency_ms'] = {
+                'avg': round(sum(latencies) / len(latencies) * 1000, 2),
+                'p50': round(latencies[len(latencies) // 2] * 1000, 2),
+                'p95': round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+                'max': round(latencies[-1] * 1000, 2),
+            }
+        return metrics
+
+    def subscribe(self, topic, handler, qos=1):
+        """
+        Calls handler(payload) for every message on topic. Handlers run on
+        paho's network thread, so they should only hand the payload off.
+        Subscriptions are renewed on every reconnect.
+        """
+        self._subscriptions[topic] = (handler, qos)
+        if self._client:
+            self._register(topic, handler, qos)
+
+    def _register(self, topic, handler, qos):
+        self._client.message_callback_add(topic, lambda client, userdata, message: handler(message.payload))
+        if self._connected.is_set():
+            self._client.subscribe(topic, qos=qos)
+
+    # --- Lifecycle ---
+
+    def start(self):
+        self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.reconnect_delay_set(self.min_backoff, self.max_backoff)
+        for topic, (handler, qos) in self._subscriptions.items():
+            self._register(topic, handler, qos)
+        self._client.connect_async(self.broker, self.port, 60)
+        self._client.loop_start()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops publishing and spills anything still queued to disk."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=self.ack_timeout)
+        self._spill(self._take_queue())
+        if self._client:
+            self._client.loop_stop()
+            self._client.disconnect()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code == 0:
+            print("Connected to MQTT Broker successfully!")
+            for topic, (handler, qos) in self._subscriptions.items():
+                client.subscribe(topic, qos=qos)
+            self._connected.set()
+            self._wakeup.set()
+        else:
+            print(f"Failed to connect to MQTT Broker, return code {reason_code}")
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        if self._connected.is_set():
+            print(f"Disconnected from MQTT Broker ({reason_code}), reconnecting")
+            with self._lock:
+                self._counters['reconnects'] += 1
+        self._connected.clear()
+        self._wakeup.set()
+
+    # --- Worker ---
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(timeout=1)
+            self._wakeup.clear()
+            if not self._connected.is_set():
+                # Park queued messages on disk until the broker is back
+                self._spill(self._take_queue())
+                time.sleep(SPILL_INTERVAL)
+                continue
+            # Spilled messages are older than anything still queued
+            if self._spilling:
+                self._replay_spill()
+            self._drain_queue()
+
+    def _take_queue(self):
+        with self._lock:
+            messages = list(self._queue)
+            self._queue.clear()
+        return messages
+
+    def _drain_queue(self):
+        while self._connected.is_set() and not self._stopped and not self._spilling:
+            with self._lock:
+                backlog = len(self._queue) > self.max_queue
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), DRAIN_BATCH))]
+            if not batch:
+                return
+            if backlog:
+                # The broker can't keep up; park the backlog on disk and replay it next round
+                self._spill(batch + self._take_queue())
+                self._wakeup.set()
+                return
+            failed = self._send(batch)
+            if failed:
+                self._spill(failed + self._take_queue())
+                return
+
+    def _replay_spill(self):
+        with self._spill_lock:
+            messages = self._read_spill()
+            if os.path.exists(self.spill_file):
+                os.remove(self.spill_file)
+            with self._lock:
+                self._spilling = False
+                self._spill_depth = 0
+        if messages:
+            print(f"Replaying {len(messages)} spilled MQTT messages")
+        for start in range(0, len(messages), DRAIN_BATCH):
+            failed = self._send(messages[start:start + DRAIN_BATCH])
+            if failed:
+                # Unsent messages are older than anything queued meanwhile
+                self._spill(failed + messages[start + DRAIN_BATCH:] + self._take_queue())
+                return
+
+    def _send(self, batch):
+        """
+        Publishes a batch and waits for the broker to acknowledge all of it.
+        With batch_max > 1, consecutive payloads for the same topic are
+        joined with newlines into one message. Returns the messages that
+        could not be confirmed.
+        """
+        groups = []
+        for message in batch:
+            topic, payload, queued_at = message
+            if groups and groups[-1][0] == topic and len(groups[-1][1]) < self.batch_max:
+                groups[-1][1].append(message)
+            else:
+                groups.append((topic, [message]))
+
+        in_flight = []
+        for topic, messages in groups:
+            payload = "\n".join(str(m[1]) for m in messages)
+            info = self._client.publish(topic, payload, qos=self.qos)
+            in_flight.append((info, messages))
+
+        failed = []
+        now = time.time()
+        for info, messages in in_flight:
+            try:
+                info.wait_for_publish(timeout=max(self.ack_timeout - (time.time() - now), 0.1))
+                ok = info.is_published()
+            except (RuntimeError, ValueError):
+                ok = False
+            if not ok:
+                failed.extend(messages)
+                continue
+            done = time.time()
+            with self._lock:
+                self._counters['published'] += len(messages)
+                self._latencies.extend(done - m[2] for m in messages)
+        if failed:
+            with self._lock:
+                self._counters['failed'] += len(failed)
+        return failed
+
+    # --- Spill file (background thread and stop() only) ---
+
+    def _spill(self, messages):
+        if not messages:
+            return
+        with self._spill_lock:
+            kept = messages[:max(0, self.max_spill - self._spill_depth)]
+            if kept:
+                with open(self.spill_file, 'a') as f:
+                    for topic, payload, queued_at in kept:
+                        f.write(json.dumps([topic, payload, queued_at]) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            with self._lock:
+                self._spilling = self._spilling or bool(kept)
+                self._spill_depth += len(kept)
+                self._counters['spilled'] += len(kept)
+                self._counters['dropped'] += len(messages) - len(kept)
+
+    def _read_spill(self):
+        messages = []
+        if not os.path.exists(self.spill_file):
+            return messages
+        with open(self.spill_file) as f:
+            for line in f:
+                try:
+                    messages.append(tuple(json.loads(line)))
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    continue
+        return messages
+
+    def _count_spilled(self):
+        if not os.path.exists(self.spill_file):
+            return 0
+        with open(self.spill_file) as f:
+            return sum(1 for _ in f)
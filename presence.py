@@ -0,0 +1,50 @@
+import threading
+
+# Consecutive positive frames needed before a room counts as occupied
+ON_FRAMES = 3
+# Seconds without a positive frame before an occupied room counts as empty
+OFF_SECONDS = 30
+
+
+class PresenceTracker:
+    """
+    Turns a noisy stream of per-frame detections into presence transitions.
+    Each key (a room, or a whole home) switches on after on_frames
+    consecutive positive frames, and off once no positive frame has been
+    seen for off_seconds. Until the first transition, the state is unknown
+    (None), so a freshly opened camera never causes a write by itself.
+    """
+
+    def __init__(self, on_frames=ON_FRAMES, off_seconds=OFF_SECONDS):
+        self.on_frames = on_frames
+        self.off_seconds = off_seconds
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, samples):
+        """
+        Feeds (timestamp, detected) samples in time order. Returns
+        (present, changed), where changed says whether the samples caused
+        a transition.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                first_time = samples[0][0] if samples else 0
+                state = self._states[key] = {'present': None, 'streak': 0, 'last_seen': first_time}
+            before = state['present']
+            for timestamp, detected in samples:
+                if detected:
+                    state['streak'] += 1
+                    state['last_seen'] = max(state['last_seen'], timestamp)
+                    if state['present'] is not True and state['streak'] >= self.on_frames:
+                        state['present'] = True
+                else:
+                    state['streak'] = 0
+                    if state['present'] is not False and timestamp - state['last_seen'] >= self.off_seconds:
+                        state['present'] = False
+            return state['present'], state['present'] != before and state['present'] is not None
+
+    def forget(self, key):
+        with self._lock:
+            self._states.pop(key, None)
@@ -0,0 +1,212 @@
+import os
+import re
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+
+# Functions kept per saved profile, ordered by self time
+TOP_FUNCTIONS = 40
+PROFILE_NAME_PATTERN = re.compile(r'^[\w.-]+\.(json|prof)$')
+
+
+def describe_code(filename, lineno, name):
+    return f"{os.path.basename(filename)}:{lineno}({name})"
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of registered threads every interval seconds
+    from one background thread. Threads register when a request starts and
+    collect their stack counts when it ends. The sampling thread exits once
+    no thread is registered and is started again by the next begin().
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def begin(self, thread_id):
+        with self._lock:
+            self._active[thread_id] = Counter()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def end(self, thread_id):
+        with self._lock:
+            return self._active.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                frames = sys._current_frames()
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    if stack:
+                        stacks[tuple(reversed(stack))] += 1
+
+
+def summarize_samples(stacks, interval):
+    """Self and cumulative seconds per function from sampled stacks, estimated as samples x interval."""
+    own = Counter()
+    cumulative = Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for code in set(stack):
+            cumulative[code] += count
+    return [{'function': describe_code(*code), 'self_s': round(own[code] * interval, 6),
+             'cumulative_s': round(cumulative[code] * interval, 6)}
+            for code in sorted(cumulative, key=lambda code: (own[code], cumulative[code]), reverse=True)[:TOP_FUNCTIONS]]
+
+
+def summarize_cprofile(profile):
+    stats = pstats.Stats(profile).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:TOP_FUNCTIONS]
+    return [{'function': describe_code(*code), 'self_s': round(tottime, 6), 'cumulative_s': round(cumtime, 6),
+             'calls': calls}
+            for code, (_, calls, tottime, cumtime, _) in ranked]
+
+
+class RequestProfiler:
+    """
+    Profiles requests and keeps the interesting ones in a rotating directory.
+    With sampling on (off by default), every request is stack-sampled while
+    it runs (discarded when the request turns out fast) and requests slower
+    than threshold seconds are saved. A request can also ask for a full cProfile run, which is always
+    saved. Each capture is a JSON summary, plus a .prof file for cProfile
+    runs, and only the newest max_files captures are kept.
+    """
+
+    def __init__(self, directory, threshold=1.0, max_files=200, interval=0.005, sampling=False):
+        self.directory = os.path.abspath(directory)
+        self.threshold = threshold
+        self.max_files = max_files
+        self.sampling = sampling
+        self.sampler = StackSampler(interval)
+        self._write_lock = threading.Lock()
+
+    def begin(self, full=False):
+        """Starts profiling the current thread's request; returns a handle for finish()."""
+        if full:
+            profile = cProfile.Profile()
+            profile.enable()
+            return ('cprofile', profile)
+        if self.sampling:
+            self.sampler.begin(threading.get_ident())
+            return ('sampled', threading.get_ident())
+        return None
+
+    def cancel(self, handle):
+        if handle is None:
+            return
+        kind, state = handle
+        if kind == 'cprofile':
+            state.disable()
+        else:
+            self.sampler.end(state)
+
+    def finish(self, handle, endpoint, method, path, status, elapsed):
+        """Stops profiling and saves the capture if it was requested or the request was slow."""
+        if handle is None:
+            return None
+        kind, state = handle
+        if kind == 'cprofile':
+            state.disable()
+            functions = summarize_cprofile(state)
+        else:
+            stacks = self.sampler.end(state)
+            if elapsed < self.threshold or not stacks:
+                return None
+            functions = summarize_samples(stacks, self.sampler.interval)
+
+        captured_at = time.time()
+        # Names sort by capture time, which is what rotation relies on
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(captured_at)) + f"{int(captured_at * 1000) % 1000:03d}"
+        name = f"{stamp}-{int(elapsed * 1000)}ms-{endpoint}-{os.getpid()}-{threading.get_ident() % 100000}"
+        summary = {
+            'name': name,
+            'captured_at': captured_at,
+            'endpoint': endpoint,
+            'method': method,
+            'path': path,
+            'status': status,
+            'duration_ms': round(elapsed * 1000, 2),
+            'kind': kind,
+            'functions': functions,
+        }
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if kind == 'cprofile':
+                state.dump_stats(os.path.join(self.directory, name + '.prof'))
+                summary['prof_file'] = name + '.prof'
+            with open(os.path.join(self.directory, name + '.json'), 'w') as f:
+                json.dump(summary, f)
+            self._rotate()
+        return name
+
+    def _rotate(self):
+        captures = sorted(entry for entry in os.listdir(self.directory) if entry.endswith('.json'))
+        for stale in captures[:max(0, len(captures) - self.max_files)]:
+            for suffix in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, stale[:-5] + suffix))
+                except FileNotFoundError:
+                    pass
+
+    # --- Reports ---
+    def captures(self):
+        """Saved capture summaries from every worker, newest first."""
+        try:
+            names = sorted((entry for entry in os.listdir(self.directory) if entry.endswith('.json')), reverse=True)
+        except FileNotFoundError:
+            return []
+        captures = []
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    captures.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Rotated away or still being written
+        return captures
+
+    def slowest_endpoints(self, top=10, functions=10):
+        """The endpoints with the slowest captures, each with its hot functions summed over its captures."""
+        by_endpoint = {}
+        for capture in self.captures():
+            entry = by_endpoint.setdefault(capture['endpoint'], {
+                'endpoint': capture['endpoint'], 'captures': 0, 'max_ms': 0, 'total_ms': 0, 'self_s': Counter()})
+            entry['captures'] += 1
+            entry['max_ms'] = max(entry['max_ms'], capture['duration_ms'])
+            entry['total_ms'] += capture['duration_ms']
+            for function in capture['functions']:
+                entry['self_s'][function['function']] += function['self_s']
+        ranked = sorted(by_endpoint.values(), key=lambda entry: entry['max_ms'], reverse=True)[:top]
+        return [{'endpoint': entry['endpoint'],
+                 'captures': entry['captures'],
+                 'max_ms': entry['max_ms'],
+                 'avg_ms': round(entry['total_ms'] / entry['captures'], 2),
+                 'hot_functions': [{'function': function, 'self_s': round(seconds, 6)}
+                                   for function, seconds in entry['self_s'].most_common(functions)]}
+                for entry in ranked]
+
+    def path(self, name):
+        """Absolute path of a saved capture file, or None if name isn't one."""
+        if not PROFILE_NAME_PATTERN.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.exists(path) else None
@@ -0,0 +1,133 @@
+import io
+import os
+import hashlib
+import tempfile
+import warnings
+import threading
+from collections import deque
+
+from PIL import Image, UnidentifiedImageError
+
+# Compacted snapshots are re-encoded as JPEG no larger than this on either side
+MAX_DIMENSION = 960
+JPEG_QUALITY = 75
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+UPLOAD_CHUNK = 64 * 1024
+# Frames whose 64-bit difference hashes differ in at most this many bits count as the same scene
+NEAR_DUPLICATE_BITS = 6
+RECENT_FRAMES = 32
+
+
+class SnapshotTooLarge(Exception):
+    pass
+
+
+def difference_hash(image):
+    """64-bit dHash: compares neighbouring pixels of a 9x8 grayscale thumbnail."""
+    pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+class SnapshotStore:
+    """
+    Content-addressed store for detection snapshots. Uploads are streamed to
+    disk, downscaled and re-encoded, and saved under the SHA-256 of the
+    compact JPEG, so identical frames are stored once. A frame that is
+    nearly identical to one of the same owner's recent frames reuses that
+    frame instead of adding a new file. Each snapshot keeps a list of the
+    owners who uploaded it, and only they may read it back.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + '.jpg')
+
+    def _owners_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + '.owners')
+
+    def owns(self, owner, digest):
+        try:
+            with open(self._owners_path(digest)) as f:
+                return str(owner) in f.read().split()
+        except FileNotFoundError:
+            return False
+
+    def _add_owner(self, owner, digest):
+        if not self.owns(owner, digest):
+            # One short O_APPEND write per owner, so concurrent workers don't interleave lines
+            with open(self._owners_path(digest), 'a') as f:
+                f.write(f"{owner}\n")
+
+    def read(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+    def put_stream(self, owner, stream):
+        """Streams an upload to a temporary file and stores it; returns (digest, reused)."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.upload')
+        try:
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(UPLOAD_CHUNK)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_BYTES:
+                        raise SnapshotTooLarge(f"Snapshots are limited to {MAX_UPLOAD_BYTES} bytes")
+                    f.write(chunk)
+            with open(tmp_path, 'rb') as f:
+                return self._store(owner, f)
+        finally:
+            os.remove(tmp_path)
+
+    def put_bytes(self, owner, data):
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise SnapshotTooLarge(f"Snapshots are limited to {MAX_UPLOAD_BYTES} bytes")
+        return self._store(owner, io.BytesIO(data))
+
+    def _store(self, owner, source):
+        try:
+            with warnings.catch_warnings():
+                # Images past Pillow's pixel limit are rejected, not just warned about
+                warnings.simplefilter('error', Image.DecompressionBombWarning)
+                image = Image.open(source)
+                image.draft('RGB', (MAX_DIMENSION, MAX_DIMENSION))  # Lets JPEG decode at reduced size
+                image = image.convert('RGB')
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+            raise ValueError(f"Not a readable image: {e}")
+        image.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
+        frame_hash = difference_hash(image)
+
+        with self._lock:
+            recent = self._recent.setdefault(owner, deque(maxlen=RECENT_FRAMES))
+            for known_hash, digest in recent:
+                if bin(known_hash ^ frame_hash).count('1') <= NEAR_DUPLICATE_BITS and os.path.exists(self.path(digest)):
+                    self._add_owner(owner, digest)
+                    return digest, True
+
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        data = output.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        reused = os.path.exists(path)
+        if not reused:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self._add_owner(owner, digest)
+        with self._lock:
+            self._recent[owner].append((frame_hash, digest))
+        return digest, reused
@@ -158,23 +158,64 @@ const fetchRoomsAndAppliances = async () => {
         if (!response.ok) throw new Error('Failed to fetch rooms and appliances');
         
         const rooms = await response.json();
-        allRoomsData = rooms;
-        renderRooms(rooms);
-        
-        if (currentRoomId) {
-            const room = rooms.find(r => r.id === currentRoomId);
-            if (room) {
-                renderAppliances(room.appliances, room.name);
-            } else {
-                showRoomsView();
-            }
-        }
+        showRoomsData(rooms);
     } catch (error) {
         console.error('Error fetching data:', error);
         showNotification('Failed to load data.', 'off');
     }
 };
 
+const showRoomsData = (rooms) => {
+    allRoomsData = rooms;
+    renderRooms(rooms);
+    
+    if (currentRoomId) {
+        const room = rooms.find(r => r.id === currentRoomId);
+        if (room) {
+            renderAppliances(room.appliances, room.name);
+        } else {
+            showRoomsView();
+        }
+    }
+};
+
+// Applies one change pushed by /api/events to the local copy of the rooms
+const applyRoomChange = (rooms, change) => {
+    if (change.type === 'rooms') {
+        return change.rooms;
+    }
+    if (change.type === 'room') {
+        const exists = rooms.some(r => r.id === change.room.id);
+        return exists ? rooms.map(r => r.id === change.room.id ? change.room : r) : [...rooms, change.room];
+    }
+    if (change.type === 'appliance') {
+        return rooms.map(r => {
+            if (r.id !== change.room_id) return r;
+            const exists = r.appliances.some(a => a.id === change.appliance.id);
+            const appliances = exists
+                ? r.appliances.map(a => a.id === change.appliance.id ? change.appliance : a)
+                : [...r.appliances, change.appliance];
+            return { ...r, appliances };
+        });
+    }
+    return rooms;
+};
+
+// Server pushes changes as they happen; fall back to polling without EventSource
+const subscribeToRoomChanges = () => {
+    if (!window.EventSource) {
+        fetchRoomsAndAppliances();
+        setInterval(fetchRoomsAndAppliances, 3000);
+        return;
+    }
+    const source = new EventSource('/api/events');
+    source.onmessage = (event) => {
+        const { changes } = JSON.parse(event.data);
+        if (!changes.length) return;
+        showRoomsData(changes.reduce(applyRoomChange, allRoomsData));
+    };
+};
+
 const showRoomsView = () => {
     currentRoomId = null;
     document.getElementById('rooms-view').classList.remove('hidden');
@@ -259,7 +300,7 @@ const updateTimerDisplay = (card, appliance) => {
                 timerElement.textContent = `Timer Off`;
                 clearInterval(timerIntervals[appliance.id]);
                 cancelButton.classList.add('hidden');
-                sendApplianceState(currentRoomId, appliance.id, false);
+                // The server switches the appliance off and pushes the change
                 toggleInput.checked = false;
             }
         };
@@ -774,9 +815,8 @@ const initModalsAndListeners = () => {
 };
 
 // Initialize application
-window.addEventListener('load', async () => {
-    await fetchRoomsAndAppliances();
-    setInterval(fetchRoomsAndAppliances, 3000);
+window.addEventListener('load', () => {
+    subscribeToRoomChanges();
     initModalsAndListeners();
     // loadModel(); // Uncomment when model loading function is available
 });
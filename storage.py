@@ -0,0 +1,539 @@
+import os
+import copy
+import json
+import time
+import atexit
+import sqlite3
+import tempfile
+import threading
+from collections import defaultdict
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines
+    fcntl = None
+
+# Fields the user directory can look accounts up by
+USER_LOOKUP_FIELDS = ('username', 'email', 'google_id', 'github_id')
+
+# Seconds the write-behind thread waits so bursts of writes reach disk as one
+WRITE_BEHIND_DELAY = 0.5
+
+
+class HomeConflict(Exception):
+    """
+    Raised by save_homes when homes were saved by someone else since they
+    were read; user_ids names them. The other homes in the call were saved.
+    """
+
+    def __init__(self, user_ids):
+        super().__init__(f"Homes changed concurrently: {', '.join(map(str, user_ids))}")
+        self.user_ids = list(user_ids)
+
+
+class CachedJSONFile:
+    """
+    Keeps a parsed JSON file in memory, revalidating it against the file's
+    mtime and size instead of re-parsing it on every read. Changed keys are
+    tracked so writes from other processes can be merged before flushing.
+    """
+
+    def __init__(self, path, empty):
+        self.path = path
+        self.empty = empty
+        self.payload = None
+        self.stamp = None
+        self.generation = 0
+        self.dirty = set()
+        self.replaced = False
+        self.bytes_read = 0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _key(self, item):
+        return item['id'] if isinstance(self.empty, list) else item
+
+    def _merge(self, disk):
+        """Re-applies our unflushed changes on top of what is on disk."""
+        if self.replaced:
+            return self.payload
+        if isinstance(self.empty, list):
+            # Only records we changed win; everyone else's come from disk
+            ours = {item['id']: item for item in self.payload if item['id'] in self.dirty}
+            merged = [ours.get(item['id'], item) for item in disk]
+            known = {item['id'] for item in disk}
+            merged.extend(ours[key] for key in self.dirty if key in ours and key not in known)
+            return merged
+        for key in self.dirty:
+            if key in self.payload:
+                disk[key] = self.payload[key]
+            else:
+                disk.pop(key, None)
+        return disk
+
+    def load(self):
+        stamp = self._stat()
+        if stamp is None and self.payload is None:
+            write_atomic(self.path, json.dumps(self.empty))
+            stamp = self._stat()
+        if self.payload is None or (stamp is not None and stamp != self.stamp):
+            with open(self.path, 'r') as f:
+                disk = json.load(f)
+            self.bytes_read += stamp[1] if stamp else 0
+            if self.payload is not None and (self.dirty or self.replaced):
+                disk = self._merge(disk)
+            self.payload = disk
+            self.stamp = stamp
+            self.generation += 1
+        return self.payload
+
+    def dump(self):
+        """Returns the serialized payload and marks it as clean."""
+        text = json.dumps(self.load(), indent=4)
+        self.dirty.clear()
+        self.replaced = False
+        return text
+
+    @property
+    def pending(self):
+        return bool(self.dirty) or self.replaced
+
+
+def write_atomic(path, text):
+    """Writes text to a temp file next to path, then swaps it in with os.replace."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class JSONStorage:
+    """
+    Stores every home in data.json and every account in users.json. Both
+    files are cached in memory per worker; writes land in the cache at once
+    and a write-behind thread coalesces them into atomic file replacements.
+    """
+
+    def __init__(self, data_file, users_file, write_delay=WRITE_BEHIND_DELAY):
+        self.data_file = data_file
+        self.users_file = users_file
+        self.write_delay = write_delay
+        self._data = CachedJSONFile(data_file, {})
+        self._users = CachedJSONFile(users_file, [])
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer = None
+        self._directory = None
+        self._directory_key = None
+        self._bytes_written = 0
+        atexit.register(self.flush)
+
+    # --- Write-behind ---
+    def _schedule_flush(self):
+        self._wake.set()
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_behind_loop, daemon=True)
+            self._writer.start()
+
+    def _write_behind_loop(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.write_delay)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing JSON storage: {e}")
+
+    def flush(self):
+        """Writes any pending changes to disk."""
+        with self._flush_lock:
+            for cached in (self._users, self._data):
+                if not cached.pending:
+                    continue
+                # The file lock keeps other workers from flushing between our merge and replace
+                with open(cached.path + '.lock', 'a') as lock_file:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    with self._lock:
+                        text = cached.dump()
+                    write_atomic(cached.path, text)
+                    with self._lock:
+                        cached.stamp = cached._stat()
+                        self._bytes_written += len(text)
+
+    def metrics(self):
+        """Bytes parsed from and written to the JSON files by this process."""
+        return {'bytes_read': self._data.bytes_read + self._users.bytes_read,
+                'bytes_written': self._bytes_written}
+
+    # --- Account indexes ---
+    def _user_directory(self):
+        """
+        Returns the in-memory account indexes, rebuilding them only when
+        users.json or data.json was reloaded from disk.
+        """
+        self._users.load()
+        self._data.load()
+        key = (self._users.generation, self._data.generation)
+        if self._directory is None or key != self._directory_key:
+            directory = {'id': {}, 'email_of': {}}
+            for field in USER_LOOKUP_FIELDS:
+                directory[field] = defaultdict(list)
+            for user in self._users.payload:
+                self._index_user(directory, user)
+            for user_id, home in self._data.payload.items():
+                self._index_email(directory, user_id, home)
+            self._directory = directory
+            self._directory_key = key
+        return self._directory
+
+    def _index_user(self, directory, record):
+        old = directory['id'].get(record['id'])
+        if old is not None:
+            for field in ('username', 'google_id', 'github_id'):
+                entries = directory[field].get(old.get(field))
+                if entries and record['id'] in entries:
+                    entries.remove(record['id'])
+        directory['id'][record['id']] = record
+        for field in ('username', 'google_id', 'github_id'):
+            if record.get(field) is not None:
+                directory[field][record[field]].append(record['id'])
+
+    def _index_email(self, directory, user_id, home):
+        old_email = directory['email_of'].pop(user_id, None)
+        if old_email is not None:
+            directory['email'][old_email].remove(user_id)
+        email = _home_email(home)
+        if email:
+            directory['email'][email].append(user_id)
+            directory['email_of'][user_id] = email
+
+    # --- Homes ---
+    def load_all(self):
+        with self._lock:
+            return copy.deepcopy(self._data.load())
+
+    def save_all(self, data):
+        with self._lock:
+            self._data.load()
+            self._data.payload = copy.deepcopy(data)
+            self._data.replaced = True
+            self._directory = None
+        self._schedule_flush()
+
+    def get_home(self, user_id):
+        with self._lock:
+            return copy.deepcopy(self._data.load().get(user_id))
+
+    def get_home_revision(self, user_id):
+        with self._lock:
+            return (self._data.load().get(user_id) or {}).get('revision', 0)
+
+    def save_home(self, user_id, home, expected=None):
+        self.save_homes({user_id: home}, None if expected is None else {user_id: expected})
+
+    def save_homes(self, homes, expected=None):
+        """
+        Saves homes, {user_id: home}. With expected, {user_id: revision}, a
+        home is only saved while its stored revision is still the one it
+        was read at; see HomeConflict. Other workers' unflushed writes can't
+        be seen here, so the file backend catches conflicts once they flush.
+        """
+        conflicts = []
+        with self._lock:
+            directory = self._user_directory()
+            for user_id, home in homes.items():
+                if expected is not None and user_id in expected:
+                    if (self._data.payload.get(user_id) or {}).get('revision', 0) != expected[user_id]:
+                        conflicts.append(user_id)
+                        continue
+                self._data.payload[user_id] = copy.deepcopy(home)
+                self._data.dirty.add(user_id)
+                self._index_email(directory, user_id, home)
+        self._schedule_flush()
+        if conflicts:
+            raise HomeConflict(conflicts)
+
+    def iter_homes(self):
+        with self._lock:
+            user_ids = list(self._data.load())
+        for user_id in user_ids:
+            home = self.get_home(user_id)
+            if home is not None:
+                yield user_id, home
+
+    # --- Accounts ---
+    def load_users(self):
+        with self._lock:
+            return copy.deepcopy(self._users.load())
+
+    def save_users(self, users):
+        with self._lock:
+            self._users.load()
+            self._users.payload = copy.deepcopy(users)
+            self._users.replaced = True
+            self._directory = None
+        self._schedule_flush()
+
+    def user_count(self):
+        with self._lock:
+            return len(self._user_directory()['id'])
+
+    def next_user_id(self):
+        with self._lock:
+            ids = [int(user_id) for user_id in self._user_directory()['id'] if user_id.isdigit()]
+        return str(max(ids) + 1) if ids else "1"
+
+    def get_user(self, user_id):
+        with self._lock:
+            record = self._user_directory()['id'].get(user_id)
+            return dict(record) if record else None
+
+    def find_users(self, field, value):
+        if field not in USER_LOOKUP_FIELDS:
+            raise ValueError(f"Users can't be looked up by {field}")
+        with self._lock:
+            directory = self._user_directory()
+            return [dict(directory['id'][user_id]) for user_id in directory[field].get(value, [])
+                    if user_id in directory['id']]
+
+    def find_user(self, field, value):
+        return next(iter(self.find_users(field, value)), None)
+
+    def save_user(self, record):
+        record = dict(record)
+        with self._lock:
+            directory = self._user_directory()
+            users = self._users.payload
+            for i, user in enumerate(users):
+                if user['id'] == record['id']:
+                    users[i] = record
+                    break
+            else:
+                users.append(record)
+            self._users.dirty.add(record['id'])
+            self._index_user(directory, record)
+        self._schedule_flush()
+
+
+class SQLiteStorage:
+    """
+    Stores one row per home and one row per account in an SQLite database
+    running in WAL mode, so reading or updating a home only touches that row
+    and concurrent gunicorn workers don't overwrite each other's homes.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._io_lock = threading.Lock()
+        self._bytes_read = 0
+        self._bytes_written = 0
+        self._create_schema()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _tally(self, read=0, written=0):
+        with self._io_lock:
+            self._bytes_read += read
+            self._bytes_written += written
+
+    def metrics(self):
+        """Bytes of home and account JSON read from and written to the database by this process."""
+        with self._io_lock:
+            return {'bytes_read': self._bytes_read, 'bytes_written': self._bytes_written}
+
+    def _create_schema(self):
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS homes (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL,
+            record TEXT NOT NULL
+        )''')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+        missing = [field for field in USER_LOOKUP_FIELDS if field not in columns]
+        for field in missing:
+            conn.execute(f'ALTER TABLE users ADD COLUMN {field}')
+        for field in USER_LOOKUP_FIELDS:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS users_{field} ON users ({field})')
+        if missing:
+            # Databases created before the directory columns existed need backfilling
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                for seq, record in conn.execute('SELECT seq, record FROM users').fetchall():
+                    self._insert_user(conn, json.loads(record), seq)
+
+    # --- Homes ---
+    def load_all(self):
+        return dict(self.iter_homes())
+
+    def save_all(self, data):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM homes WHERE user_id NOT IN (%s)' % ','.join('?' * len(data)), list(data))
+            rows = [(user_id, json.dumps(home)) for user_id, home in data.items()]
+            conn.executemany('INSERT OR REPLACE INTO homes (user_id, data) VALUES (?, ?)', rows)
+        self._tally(written=sum(len(text) for _, text in rows))
+
+    def get_home(self, user_id):
+        row = self._conn().execute('SELECT data FROM homes WHERE user_id = ?', (user_id,)).fetchone()
+        if not row:
+            return None
+        self._tally(read=len(row[0]))
+        return json.loads(row[0])
+
+    def get_home_revision(self, user_id):
+        row = self._conn().execute("SELECT json_extract(data, '$.revision') FROM homes WHERE user_id = ?",
+                                   (user_id,)).fetchone()
+        return row[0] or 0 if row else 0
+
+    def save_home(self, user_id, home, expected=None):
+        self.save_homes({user_id: home}, None if expected is None else {user_id: expected})
+
+    def save_homes(self, homes, expected=None):
+        """
+        Saves homes, {user_id: home}. With expected, {user_id: revision}, a
+        home is only written while its stored revision is still the one it
+        was read at (a missing home counts as revision 0); see HomeConflict.
+        """
+        expected = expected or {}
+        conflicts = []
+        written = {}
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for user_id, home in homes.items():
+                text = json.dumps(home)
+                if user_id not in expected:
+                    conn.execute('INSERT OR REPLACE INTO homes (user_id, data) VALUES (?, ?)', (user_id, text))
+                elif not (conn.execute("UPDATE homes SET data = ? WHERE user_id = ? "
+                                       "AND COALESCE(json_extract(data, '$.revision'), 0) = ?",
+                                       (text, user_id, expected[user_id])).rowcount
+                          or expected[user_id] == 0 and conn.execute(
+                              'INSERT OR IGNORE INTO homes (user_id, data) VALUES (?, ?)', (user_id, text)).rowcount):
+                    conflicts.append(user_id)
+                    continue
+                written[user_id] = text
+            # Keep the directory's email column in step with the user settings
+            conn.executemany('UPDATE users SET email = ? WHERE id = ? AND email IS NOT ?',
+                             [(_home_email(homes[user_id]), user_id, _home_email(homes[user_id])) for user_id in written])
+        self._tally(written=sum(len(text) for text in written.values()))
+        if conflicts:
+            raise HomeConflict(conflicts)
+
+    def iter_homes(self):
+        for user_id, data in self._conn().execute('SELECT user_id, data FROM homes'):
+            self._tally(read=len(data))
+            yield user_id, json.loads(data)
+
+    # --- Accounts ---
+    def load_users(self):
+        rows = self._conn().execute('SELECT record FROM users ORDER BY seq').fetchall()
+        self._tally(read=sum(len(record) for (record,) in rows))
+        return [json.loads(record) for (record,) in rows]
+
+    def _insert_user(self, conn, record, seq):
+        home = conn.execute('SELECT data FROM homes WHERE user_id = ?', (record['id'],)).fetchone()
+        email = _home_email(json.loads(home[0])) if home else None
+        text = json.dumps(record)
+        conn.execute('''INSERT OR REPLACE INTO users (id, seq, record, username, email, google_id, github_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                     (record['id'], seq, text, record.get('username'), email,
+                      record.get('google_id'), record.get('github_id')))
+        self._tally(written=len(text))
+
+    def save_users(self, users):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM users')
+            for i, user in enumerate(users):
+                self._insert_user(conn, user, i)
+
+    def user_count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def next_user_id(self):
+        row = self._conn().execute("SELECT MAX(CAST(id AS INTEGER)) FROM users WHERE id GLOB '[0-9]*'").fetchone()
+        return str(row[0] + 1) if row[0] is not None else "1"
+
+    def get_user(self, user_id):
+        row = self._conn().execute('SELECT record FROM users WHERE id = ?', (user_id,)).fetchone()
+        if not row:
+            return None
+        self._tally(read=len(row[0]))
+        return json.loads(row[0])
+
+    def find_users(self, field, value):
+        if field not in USER_LOOKUP_FIELDS:
+            raise ValueError(f"Users can't be looked up by {field}")
+        rows = self._conn().execute(f'SELECT record FROM users WHERE {field} = ? ORDER BY seq', (value,)).fetchall()
+        self._tally(read=sum(len(record) for (record,) in rows))
+        return [json.loads(record) for (record,) in rows]
+
+    def find_user(self, field, value):
+        return next(iter(self.find_users(field, value)), None)
+
+    def save_user(self, record):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT seq FROM users WHERE id = ?', (record['id'],)).fetchone()
+            if row:
+                seq = row[0]
+            else:
+                seq = conn.execute('SELECT COALESCE(MAX(seq), -1) + 1 FROM users').fetchone()[0]
+            self._insert_user(conn, record, seq)
+
+
+def _home_email(home):
+    return home.get('user_settings', {}).get('email') or None
+
+
+def create_storage(backend, data_file, users_file, db_file, write_delay=WRITE_BEHIND_DELAY):
+    """Returns the storage backend selected by name ('json' or 'sqlite')."""
+    if backend == 'sqlite':
+        return SQLiteStorage(db_file)
+    if backend == 'json':
+        return JSONStorage(data_file, users_file, write_delay)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def migrate_json_to_sqlite(data_file, users_file, db_file):
+    """Imports data.json and users.json into the SQLite store."""
+    source = JSONStorage(data_file, users_file, write_delay=0)
+    target = SQLiteStorage(db_file)
+    users = source.load_users()
+    homes = source.load_all()
+    target.save_homes(homes)
+    target.save_users(users)
+    return len(users), len(homes)
@@ -0,0 +1,131 @@
+import os
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from timeseries import SegmentStore, TimeSeries, to_epoch_hours
+
+HOURS_PER_YEAR = 8766
+# Standby load every home draws, before the household size factor
+BASE_LOAD = 20.0
+# Spread of household size; a home's loads are all scaled by a lognormal factor
+HOUSEHOLD_SIGMA = 0.25
+NOISE = 2.0
+# Homes generated per task handed to a worker process
+CHUNK_HOMES = 25
+
+# Monday first
+WEEKDAY_FACTORS = np.array([0.97, 0.96, 0.96, 0.97, 1.02, 1.15, 1.17], dtype=np.float32)
+
+# Peak day of year for the seasonal curves
+SEASON_PEAKS = {'heating': 15, 'cooling': 196}
+
+
+def _curve(*points):
+    """Builds a 24-hour curve by linear interpolation between (hour, value) points."""
+    hours, values = zip(*points)
+    return np.interp(np.arange(24), hours, values, period=24).astype(np.float32)
+
+
+# Each appliance runs in a given hour with probability duty[hour] x weekday x season,
+# drawing power while it does. owned is the share of homes that have one.
+APPLIANCE_PROFILES = {
+    'fridge': {'power': 8, 'owned': 1.0, 'duty': _curve((0, 0.45), (12, 0.55)),
+               'weekend': 1.0, 'season': ('cooling', 0.2)},
+    'lighting': {'power': 12, 'owned': 1.0, 'duty': _curve((1, 0.05), (6, 0.3), (9, 0.1), (17, 0.4), (20, 0.9), (23, 0.4)),
+                 'weekend': 1.05, 'season': ('heating', 0.4)},
+    'heating': {'power': 60, 'owned': 0.5, 'duty': _curve((3, 0.2), (7, 0.8), (11, 0.4), (18, 0.9), (22, 0.5)),
+                'weekend': 1.1, 'season': ('heating', 1.0)},
+    'cooling': {'power': 50, 'owned': 0.4, 'duty': _curve((4, 0.1), (10, 0.3), (15, 0.9), (19, 0.7), (23, 0.3)),
+                'weekend': 1.1, 'season': ('cooling', 1.0)},
+    'cooking': {'power': 20, 'owned': 1.0, 'duty': _curve((3, 0.0), (7, 0.35), (9, 0.05), (12, 0.3), (14, 0.05), (18, 0.6), (21, 0.05)),
+                'weekend': 1.2, 'season': None},
+    'laundry': {'power': 25, 'owned': 0.85, 'duty': _curve((6, 0.0), (9, 0.1), (14, 0.12), (20, 0.08), (23, 0.0)),
+                'weekend': 2.0, 'season': None},
+    'entertainment': {'power': 10, 'owned': 0.95, 'duty': _curve((1, 0.05), (7, 0.1), (13, 0.2), (20, 0.85), (23, 0.5)),
+                      'weekend': 1.3, 'season': ('heating', 0.2)},
+}
+
+
+def season_curve(day_of_year, kind):
+    """0..1 seasonal intensity peaking at SEASON_PEAKS[kind] (northern hemisphere)."""
+    phase = 2 * np.pi * (day_of_year - SEASON_PEAKS[kind]) / 365.25
+    return np.clip(np.cos(phase), 0, None).astype(np.float32)
+
+
+def current_hour():
+    return to_epoch_hours(datetime.now().replace(minute=0, second=0, microsecond=0))
+
+
+def generate_home_series(seed, index, years=1, end_hour=None, profiles=APPLIANCE_PROFILES):
+    """
+    Returns a TimeSeries of hourly consumption for one synthetic home,
+    ending at end_hour (the current hour by default). The same seed and
+    index always give the same series; seed=None draws fresh entropy.
+    """
+    rng = np.random.default_rng(None if seed is None else [seed, index])
+    end_hour = current_hour() if end_hour is None else end_hour
+    count = int(years * HOURS_PER_YEAR)
+    hours = np.arange(end_hour - count + 1, end_hour + 1, dtype=np.int32)
+
+    days = hours // 24
+    hour_of_day = hours % 24
+    weekday = (days + 3) % 7
+    day_of_year = (hours.astype('datetime64[h]') - hours.astype('datetime64[h]').astype('datetime64[Y]')).astype(np.int64) // 24
+    is_weekend = weekday >= 5
+    weekday_factor = WEEKDAY_FACTORS[weekday]
+
+    household = np.float32(rng.lognormal(0, HOUSEHOLD_SIGMA))
+    consumption = np.full(count, BASE_LOAD, dtype=np.float32)
+    seasons = {}
+    for profile in profiles.values():
+        if rng.random() >= profile['owned']:
+            continue
+        probability = profile['duty'][hour_of_day] * weekday_factor
+        if profile['weekend'] != 1.0:
+            probability = np.where(is_weekend, probability * np.float32(profile['weekend']), probability)
+        if profile['season']:
+            kind, amplitude = profile['season']
+            if kind not in seasons:
+                seasons[kind] = season_curve(day_of_year, kind)
+            probability = probability * ((1 - amplitude) + amplitude * seasons[kind])
+        running = rng.random(count, dtype=np.float32) < probability
+        power = np.float32(profile['power'] * rng.uniform(0.8, 1.2))
+        consumption += running * power * rng.uniform(0.7, 1.3, count).astype(np.float32)
+
+    consumption *= household
+    consumption += rng.normal(0, NOISE, count).astype(np.float32)
+    np.clip(consumption, 0, None, out=consumption)
+    return TimeSeries(hours, np.round(consumption, 2))
+
+
+def _generate_chunk(root, seed, indexes, first_id, years, end_hour):
+    store = SegmentStore(root)
+    readings = 0
+    for index in indexes:
+        series = generate_home_series(seed, index, years, end_hour)
+        store.write_series(str(first_id + index), series.hours, series.consumption)
+        readings += len(series)
+    return len(indexes), readings
+
+
+def generate_homes(root, homes, years=1, seed=0, first_id=1, workers=None, progress=None):
+    """
+    Writes synthetic readings for homes first_id .. first_id + homes - 1
+    straight into the per-home segment store under root, generating homes
+    in parallel worker processes. Returns the total number of readings.
+    """
+    end_hour = current_hour()
+    chunks = [range(start, min(start + CHUNK_HOMES, homes)) for start in range(0, homes, CHUNK_HOMES)]
+    workers = workers or os.cpu_count() or 1
+    done = readings = 0
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_generate_chunk, root, seed, chunk, first_id, years, end_hour) for chunk in chunks]
+        for future in futures:
+            home_count, reading_count = future.result()
+            done += home_count
+            readings += reading_count
+            if progress:
+                progress(done, homes)
+    return readings
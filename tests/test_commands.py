@@ -0,0 +1,29 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from commands import CommandQueue
+
+
+def test_commands_are_delivered_in_order(tmp_path):
+    queue = CommandQueue(str(tmp_path / 'commands.db'))
+    queue.enqueue('1', {'state': True})
+    last = queue.enqueue_many('1', [{'state': False}, {'state': True}])
+    assert last == 3
+    assert [command['seq'] for command in queue.pending('1')] == [1, 2, 3]
+    queue.ack('1', 2)
+    assert queue.pending('1') == [{'state': True, 'seq': 3}]
+
+
+def test_stale_commands_expire(tmp_path, monkeypatch):
+    queue = CommandQueue(str(tmp_path / 'commands.db'), ttl=60)
+    queue.enqueue('1', {'state': True})
+    later = time.time() + 61
+    monkeypatch.setattr(time, 'time', lambda: later)
+    assert queue.pending('1') == []
+    queue.enqueue('1', {'state': False})
+    assert queue.pending('1') == [{'state': False, 'seq': 2}]
+    queue.ack('1', 0)
+    assert queue._conn().execute('SELECT COUNT(*) FROM device_commands').fetchone()[0] == 1
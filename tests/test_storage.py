@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import HomeConflict, JSONStorage, SQLiteStorage
+
+
+def make_storage(tmp_path):
+    # A long write delay keeps the write-behind thread out of the way; the tests flush explicitly
+    return JSONStorage(str(tmp_path / 'data.json'), str(tmp_path / 'users.json'), write_delay=60)
+
+
+def test_flush_keeps_accounts_changed_by_another_worker(tmp_path):
+    seed = make_storage(tmp_path)
+    seed.save_user({'id': '1', 'username': 'one', 'password_hash': 'old'})
+    seed.save_user({'id': '2', 'username': 'two', 'password_hash': 'x'})
+    seed.flush()
+
+    a = make_storage(tmp_path)
+    b = make_storage(tmp_path)
+    a.save_user(dict(a.get_user('2'), username='renamed'))
+    b.save_user(dict(b.get_user('1'), password_hash='new'))
+    b.flush()
+    a.flush()
+
+    with open(tmp_path / 'users.json') as f:
+        users = {user['id']: user for user in json.load(f)}
+    assert users['1']['password_hash'] == 'new'
+    assert users['2']['username'] == 'renamed'
+
+
+def test_flush_keeps_signups_from_another_worker(tmp_path):
+    seed = make_storage(tmp_path)
+    seed.save_user({'id': '1', 'username': 'one', 'password_hash': 'x'})
+    seed.flush()
+
+    a = make_storage(tmp_path)
+    b = make_storage(tmp_path)
+    a.save_user(dict(a.get_user('1'), password_hash='y'))
+    b.save_user({'id': '2', 'username': 'two', 'password_hash': 'z'})
+    b.flush()
+    a.flush()
+
+    assert {user['id'] for user in make_storage(tmp_path).load_users()} == {'1', '2'}
+    assert make_storage(tmp_path).get_user('1')['password_hash'] == 'y'
+
+
+def test_flush_keeps_homes_changed_by_another_worker(tmp_path):
+    seed = make_storage(tmp_path)
+    seed.save_homes({'1': {'rooms': [], 'revision': 1}, '2': {'rooms': [], 'revision': 1}})
+    seed.flush()
+
+    a = make_storage(tmp_path)
+    b = make_storage(tmp_path)
+    a.save_home('2', {'rooms': [], 'revision': 2})
+    b.save_home('1', {'rooms': [], 'revision': 5})
+    b.flush()
+    a.flush()
+
+    homes = make_storage(tmp_path).load_all()
+    assert homes['1']['revision'] == 5
+    assert homes['2']['revision'] == 2
+
+
+def test_sqlite_save_rejects_a_home_saved_since_it_was_read(tmp_path):
+    a = SQLiteStorage(str(tmp_path / 'homes.db'))
+    b = SQLiteStorage(str(tmp_path / 'homes.db'))
+    a.save_homes({'1': {'rooms': [], 'revision': 1}, '2': {'rooms': [], 'revision': 1}}, {'1': 0, '2': 0})
+
+    b.save_home('1', {'rooms': ['b'], 'revision': 2}, expected=1)
+    with pytest.raises(HomeConflict) as conflict:
+        a.save_homes({'1': {'rooms': ['a'], 'revision': 2}, '2': {'rooms': ['a'], 'revision': 2}}, {'1': 1, '2': 1})
+
+    assert conflict.value.user_ids == ['1']
+    assert a.get_home('1')['rooms'] == ['b']
+    assert a.get_home('2')['rooms'] == ['a']
+
+
+def test_sqlite_save_only_creates_a_missing_home_at_revision_zero(tmp_path):
+    store = SQLiteStorage(str(tmp_path / 'homes.db'))
+    with pytest.raises(HomeConflict):
+        store.save_home('1', {'rooms': [], 'revision': 4}, expected=3)
+    assert store.get_home('1') is None
+    store.save_home('1', {'rooms': [], 'revision': 1}, expected=0)
+    with pytest.raises(HomeConflict):
+        store.save_home('1', {'rooms': [], 'revision': 1}, expected=0)
@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timer_scheduler import TimerJournal, TimerScheduler
+
+
+def test_journal_replays_changes_from_other_workers_in_order(tmp_path):
+    leader = TimerJournal(str(tmp_path / 'timers.db'))
+    worker = TimerJournal(str(tmp_path / 'timers.db'))
+    worker.record(('1', 'r1', 'a1'), 100.0)
+    after = leader.last_id()
+    worker.record(('1', 'r1', 'a2'), 200.0)
+    worker.record(('1', 'r1', 'a2'), 300.0)
+    worker.record(('1', 'r1', 'a3'), 400.0)
+    worker.record(('1', 'r1', 'a3'))
+
+    scheduler = TimerScheduler(lambda due: None)
+    after = leader.apply(scheduler, after)
+    assert scheduler.pop_due(now=1000) == [(('1', 'r1', 'a2'), 300.0)]
+    assert leader.take(after) == (after, [])
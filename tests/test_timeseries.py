@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timeseries import parse_export_bound, parse_reading
+
+
+@pytest.mark.parametrize('timestamp', [1e18, -1e18, 1e308, 2**63, float('inf'), float('nan')])
+def test_parse_reading_rejects_unrepresentable_epochs(timestamp):
+    with pytest.raises(ValueError):
+        parse_reading({'timestamp': timestamp, 'consumption': 1.0})
+
+
+def test_parse_reading_accepts_epoch_seconds():
+    hour, consumption = parse_reading({'timestamp': 1700000000, 'consumption': 1.5})
+    assert consumption == 1.5
+    assert hour > 0
+
+
+@pytest.fixture
+def berlin_time(monkeypatch):
+    monkeypatch.setenv('TZ', 'Europe/Berlin')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_export_bounds_use_the_readings_local_clock(berlin_time):
+    stamp = 1700000000  # 2023-11-14 22:13 UTC, 23:13 in Berlin
+    reading_hour, _ = parse_reading({'timestamp': stamp, 'consumption': 1.0})
+    assert parse_export_bound(str(stamp)) == reading_hour
+    assert parse_export_bound('2023-11-14T22:13:20+00:00') == reading_hour
+    assert parse_export_bound(str(stamp), is_end=True) == reading_hour + 1
+    assert parse_export_bound('2023-11-14T23:13:20') == reading_hour
+
+
+def test_date_only_end_bound_covers_the_whole_day(berlin_time):
+    start = parse_export_bound('2023-11-14')
+    assert parse_export_bound('2023-11-14', is_end=True) == start + 24
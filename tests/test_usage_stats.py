@@ -0,0 +1,44 @@
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timeseries import TimeSeries, to_epoch_hours
+from usage_stats import UsageStats, summarize_usage
+
+NOW = datetime(2024, 3, 15, 12)
+
+
+def make_series(hours=24 * 400):
+    end = to_epoch_hours(NOW)
+    rng = np.random.default_rng(0)
+    # Rounded to 0.01 kWh, the precision streamed quartile counts are exact at
+    consumption = (np.round(rng.gamma(2.0, 0.4, hours) * 100) / 100).astype(np.float32)
+    return TimeSeries(np.arange(end - hours, end, dtype=np.int32), consumption)
+
+
+def assert_same_summary(a, b):
+    for field in ('count', 'peak_usage', 'peak_hour', 'this_month_count', 'last_month_count', 'this_month_days'):
+        assert getattr(a, field) == getattr(b, field), field
+    for field in ('total', 'this_month_total', 'last_month_total', 'month_change_percent'):
+        assert np.isclose(getattr(a, field), getattr(b, field)), field
+    assert np.allclose(a.hourly_means(), b.hourly_means())
+    assert a.quartile_counts() == b.quartile_counts()
+
+
+def test_series_summary_matches_a_streamed_pass():
+    series = make_series()
+    streamed = UsageStats(NOW).consume(zip(series.hours.tolist(), series.consumption.tolist()))
+    assert_same_summary(summarize_usage(series, NOW), streamed)
+
+
+def test_readings_added_after_a_series_are_folded_in():
+    series = make_series()
+    half = len(series) // 2
+    mixed = UsageStats(NOW).consume(TimeSeries(series.hours[:half], series.consumption[:half]))
+    mixed.add_batch(series.hours[half:], series.consumption[half:])
+    streamed = UsageStats(NOW).consume(zip(series.hours.tolist(), series.consumption.tolist()))
+    assert_same_summary(mixed, streamed)
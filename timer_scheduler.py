@@ -0,0 +1,189 @@
+import json
+import heapq
+import sqlite3
+import itertools
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms run every process as the leader
+    fcntl = None
+
+# Longest the scheduler sleeps without re-checking the heap, in seconds
+MAX_SLEEP = 60
+# Delay before timers whose fire callback failed are tried again
+RETRY_DELAY = 5
+# How often the leader picks up timers set or cancelled by other workers, in seconds
+JOURNAL_POLL_INTERVAL = 1
+
+
+class TimerScheduler:
+    """
+    Min-heap of deadlines keyed by (user_id, room_id, appliance_id).
+    Scheduling is O(log n). Rescheduling or cancelling leaves the old heap
+    entry in place and skips it when it surfaces, so neither needs a heap
+    search. Due timers are handed to fire([(key, deadline), ...]) in batches
+    from a single background thread.
+    """
+
+    def __init__(self, fire):
+        self.fire = fire
+        self._heap = []
+        self._deadlines = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key, deadline):
+        with self._condition:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._sequence), key))
+            self._compact()
+            if self._heap[0][2] == key:
+                self._condition.notify()
+
+    def cancel(self, key):
+        with self._condition:
+            self._deadlines.pop(key, None)
+            self._compact()
+
+    def next_deadline(self):
+        with self._condition:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def pop_due(self, now=None):
+        """Removes and returns every timer whose deadline has passed."""
+        now = time.time() if now is None else now
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self._heap)
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+                    due.append((key, deadline))
+        return due
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    self._discard_stale()
+                    delay = self._heap[0][0] - time.time() if self._heap else MAX_SLEEP
+                    if delay <= 0:
+                        break
+                    self._condition.wait(min(delay, MAX_SLEEP))
+                if self._stopped:
+                    return
+            due = self.pop_due()
+            if not due:
+                continue
+            try:
+                self.fire(due)
+            except Exception as e:
+                print(f"Error firing timers: {e}")
+                retry_at = time.time() + RETRY_DELAY
+                with self._condition:
+                    for key, deadline in due:
+                        if key not in self._deadlines:
+                            self._deadlines[key] = retry_at
+                            heapq.heappush(self._heap, (retry_at, next(self._sequence), key))
+
+    def _discard_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # Rebuild once cancelled entries outnumber live ones, keeping the heap O(live timers)
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self._heap)
+
+
+class TimerJournal:
+    """
+    Timer changes shared between worker processes through SQLite. Any worker
+    records the timers it sets or cancels; the process running the scheduler
+    takes them in order and applies them to its heap.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._conn().execute('''CREATE TABLE IF NOT EXISTS timer_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL,
+            deadline REAL
+        )''')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def record(self, key, deadline=None):
+        """Records a timer set to deadline, or cancelled when deadline is None."""
+        self._conn().execute('INSERT INTO timer_changes (key, deadline) VALUES (?, ?)', (json.dumps(key), deadline))
+
+    def last_id(self):
+        return self._conn().execute('SELECT COALESCE(MAX(id), 0) FROM timer_changes').fetchone()[0]
+
+    def take(self, after):
+        """
+        Drops the changes up to id after and returns (last id, [(key, deadline), ...])
+        for the ones recorded since.
+        """
+        conn = self._conn()
+        conn.execute('DELETE FROM timer_changes WHERE id <= ?', (after,))
+        rows = conn.execute('SELECT id, key, deadline FROM timer_changes WHERE id > ? ORDER BY id', (after,)).fetchall()
+        return (rows[-1][0] if rows else after), [(tuple(json.loads(key)), deadline) for _, key, deadline in rows]
+
+    def apply(self, scheduler, after):
+        """Applies the changes recorded after id after to scheduler; returns the new last id."""
+        after, changes = self.take(after)
+        for key, deadline in changes:
+            if deadline is None:
+                scheduler.cancel(key)
+            else:
+                scheduler.schedule(key, deadline)
+        return after
+
+    def follow(self, scheduler, after, interval=JOURNAL_POLL_INTERVAL):
+        """Keeps applying recorded changes to scheduler, starting after id after."""
+        while True:
+            after = self.apply(scheduler, after)
+            time.sleep(interval)
+
+
+def run_as_leader(lock_path, lead):
+    """
+    Calls lead() from a background thread once this process holds an
+    exclusive lock on lock_path, so one process at a time does the work.
+    The others keep waiting on the lock and one takes over when it exits.
+    """
+    def wait_and_lead():
+        with open(lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            lead()
+
+    thread = threading.Thread(target=wait_and_lead, daemon=True)
+    thread.start()
+    return thread
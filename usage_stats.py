@@ -0,0 +1,238 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from timeseries import TimeSeries, epoch_hour_label, parse_reading, to_epoch_hours
+
+# Readings folded in per vectorized update
+CHUNK_SIZE = 8760
+# Histogram bins per kWh for streamed quartile counts; 0.01 kWh is the precision readings are exported at
+HISTOGRAM_SCALE = 100
+# Above this many bins the histogram halves its resolution instead of growing
+MAX_HISTOGRAM_BINS = 1 << 20
+
+
+def reading_from_record(record):
+    """(epoch hour, kWh) for a reading given as a pair, a CSV row or an ingestion-API reading."""
+    if not isinstance(record, dict):
+        hour, consumption = record
+        return int(hour), float(consumption)
+    if 'timestamp' in record:
+        return parse_reading(record)
+    day = np.datetime64(str(record['date']), 'D').astype(np.int64)
+    return int(day) * 24 + int(record['hour']), float(record['consumption'])
+
+
+class UsageStats:
+    """
+    Single-pass accumulator over hourly readings. It keeps running totals,
+    the mean, the peak and the hour it first occurred, this month's and last
+    month's sums with this month's distinct days, per-hour-of-day sums, and
+    a 0.01 kWh histogram for quartile counts. Memory depends on the spread
+    of the values, never on how many readings were seen. Readings can come
+    from a list or a generator; peak ties go to the first reading seen, so
+    feed readings in time order. Streamed quartile counts are resolved to
+    the histogram's 0.01 kWh bins, which is exact for readings rounded to
+    0.01 kWh (as exported) and approximate otherwise.
+
+    A TimeSeries is already in memory and sorted, so from_series() reads the
+    totals off its columns instead, and takes the per-hour means and exact
+    quartile counts from the series' cached rollups and quartiles.
+    """
+
+    def __init__(self, now=None):
+        now = now or datetime.now()
+        this_month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        last_month_start = (this_month_start - timedelta(days=1)).replace(day=1)
+        self.this_month_hour = to_epoch_hours(this_month_start)
+        self.last_month_hour = to_epoch_hours(last_month_start)
+        self.count = 0
+        self.total = 0.0
+        self.peak_usage = 0.0
+        self.peak_hour = None
+        self.this_month_total = 0.0
+        self.this_month_count = 0
+        self.last_month_total = 0.0
+        self.last_month_count = 0
+        self.this_month_days = set()
+        self.hourly_sum = np.zeros(24)
+        self.hourly_count = np.zeros(24, dtype=np.int64)
+        # Histogram bins are 0.01 kWh steps shifted right by _shift (each coarsening halves the resolution)
+        self._shift = 0
+        self._low_bin = 0
+        self._histogram = np.zeros(0, dtype=np.int64)
+        # The TimeSeries this summary was read from, until more readings are added
+        self._series = None
+
+    @classmethod
+    def from_series(cls, series, now=None):
+        """Summarizes a TimeSeries from its sorted columns, without the histogram."""
+        stats = cls(now)
+        stats._read_series(series)
+        return stats
+
+    def _read_series(self, series):
+        hours = series.hours
+        values = series.consumption
+        if not len(values):
+            return
+        self.count = len(values)
+        self.total = float(values.sum(dtype=np.float64))
+        peak_index = int(np.argmax(values))
+        if values[peak_index] > 0:
+            self.peak_usage = float(values[peak_index])
+            self.peak_hour = int(hours[peak_index])
+        # Bounds in the column's own dtype, or searchsorted would widen a copy of the whole column
+        bounds = np.array([self.last_month_hour, self.this_month_hour], dtype=hours.dtype)
+        last_month_first, this_month_first = np.searchsorted(hours, bounds)
+        this_month = values[this_month_first:]
+        last_month = values[last_month_first:this_month_first]
+        self.this_month_total = float(this_month.sum(dtype=np.float64))
+        self.this_month_count = len(this_month)
+        self.this_month_days = set(np.unique(hours[this_month_first:] // 24).tolist())
+        self.last_month_total = float(last_month.sum(dtype=np.float64))
+        self.last_month_count = len(last_month)
+        self._series = series
+
+    def _stream_series(self):
+        """Builds the per-hour sums and histogram of the series read by from_series, so streaming can go on."""
+        series, self._series = self._series, None
+        self.hourly_sum = series.rollups.hourly.sum.copy()
+        self.hourly_count = series.rollups.hourly.count.copy()
+        for start in range(0, len(series), CHUNK_SIZE):
+            self._add_to_histogram(np.asarray(series.consumption[start:start + CHUNK_SIZE], dtype=np.float64))
+
+    # --- Feeding ---
+    def consume(self, readings):
+        """Folds in a TimeSeries or any iterable of readings (see reading_from_record); returns self."""
+        if isinstance(readings, TimeSeries):
+            if not self.count:
+                self._read_series(readings)
+                return self
+            for start in range(0, len(readings), CHUNK_SIZE):
+                self.add_batch(readings.hours[start:start + CHUNK_SIZE], readings.consumption[start:start + CHUNK_SIZE])
+            return self
+        hours = []
+        consumption = []
+        for record in readings:
+            hour, value = reading_from_record(record)
+            hours.append(hour)
+            consumption.append(value)
+            if len(hours) == CHUNK_SIZE:
+                self.add_batch(hours, consumption)
+                hours, consumption = [], []
+        if hours:
+            self.add_batch(hours, consumption)
+        return self
+
+    def add(self, hour, consumption):
+        self.add_batch([hour], [consumption])
+
+    def add_batch(self, hours, consumption):
+        hours = np.asarray(hours, dtype=np.int64)
+        values = np.asarray(consumption, dtype=np.float64)
+        if not len(hours):
+            return
+        if self._series is not None:
+            self._stream_series()
+        self.count += len(values)
+        self.total += float(values.sum())
+
+        peak_index = int(np.argmax(values))
+        if values[peak_index] > self.peak_usage:
+            self.peak_usage = float(values[peak_index])
+            self.peak_hour = int(hours[peak_index])
+
+        this_month = hours >= self.this_month_hour
+        if this_month.any():
+            self.this_month_total += float(values[this_month].sum())
+            self.this_month_count += int(np.count_nonzero(this_month))
+            self.this_month_days.update(np.unique(hours[this_month] // 24).tolist())
+        last_month = (hours >= self.last_month_hour) & ~this_month
+        if last_month.any():
+            self.last_month_total += float(values[last_month].sum())
+            self.last_month_count += int(np.count_nonzero(last_month))
+
+        hour_of_day = hours - hours // 24 * 24  # Same as % 24 for these non-negative hours, and faster
+        self.hourly_sum += np.bincount(hour_of_day, weights=values, minlength=24)
+        self.hourly_count += np.bincount(hour_of_day, minlength=24)
+        self._add_to_histogram(values)
+
+    def _add_to_histogram(self, values):
+        steps = np.rint(values * HISTOGRAM_SCALE).astype(np.int64)
+        while True:
+            bins = steps >> self._shift
+            low = min(int(bins.min()), self._low_bin) if len(self._histogram) else int(bins.min())
+            high = max(int(bins.max()), self._low_bin + len(self._histogram) - 1)
+            if high - low < MAX_HISTOGRAM_BINS:
+                break
+            self._coarsen()
+        if not len(self._histogram):
+            self._low_bin = low
+        pad_before = self._low_bin - low
+        pad_after = high - low + 1 - len(self._histogram) - pad_before
+        if pad_before or pad_after:
+            self._histogram = np.pad(self._histogram, (pad_before, pad_after))
+            self._low_bin = low
+        self._histogram += np.bincount(bins - low, minlength=len(self._histogram))
+
+    def _coarsen(self):
+        """Halves the histogram resolution, merging neighbouring bins the way new values are binned."""
+        self._shift += 1
+        if len(self._histogram):
+            merged = (np.arange(len(self._histogram)) + self._low_bin) >> 1
+            self._histogram = np.bincount(merged - merged[0], weights=self._histogram).astype(np.int64)
+            self._low_bin = int(merged[0])
+
+    # --- Results ---
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    @property
+    def peak_time(self):
+        return epoch_hour_label(self.peak_hour) if self.peak_hour is not None else ""
+
+    @property
+    def this_month_daily_average(self):
+        return self.this_month_total / max(1, len(self.this_month_days))
+
+    @property
+    def month_change_percent(self):
+        """Change of this month's mean hourly reading against last month's, in percent."""
+        this_month_avg = self.this_month_total / self.this_month_count if self.this_month_count else 0
+        last_month_avg = self.last_month_total / self.last_month_count if self.last_month_count else 0
+        return ((this_month_avg - last_month_avg) / max(last_month_avg, 1)) * 100 if last_month_avg > 0 else 0
+
+    def hourly_means(self):
+        """Mean reading per hour of day (0 where there are none)."""
+        if self._series is not None:
+            hourly = self._series.rollups.hourly
+            return np.divide(hourly.sum, hourly.count, out=np.zeros(24), where=hourly.count > 0)
+        return np.divide(self.hourly_sum, self.hourly_count, out=np.zeros(24), where=self.hourly_count > 0)
+
+    def quartile_counts(self):
+        """
+        Readings at or below the first quartile, then up to the median, up
+        to the third quartile and above it. Quartiles are the values at
+        ranks n/4, n/2 and 3n/4; see the class docstring for when they are
+        resolved to the histogram's bin width.
+        """
+        if self._series is not None:
+            return self._series.quartile_counts
+        cumulative = np.cumsum(self._histogram)
+        ranks = [self.count // 4, self.count // 2, 3 * self.count // 4]
+        low, to_median, to_q3 = (int(cumulative[np.searchsorted(cumulative, rank, side='right')]) for rank in ranks)
+        return [low, to_median - low, to_q3 - to_median, self.count - to_q3]
+
+
+def summarize_usage(data, now=None):
+    """
+    Returns data itself when it is already a UsageStats, reads a TimeSeries
+    off its columns, and takes one streaming pass over anything else.
+    """
+    if isinstance(data, UsageStats):
+        return data
+    if isinstance(data, TimeSeries):
+        return UsageStats.from_series(data, now)
+    return UsageStats(now).consume(data)